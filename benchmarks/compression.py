@@ -0,0 +1,136 @@
+"""
+Benchmark of the compression of the cached bodies: compression ratio,
+store time and hit latency (get_resource()) for each codec and level.
+
+The pages are read from HTML files (or directories of HTML files), or
+from the HTML resources stored in a levior cache:
+
+    python benchmarks/compression.py ~/saved-pages/
+    python benchmarks/compression.py --cache-path ~/.local/share/levior/cache
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import diskcache
+from omegaconf import OmegaConf
+from yarl import URL
+
+from levior import caching
+
+
+def load_pages(paths: list, cache_path: str = None, limit: int = 500) -> list:
+    pages: list = []
+
+    if cache_path:
+        src = diskcache.Cache(cache_path)
+
+        for key in src:
+            if not isinstance(key, str) or \
+               key.startswith(caching.internal_key_prefixes):
+                continue
+
+            entry = caching.get_resource(src, URL(key))
+
+            if entry and entry[0] == 'text/html' and \
+               isinstance(entry[1], (bytes, str)):
+                pages.append(entry[1])
+
+            if len(pages) >= limit:
+                break
+
+    for path in [Path(p) for p in paths]:
+        files = path.rglob('*.html') if path.is_dir() else [path]
+
+        for file in files:
+            pages.append(file.read_bytes())
+
+            if len(pages) >= limit:
+                return pages
+
+    return pages
+
+
+def bench(pages: list, codec: str, level: int, rounds: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = caching.configure_cache(OmegaConf.create({
+            'cache_path': tmpdir,
+            'cache_eviction_policy': 'none',
+            'cache_size_limit': 8192,
+            'cache_compression': codec,
+            'cache_compression_level': level
+        }))
+        urls = [URL(f'https://bench.example/{idx}')
+                for idx in range(len(pages))]
+
+        started = time.perf_counter()
+
+        for url, page in zip(urls, pages):
+            caching.cache_resource(cache, url, 'text/html', page)
+
+        store_time = time.perf_counter() - started
+        stored = sum(len(cache.get(caching.cache_key_for_url(url))[1])
+                     for url in urls)
+
+        latencies: list = []
+
+        for _ in range(rounds):
+            for url in urls:
+                started = time.perf_counter()
+                caching.get_resource(cache, url)
+                latencies.append(time.perf_counter() - started)
+
+        latencies.sort()
+        cache.close()
+
+        return {
+            'ratio': sum(len(page) for page in pages) / stored,
+            'store_ms': store_time * 1000 / len(pages),
+            'hit_mean_ms': statistics.mean(latencies) * 1000,
+            'hit_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+        }
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*',
+                        help='HTML files or directories')
+    parser.add_argument('--cache-path', dest='cache_path', default=None,
+                        help='Read the HTML pages from this levior cache')
+    parser.add_argument('--limit', type=int, default=500,
+                        help='Maximum number of pages')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Number of reads of each page')
+    args = parser.parse_args()
+
+    pages = load_pages(args.paths, args.cache_path, limit=args.limit)
+
+    if not pages:
+        print('No pages found', file=sys.stderr)
+        sys.exit(1)
+
+    print(f'{len(pages)} pages, '
+          f'{sum(len(p) for p in pages) / len(pages) / 1024:.1f} KB average')
+    print(f'{"codec":<6} {"level":>5} {"ratio":>6} {"store ms":>9} '
+          f'{"hit ms":>7} {"hit p99":>8}')
+
+    variants: list = [(None, None)] + [('zlib', lvl) for lvl in (1, 6, 9)]
+
+    if caching.have_zstd:
+        variants += [('zstd', lvl) for lvl in (1, 3, 9, 19)]
+
+    for codec, level in variants:
+        res = bench(pages, codec, level, args.rounds)
+
+        print(f'{codec or "none":<6} {level if level else "-":>5} '
+              f'{res["ratio"]:>6.2f} {res["store_ms"]:>9.3f} '
+              f'{res["hit_mean_ms"]:>7.3f} {res["hit_p99_ms"]:>8.3f}')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,5 +1,6 @@
 import asyncio
 import os
+import sys
 import traceback
 from io import StringIO
 
@@ -17,13 +18,17 @@ from omegaconf import DictConfig
 from omegaconf import ListConfig
 
 from . import __appname__
+from . import accesslog
+from . import bytes_to_humanr
 from . import caching
 from . import default_cert_paths
+from . import warmup
 from . import ocresolvers  # noqa
 
-from .caching import load_cached_access_log
 from .handler import create_levior_handler
+from .handler import warmup_fetcher
 from .rules import parse_rules
+from .rules import URLRulesIndex
 
 
 try:  # pragma: no cover
@@ -168,13 +173,72 @@ def levior_configure_server(cli_cfg,
 
     cache = caching.configure_cache(config)
 
+    # Compile the URL rules index
+    rules_index = URLRulesIndex(rules,
+                                lru_size=config.get('rules_lru_size', 4096))
+
     return (config, Server(
         create_server_ssl_context(cert_path, key_path),
         create_levior_handler(
-            config, cache, rules,
+            config, cache, rules_index,
             graph=graph,
-            access_log=load_cached_access_log(cache)
+            access_log=accesslog.load_cached_access_log(
+                cache, capacity=config.get('access_log_size', 1000))
         ),
         host=config.get('hostname', 'localhost'),
         port=config.get('port', 1965)
     ))
+
+
+async def levior_cache_warmup(cli_cfg, graph=None) -> int:
+    """
+    Warm up the cache with the URLs of a file (a list of URLs or a
+    sitemap), or of the persisted access log if the source is
+    'access-log'. The URLs are requested through the levior request
+    handler (in proxy mode), so they're fetched, rendered and cached
+    according to the URL rules. Returns the exit status.
+    """
+
+    config, rules = get_config(cli_cfg)
+    source: str = config.cache_warmup
+    modes: list = [mode.strip() for mode in
+                   str(config.get('mode') or '').split(',') if mode.strip()]
+
+    if 'proxy' not in modes:
+        # The URLs are requested in proxy mode (on a copy of the config)
+        config = OmegaConf.merge(config, {'mode': ','.join(modes +
+                                                           ['proxy'])})
+
+    cache = caching.configure_cache(config)
+
+    if source == 'access-log':
+        urls = warmup.warmup_urls_access_log(cache)
+    else:
+        urls = warmup.warmup_urls_file(source)
+
+    handler = create_levior_handler(
+        config, cache,
+        URLRulesIndex(rules, lru_size=config.get('rules_lru_size', 4096)),
+        graph=graph,
+        background_tasks=False
+    )
+
+    def progress(url, error) -> None:
+        if error:
+            print(f'{url}: {error}', file=sys.stderr)
+
+    report = await warmup.warm_cache(
+        urls,
+        warmup_fetcher(handler),
+        concurrency=config.get('cache_warmup_concurrency', 8),
+        host_rate=config.get('cache_warmup_host_rate', 1.0),
+        progress=progress
+    )
+
+    print(f'Warmed up {report.fetched}/{report.total} URLs in '
+          f'{report.elapsed:.1f} seconds '
+          f'({report.throughput:.2f} URLs/s, '
+          f'{bytes_to_humanr(int(report.bandwidth))}/s), '
+          f'{len(report.failed)} failed')
+
+    return 0 if not report.failed else 1
@@ -0,0 +1,667 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import traceback
+
+from collections import deque
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import diskcache
+from omegaconf import DictConfig
+from yarl import URL
+
+
+logger = logging.getLogger()
+
+# Default capacity (in records) of the in-memory access log
+default_capacity: int = 1000
+
+# Name of the segment being written, and of the rotated segments
+current_segment_name: str = 'current.log'
+segment_name_re = re.compile(r'^(\d+)\.log(\.gz)?$')
+
+# Access log lines written as gemtext links (older versions)
+gemtext_line_re = re.compile(
+    r'^=>\s*(?P<url>\S+)\s*(?:\[(?P<date>[^\]]+)\])?\s*(?P<title>.*?)'
+    r'(?:\s+\(origin: (?P<client>[^,]*), status: (?P<status>\d+), '
+    r'ctype: (?P<ctype>[^)]*)\))?\s*$')
+
+# Date format of the gemtext access log lines
+gemtext_date_format: str = '%d/%b/%Y %H:%M:%S'
+
+# The default diskcache key for the main access log
+global_access_log_key: str = 'main_access_log'
+
+# Tag for access log cache entries (older levior versions)
+access_log_tag: str = 'access_log'
+
+# Directory (in the cache directory) of the persisted access logs
+access_log_dir_name: str = 'access_log'
+
+# Persistence of the access log (see configure_access_log())
+access_log_persistence: dict = {
+    'segment_size': 1024 * 1024,
+    'max_segments': 16,
+    'compress': True
+}
+
+# Retention of the access log database (see configure_access_log())
+access_log_db_settings: dict = {
+    'max_rows': 100000
+}
+
+# Name of the access log database, in the access log's directory
+access_log_db_name: str = 'requests.db'
+
+# Cache backends the access logs are persisted in (see caching.CacheBackend)
+CacheBackend = Union[diskcache.Cache, diskcache.FanoutCache]
+
+
+@dataclass
+class AccessRecord:
+    """
+    A request in the access log
+    """
+
+    time: float
+    url: str
+    status: int
+    host: Optional[str] = None
+    client: Optional[str] = None
+    ctype: Optional[str] = None
+    size: Optional[int] = None
+    title: Optional[str] = None
+
+    # Cache outcome (hit, stale, revalidated, miss, bypass)
+    outcome: Optional[str] = None
+
+    # Time spent fetching the resource and converting the page (seconds)
+    fetch_time: Optional[float] = None
+    convert_time: Optional[float] = None
+
+    # Duration of the request (seconds), and time spent in each phase
+    # of the request, in milliseconds (see timing.phases)
+    duration: Optional[float] = None
+    timings: Optional[Dict[str, float]] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'AccessRecord':
+        names = {field.name for field in fields(cls)}
+
+        return cls(**{key: val for key, val in data.items() if key in names})
+
+    @classmethod
+    def from_line(cls, line: str) -> Optional['AccessRecord']:
+        """
+        Parse a persisted access log line: a JSON record, or a gemtext
+        link written by an older version
+        """
+
+        line = line.strip()
+
+        if line.startswith('{'):
+            try:
+                return cls.from_dict(json.loads(line))
+            except (ValueError, TypeError):
+                return None
+
+        match = gemtext_line_re.match(line)
+
+        if not match:
+            return None
+
+        try:
+            rtime = datetime.strptime(match.group('date'),
+                                      gemtext_date_format).timestamp()
+        except (TypeError, ValueError):
+            rtime = 0
+
+        url = match.group('url')
+        attrs: dict = {
+            name: match.group(name) for name in ['client', 'ctype', 'title']
+            if match.group(name) not in [None, '', 'None', url]
+        }
+
+        return cls(
+            time=rtime,
+            url=url,
+            host=URL(url).host,
+            status=int(match.group('status') or 0),
+            **attrs
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({key: val for key, val in asdict(self).items()
+                           if val is not None}, separators=(',', ':'))
+
+    def gemtext(self) -> str:
+        """
+        The record as a gemtext link
+        """
+
+        rdt: str = datetime.fromtimestamp(self.time).strftime(
+            gemtext_date_format)
+
+        line: str = f'=> {self.url}  [{rdt}] {self.title or self.url}'
+        line += f' (origin: {self.client}, status: {self.status}, '
+        line += f'ctype: {self.ctype}'
+
+        if self.size is not None:
+            line += f', size: {self.size}'
+
+        if self.outcome:
+            line += f', cache: {self.outcome}'
+
+        for name in ['fetch_time', 'convert_time', 'duration']:
+            if getattr(self, name) is not None:
+                line += f', {name.split("_")[0]}: '
+                line += f'{getattr(self, name) * 1000:.0f} ms'
+
+        return line + ')'
+
+    def matches(self,
+                host: Optional[str] = None,
+                status: Optional[int] = None,
+                since: Optional[float] = None,
+                until: Optional[float] = None) -> bool:
+        return (not host or self.host == host) and \
+            (status is None or self.status == status or (
+                status < 10 and self.status // 10 == status)) and \
+            (since is None or self.time >= since) and \
+            (until is None or self.time < until)
+
+
+class AccessLog:
+    """
+    In-memory access log: a fixed-capacity ring buffer of access records
+    (the oldest records are dropped). The records appended since the last
+    drain() are kept (up to the capacity) until they're persisted.
+    """
+
+    def __init__(self, capacity: int = default_capacity):
+        self.capacity = capacity
+        self._records: deque = deque(maxlen=capacity)
+        self._unsaved: deque = deque(maxlen=capacity)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of records waiting to be persisted
+        """
+        return len(self._unsaved)
+
+    def append(self, record: AccessRecord) -> None:
+        self._records.append(record)
+        self._unsaved.append(record)
+
+    def restore(self, records: Iterable[AccessRecord]) -> None:
+        """
+        Add records which are already persisted (e.g: the tail of the
+        persisted log at startup)
+        """
+        self._records.extend(records)
+
+    def drain(self) -> List[AccessRecord]:
+        """
+        Return the records to persist, and forget them
+        """
+
+        records: List[AccessRecord] = []
+
+        while self._unsaved:
+            records.append(self._unsaved.popleft())
+
+        return records
+
+    def records(self) -> List[AccessRecord]:
+        return list(self._records)
+
+    def count(self, **filters) -> int:
+        return sum(1 for rec in self.records() if rec.matches(**filters))
+
+    def query(self,
+              offset: int = 0,
+              limit: int = 50,
+              **filters) -> List[AccessRecord]:
+        """
+        Return the records matching the filters (host, status, since,
+        until), most recent first
+        """
+
+        matching = [rec for rec in reversed(self.records())
+                    if rec.matches(**filters)]
+        return matching[offset:offset + limit]
+
+    def emit_trim_gmi(self) -> Iterator[str]:
+        for record in self.records():
+            yield record.gemtext()
+
+
+class AccessLogStore:
+    """
+    Append-only persistence of the access log, in segment files. Lines
+    are appended to the current segment, which is rotated when it's
+    bigger than segment_size bytes (the rotated segments are gzipped if
+    compress is set). Only the max_segments most recent rotated segments
+    are kept.
+    """
+
+    def __init__(self,
+                 directory: Union[Path, str],
+                 segment_size: int = 1024 * 1024,
+                 max_segments: int = 16,
+                 compress: bool = True):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.compress = compress
+
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def current(self) -> Path:
+        return self.directory.joinpath(current_segment_name)
+
+    def rotated(self) -> List[Path]:
+        """
+        Return the rotated segments, oldest first
+        """
+
+        segments: list = []
+
+        for path in self.directory.iterdir():
+            match = segment_name_re.match(path.name)
+
+            if match:
+                segments.append((int(match.group(1)), path))
+
+        return [path for seq, path in sorted(segments)]
+
+    def append(self, lines: List[str]) -> int:
+        """
+        Append lines to the current segment, and rotate it if it's full.
+        Returns the number of bytes written.
+        """
+
+        if not lines:
+            return 0
+
+        data = ''.join(f'{line}\n' for line in lines).encode()
+
+        with self._lock:
+            with open(self.current, 'ab') as fd:
+                fd.write(data)
+                size = fd.tell()
+
+            if size >= self.segment_size:
+                self._rotate()
+
+        return len(data)
+
+    def _rotate(self) -> None:
+        rotated = self.rotated()
+        seq: int = int(segment_name_re.match(
+            rotated[-1].name).group(1)) + 1 if rotated else 1
+        dest = self.directory.joinpath(f'{seq:08d}.log')
+
+        if self.compress:
+            with open(self.current, 'rb') as src:
+                with gzip.open(f'{dest}.gz', 'wb') as gz:
+                    gz.write(src.read())
+
+            self.current.unlink()
+            rotated.append(Path(f'{dest}.gz'))
+        else:
+            os.replace(self.current, dest)
+            rotated.append(dest)
+
+        for path in rotated[:-self.max_segments]:
+            try:
+                path.unlink()
+            except FileNotFoundError:  # pragma: no cover
+                continue
+
+    def read_segment(self, path: Path) -> List[str]:
+        opener = gzip.open if path.suffix == '.gz' else open
+
+        try:
+            with opener(path, 'rb') as fd:
+                return fd.read().decode(errors='replace').splitlines()
+        except (FileNotFoundError, OSError, EOFError):  # pragma: no cover
+            logger.warning(f'{path}: could not read the access log segment')
+            return []
+
+    def tail(self, count: int) -> List[str]:
+        """
+        Return the last count lines of the log (oldest first), reading
+        the segments from the most recent one until there are enough
+        """
+
+        lines: List[str] = []
+
+        with self._lock:
+            segments = self.rotated() + (
+                [self.current] if self.current.exists() else [])
+
+            for path in reversed(segments):
+                lines = self.read_segment(path) + lines
+
+                if len(lines) >= count:
+                    break
+
+        return lines[-count:] if count else []
+
+
+class AccessLogDB:
+    """
+    Queryable store of the access records, in an SQLite database indexed
+    by time, host and status. Only the max_rows most recent records are
+    kept.
+    """
+
+    schema: str = '''
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time REAL NOT NULL,
+            url TEXT NOT NULL,
+            host TEXT,
+            status INTEGER,
+            client TEXT,
+            ctype TEXT,
+            size INTEGER,
+            title TEXT,
+            outcome TEXT,
+            fetch_time REAL,
+            convert_time REAL,
+            duration REAL,
+            timings TEXT
+        );
+        CREATE INDEX IF NOT EXISTS requests_time ON requests (time);
+        CREATE INDEX IF NOT EXISTS requests_host ON requests (host, time);
+        CREATE INDEX IF NOT EXISTS requests_status ON requests (status, time);
+    '''
+
+    columns: tuple = tuple(field.name for field in fields(AccessRecord))
+
+    def __init__(self, path: Union[Path, str], max_rows: int = 100000):
+        self.path = Path(path)
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path),
+                                   isolation_level=None,
+                                   check_same_thread=False)
+
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(self.schema)
+
+            columns = [row[1] for row in self._db.execute(
+                'PRAGMA table_info(requests)').fetchall()]
+
+            for column, ctype in [('duration', 'REAL'), ('timings', 'TEXT')]:
+                if column not in columns:
+                    # Database created by an older version
+                    self._db.execute(
+                        f'ALTER TABLE requests ADD COLUMN {column} {ctype}')
+
+    def _exec(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def _row(self, record: AccessRecord) -> tuple:
+        return tuple(
+            json.dumps(record.timings) if col == 'timings' and
+            record.timings is not None else getattr(record, col)
+            for col in self.columns
+        )
+
+    def _record(self, row: tuple) -> AccessRecord:
+        attrs = dict(zip(self.columns, row))
+
+        if attrs['timings']:
+            attrs['timings'] = json.loads(attrs['timings'])
+
+        return AccessRecord(**attrs)
+
+    def add(self, records: List[AccessRecord]) -> None:
+        """
+        Insert records (in a single transaction), and remove the oldest
+        records beyond max_rows
+        """
+
+        if not records:
+            return
+
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany(
+                    f'INSERT INTO requests ({", ".join(self.columns)}) '
+                    f'VALUES ({", ".join("?" * len(self.columns))})',
+                    [self._row(rec) for rec in records]
+                )
+
+                if self.max_rows:
+                    self._db.execute(
+                        'DELETE FROM requests WHERE id <= '
+                        '(SELECT MAX(id) FROM requests) - ?',
+                        (self.max_rows, ))
+
+    def _filters(self,
+                 host: Optional[str] = None,
+                 status: Optional[int] = None,
+                 since: Optional[float] = None,
+                 until: Optional[float] = None) -> Tuple[str, tuple]:
+        clauses: list = ['1']
+        params: list = []
+
+        if host:
+            clauses.append('host = ?')
+            params.append(host)
+
+        if status is not None and status < 10:
+            # Status class (e.g: 5 for the 5x statuses)
+            clauses.append('status >= ? AND status < ?')
+            params += [status * 10, status * 10 + 10]
+        elif status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+
+        if since is not None:
+            clauses.append('time >= ?')
+            params.append(since)
+
+        if until is not None:
+            clauses.append('time < ?')
+            params.append(until)
+
+        return ' AND '.join(clauses), tuple(params)
+
+    def count(self, **filters) -> int:
+        where, params = self._filters(**filters)
+
+        return self._exec(
+            f'SELECT COUNT(*) FROM requests WHERE {where}', params
+        ).fetchone()[0]
+
+    def query(self,
+              offset: int = 0,
+              limit: int = 50,
+              **filters) -> List[AccessRecord]:
+        """
+        Return the records matching the filters (host, status, since,
+        until), most recent first
+        """
+
+        where, params = self._filters(**filters)
+        cursor = self._exec(
+            f'SELECT {", ".join(self.columns)} FROM requests WHERE {where} '
+            'ORDER BY time DESC, id DESC LIMIT ? OFFSET ?',
+            params + (limit, offset)
+        )
+
+        return [self._record(row) for row in cursor.fetchall()]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# Segment stores of the access logs, by directory
+access_log_stores: Dict[str, AccessLogStore] = {}
+access_log_stores_lock = threading.Lock()
+
+# Databases of the access logs, by path
+access_log_dbs: Dict[str, AccessLogDB] = {}
+
+
+def configure_access_log(config: DictConfig) -> None:
+    """
+    Configure the persistence of the access log: segments of
+    access_log_segment_size KB, access_log_segments rotated segments kept
+    (gzipped if access_log_compress is set), and access_log_db_max_rows
+    records kept in the access log database
+    """
+
+    access_log_persistence.update(
+        segment_size=int(config.get('access_log_segment_size', 1024) * 1024),
+        max_segments=config.get('access_log_segments', 16),
+        compress=config.get('access_log_compress', True) is True
+    )
+    access_log_db_settings.update(
+        max_rows=config.get('access_log_db_max_rows', 100000)
+    )
+
+
+def access_log_store(cache: CacheBackend,
+                     key: str = None) -> AccessLogStore:
+    """
+    Return the segment store of an access log (stored in the cache
+    directory), creating it if needed
+    """
+
+    key: str = key if key else global_access_log_key
+    path = Path(cache.directory).joinpath(access_log_dir_name, key)
+
+    with access_log_stores_lock:
+        store = access_log_stores.get(str(path))
+
+        if store is None:
+            store = access_log_stores[str(path)] = AccessLogStore(
+                path, **access_log_persistence)
+
+        return store
+
+
+def access_log_db(cache: CacheBackend,
+                  key: str = None) -> AccessLogDB:
+    """
+    Return the database of an access log (stored next to its segments),
+    creating it if needed. A new database is filled with the records of
+    the existing segments.
+    """
+
+    store = access_log_store(cache, key=key)
+    path = store.directory.joinpath(access_log_db_name)
+
+    with access_log_stores_lock:
+        db = access_log_dbs.get(str(path))
+
+        if db is not None:
+            return db
+
+        created: bool = not path.exists()
+        db = access_log_dbs[str(path)] = AccessLogDB(
+            path, **access_log_db_settings)
+
+    if created:
+        db.add(parse_access_log_lines(store.tail(db.max_rows)))
+
+    return db
+
+
+def parse_access_log_lines(lines: List[str]) -> List[AccessRecord]:
+    records = [AccessRecord.from_line(line) for line in lines]
+    return [record for record in records if record is not None]
+
+
+def persist_access_log(cache: CacheBackend,
+                       access_log: AccessLog,
+                       key: str = None) -> int:
+    """
+    Append the new records of this access log to its segment store (as
+    JSON lines) and to its database. Returns the number of records
+    persisted.
+
+    :param AccessLog access_log: Access log
+    :param str key: Name of the access log
+    """
+
+    db = access_log_db(cache, key=key)
+    records = access_log.drain()
+
+    access_log_store(cache, key=key).append(
+        [record.to_json() for record in records])
+    db.add(records)
+    return len(records)
+
+
+def load_cached_access_log(cache: CacheBackend,
+                           key: str = None,
+                           capacity: int = default_capacity
+                           ) -> AccessLog:
+    """
+    Load the tail (the last capacity records) of the persisted access
+    log. An access log stored in the diskcache (by older levior versions)
+    is moved to the segment store and to the database.
+    """
+
+    key: str = key if key else global_access_log_key
+    store = access_log_store(cache, key=key)
+    log = AccessLog(capacity=capacity)
+
+    try:
+        fd = cache.get(key, read=True)
+
+        if fd is not None:
+            with fd:
+                records = parse_access_log_lines(
+                    fd.read().decode().splitlines())
+
+            # Open the database first (a new one imports the segments)
+            db = access_log_db(cache, key=key)
+            store.append([record.to_json() for record in records])
+            db.add(records)
+            cache.delete(key)
+    except diskcache.Timeout:  # pragma: no cover
+        pass
+    except BaseException:  # pragma: no cover
+        traceback.print_exc()
+
+    log.restore(parse_access_log_lines(store.tail(capacity)))
+    return log
+
+
+async def cache_persist_task(cache: CacheBackend,
+                             access_log: AccessLog) -> None:
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(3)
+
+        if access_log.pending > 0:
+            await loop.run_in_executor(None, persist_access_log,
+                                       cache, access_log)
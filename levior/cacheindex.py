@@ -0,0 +1,276 @@
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, Optional, List, Set, Tuple, Union
+
+
+# Name of the index database file, in the cache directory
+index_db_name: str = 'levior-index.db'
+
+# Columns of an index entry, in order
+entry_columns: tuple = ('key', 'url', 'host', 'ctype', 'size',
+                        'stored', 'expires', 'hits', 'content')
+
+
+class CacheIndex:
+    """
+    Lightweight metadata index of the resources stored in the cache
+    (URL, content type, size, storage date, expiration date, hit count
+    and the key of the shared content entry), kept in an SQLite database
+    next to the diskcache. Listing the cache only reads this index, never
+    the cached bodies.
+
+    The hits and the misses of the cache lookups are counted in memory,
+    and written to the database by flush().
+    """
+
+    schema: str = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            host TEXT,
+            ctype TEXT,
+            size INTEGER DEFAULT 0,
+            stored REAL,
+            expires REAL,
+            hits INTEGER DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS entries_host ON entries (host);
+        CREATE INDEX IF NOT EXISTS entries_ctype ON entries (ctype);
+        CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+        CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored);
+    '''
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.created = not self.path.exists()
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._hits: Dict[str, int] = {}
+        self._misses: Dict[str, Tuple[Optional[str], float]] = {}
+        self._db = sqlite3.connect(str(self.path),
+                                   isolation_level=None,
+                                   check_same_thread=False)
+
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(self.schema)
+
+            columns = [row[1] for row in self._db.execute(
+                'PRAGMA table_info(entries)').fetchall()]
+
+            if 'content' not in columns:
+                # Index created by an older version
+                self._db.execute('ALTER TABLE entries ADD COLUMN content TEXT')
+
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_content '
+                             'ON entries (content)')
+
+    def _exec(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def add(self,
+            key: str,
+            url: str,
+            host: Optional[str],
+            ctype: Optional[str],
+            size: int = 0,
+            expires: Optional[float] = None,
+            stored: Optional[float] = None,
+            content: Optional[str] = None) -> None:
+        """
+        Add (or replace) the index entry for a cache key. The hit count
+        of a replaced entry is kept.
+        """
+
+        with self._pending_lock:
+            # Stored again since the lookup miss
+            self._misses.pop(key, None)
+
+        self._exec(
+            'INSERT INTO entries (key, url, host, ctype, size, stored, '
+            'expires, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET url=excluded.url, '
+            'host=excluded.host, ctype=excluded.ctype, size=excluded.size, '
+            'stored=excluded.stored, expires=excluded.expires, '
+            'content=excluded.content',
+            (key, url, host, ctype, size,
+             stored if stored else time.time(), expires, content)
+        )
+
+    def entry(self, key: str) -> Optional[dict]:
+        """
+        Return the index entry (as a dict) of a cache key, or None
+        """
+
+        row = self._exec(
+            f'SELECT {", ".join(entry_columns)} FROM entries WHERE key = ?',
+            (key, )).fetchone()
+
+        return dict(zip(entry_columns, row)) if row else None
+
+    def content(self, key: str) -> Optional[str]:
+        """
+        Return the key of the content entry referenced by a cache key
+        """
+
+        row = self._exec('SELECT content FROM entries WHERE key = ?',
+                         (key, )).fetchone()
+
+        return row[0] if row else None
+
+    def content_refs(self, content: str) -> int:
+        """
+        Return the number of (unexpired) entries referencing a content
+        entry
+        """
+
+        return self._exec(
+            'SELECT COUNT(*) FROM entries WHERE content = ? AND '
+            '(expires IS NULL OR expires > ?)',
+            (content, time.time())
+        ).fetchone()[0]
+
+    def referenced_contents(self) -> Set[str]:
+        """
+        Return the keys of the content entries referenced by (unexpired)
+        entries
+        """
+
+        return {row[0] for row in self._exec(
+            'SELECT DISTINCT content FROM entries WHERE content IS NOT NULL '
+            'AND (expires IS NULL OR expires > ?)', (time.time(), )
+        ).fetchall()}
+
+    def hit(self, key: str) -> None:
+        with self._pending_lock:
+            self._hits[key] = self._hits.get(key, 0) + 1
+
+    def missed(self, key: str, host: Optional[str] = None) -> None:
+        """
+        Record a lookup miss for a cache key: its entry is removed from
+        the index by the next flush(), if it had not expired
+        """
+
+        with self._pending_lock:
+            self._misses[key] = (host, time.time())
+
+    def flush(self) -> List[Optional[str]]:
+        """
+        Write the hits counted since the last flush, and remove the
+        entries of the resources missing from the cache. Returns the
+        hosts of the resources which had been evicted (missing before
+        their expiration).
+        """
+
+        with self._pending_lock:
+            hits, self._hits = self._hits, {}
+            misses, self._misses = self._misses, {}
+
+        evicted: List[Optional[str]] = []
+
+        if not hits and not misses:
+            return evicted
+
+        with self._lock:
+            self._db.execute('BEGIN')
+
+            try:
+                self._db.executemany(
+                    'UPDATE entries SET hits = hits + ? WHERE key = ?',
+                    [(count, key) for key, count in hits.items()])
+
+                for key, (host, missed_at) in misses.items():
+                    if self._db.execute(
+                            'DELETE FROM entries WHERE key = ? AND '
+                            '(expires IS NULL OR expires > ?)',
+                            (key, missed_at)).rowcount > 0:
+                        evicted.append(host)
+
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+        return evicted
+
+    def touch(self, key: str, expires: Optional[float]) -> None:
+        self._exec('UPDATE entries SET expires = ? WHERE key = ?',
+                   (expires, key))
+
+    def remove(self, key: str) -> None:
+        with self._pending_lock:
+            self._hits.pop(key, None)
+            self._misses.pop(key, None)
+
+        self._exec('DELETE FROM entries WHERE key = ?', (key, ))
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """
+        Remove the entries of the expired resources
+        """
+
+        return self._exec(
+            'DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?',
+            (now if now else time.time(), )
+        ).rowcount
+
+    def _filters(self,
+                 host: Optional[str] = None,
+                 ctype: Optional[str] = None,
+                 min_size: Optional[int] = None,
+                 max_size: Optional[int] = None) -> Tuple[str, tuple]:
+        clauses: list = ['(expires IS NULL OR expires > ?)']
+        params: list = [time.time()]
+
+        if host:
+            clauses.append('host = ?')
+            params.append(host)
+
+        if ctype:
+            # Match the full content type, or its main type (e.g: image)
+            clauses.append('(ctype = ? OR ctype LIKE ?)')
+            params += [ctype, f'{ctype}/%']
+
+        if min_size is not None:
+            clauses.append('size >= ?')
+            params.append(min_size)
+
+        if max_size is not None:
+            clauses.append('size <= ?')
+            params.append(max_size)
+
+        return ' AND '.join(clauses), tuple(params)
+
+    def count(self, **filters) -> int:
+        where, params = self._filters(**filters)
+
+        return self._exec(
+            f'SELECT COUNT(*) FROM entries WHERE {where}', params
+        ).fetchone()[0]
+
+    def query(self,
+              offset: int = 0,
+              limit: int = 50,
+              **filters) -> List[dict]:
+        """
+        Return the index entries (as dicts) matching the filters (host,
+        ctype, min_size, max_size), most recently stored first
+        """
+
+        where, params = self._filters(**filters)
+        cursor = self._exec(
+            f'SELECT {", ".join(entry_columns)} FROM entries WHERE {where} '
+            'ORDER BY stored DESC, rowid DESC LIMIT ? OFFSET ?',
+            params + (limit, offset)
+        )
+
+        return [dict(zip(entry_columns, row)) for row in cursor.fetchall()]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,180 @@
+import asyncio
+import concurrent.futures
+import functools
+import time
+
+from typing import Callable, Dict, Optional, BinaryIO
+
+from omegaconf import DictConfig
+from yarl import URL
+
+from . import caching
+from .stats import LatencyHistogram
+
+# Default number of cache I/O threads
+default_workers: int = 4
+
+# Plain values up to this size (in bytes) are stored inline (on the event
+# loop)
+default_inline_max_size: int = 4096
+
+executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+workers: int = default_workers
+inline_max_size: int = default_inline_max_size
+
+# Latency of the cache operations, by operation type
+latencies: Dict[str, LatencyHistogram] = {}
+
+
+def configure(config: DictConfig) -> None:
+    """
+    Configure the cache I/O executor (cache_io_workers threads). Plain
+    values (set_value) smaller than cache_io_inline_max bytes are stored
+    inline, a thread handoff costs more than a small write. Resources and
+    rendered pages always go through the executor: storing them reads or
+    indexes other cache entries, whatever the size of the value.
+    """
+
+    global workers, inline_max_size
+
+    workers = config.get('cache_io_workers', default_workers)
+    inline_max_size = config.get('cache_io_inline_max',
+                                 default_inline_max_size)
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Return the cache I/O executor, creating it if needed
+    """
+
+    global executor
+
+    if executor is None:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(workers, 1),
+            thread_name_prefix='levior-cacheio'
+        )
+
+    return executor
+
+
+def shutdown_executor(wait: bool = False) -> None:
+    """
+    Shut down the cache I/O executor
+    """
+
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait=wait)
+        executor = None
+
+
+def observe(op: str, duration: float) -> None:
+    hist = latencies.get(op)
+
+    if hist is None:
+        hist = latencies.setdefault(op, LatencyHistogram())
+
+    hist.observe(duration)
+
+
+def timed(op: str, func: Callable, *args, **kwargs):
+    started = time.monotonic()
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        observe(op, time.monotonic() - started)
+
+
+async def run(op: str, func: Callable, *args, inline: bool = False,
+              **kwargs):
+    """
+    Run a (blocking) cache operation in the cache I/O executor, or on
+    the event loop if inline is True, and record its latency (the time
+    spent in the operation, not waiting for a thread)
+    """
+
+    if inline:
+        return timed(op, func, *args, **kwargs)
+
+    return await asyncio.get_event_loop().run_in_executor(
+        get_executor(),
+        functools.partial(timed, op, func, *args, **kwargs)
+    )
+
+
+def small(data) -> bool:
+    return isinstance(data, (bytes, str)) and len(data) <= inline_max_size
+
+
+async def get_value(cache: caching.CacheBackend, key: str,
+                    default=None, **kw):
+    return await run('get', cache.get, key, default, **kw)
+
+
+async def set_value(cache: caching.CacheBackend, key: str, value,
+                    **kw) -> bool:
+    return await run('set', cache.set, key, value, inline=small(value), **kw)
+
+
+async def get_resource(cache: caching.CacheBackend,
+                       url: URL) -> Optional[tuple]:
+    return await run('get_resource', caching.get_resource, cache, url)
+
+
+async def cache_resource(cache: caching.CacheBackend,
+                         url: URL, ctype: str, data, **kw) -> bool:
+    return await run('cache_resource', caching.cache_resource,
+                     cache, url, ctype, data, **kw)
+
+
+async def cache_resource_file(cache: caching.CacheBackend,
+                              url: URL, ctype: str, fd: BinaryIO,
+                              **kw) -> bool:
+    return await run('cache_resource_file', caching.cache_resource_file,
+                     cache, url, ctype, fd, **kw)
+
+
+async def get_rendered(cache: caching.CacheBackend,
+                       url: URL, fingerprint: str,
+                       meta: Optional[dict] = None) -> Optional[tuple]:
+    return await run('get_rendered', caching.get_rendered,
+                     cache, url, fingerprint, meta=meta)
+
+
+async def cache_rendered(cache: caching.CacheBackend,
+                         url: URL, fingerprint: str,
+                         gemtext: str,
+                         title: Optional[str] = None) -> bool:
+    return await run('cache_rendered', caching.cache_rendered,
+                     cache, url, fingerprint, gemtext, title)
+
+
+async def cache_update_expiration(cache: caching.CacheBackend,
+                                  url: URL, **kw) -> bool:
+    return await run('cache_update_expiration',
+                     caching.cache_update_expiration, cache, url, **kw)
+
+
+async def uncache_resource(cache: caching.CacheBackend, url: URL) -> bool:
+    return await run('uncache_resource', caching.uncache_resource,
+                     cache, url)
+
+
+def latencies_dict() -> dict:
+    return {op: hist.as_dict() for op, hist in latencies.items()}
+
+
+def latencies_prometheus(name: str = 'levior_cache_io_seconds') -> str:
+    """
+    Dump the latency histograms in the Prometheus text exposition format
+    """
+
+    lines: list = [f'# TYPE {name} histogram']
+
+    for op, hist in latencies.items():
+        lines += hist.to_prometheus(name, f'op="{op}"')
+
+    return '\n'.join(lines) + '\n'
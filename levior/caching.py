@@ -1,19 +1,40 @@
 import appdirs
 import asyncio
+import hashlib
+import io
+import json
 import logging
+import os
+import re
+import threading
+import time
 import traceback
+import zlib
 
 import diskcache
 from pathlib import Path
 from datetime import timedelta
-from io import BytesIO
-from typing import Union, Optional
+from email.utils import parsedate_to_datetime
+from typing import (Union, Optional, AsyncIterator, BinaryIO, Mapping, Dict,
+                    Tuple)
 from yarl import URL
 
+from omegaconf import Container
 from omegaconf import DictConfig
-from trimgmi import Document as GmiDocument
+from omegaconf import OmegaConf
 
 from . import __appname__
+from . import accesslog
+from .cacheindex import CacheIndex
+from .cacheindex import index_db_name
+from .hottier import hot_tier
+from .stats import cache_stats
+
+try:
+    import zstandard
+    have_zstd = True
+except ImportError:  # pragma: no cover
+    have_zstd = False
 
 
 logger = logging.getLogger()
@@ -26,15 +47,62 @@ query_cachettl_key = 'levior_cache_ttl'
 query_cache_forever_key = 'levior_cache_forever'
 
 
-# The default diskcache key for the main access log
-global_access_log_key: str = 'main_access_log'
+# Key prefix and tag for rendered gemtext cache entries
+rendered_key_prefix: str = 'rendered:'
+rendered_tag: str = 'rendered'
+
+# Key prefix and tag for file-backed (streamed) resource bodies
+blob_key_prefix: str = 'blob:'
+blob_tag: str = 'blob'
+
+# Key prefix of the content entries (bodies shared by the URLs having the
+# same content, keyed by the content's hash)
+content_key_prefix: str = 'content:'
+content_tag: str = 'content'
 
-# Tag for access log cache entries
-access_log_tag: str = 'access_log'
+# Prefixes of the cache keys which are not resource URLs
+internal_key_prefixes: tuple = (rendered_key_prefix, blob_key_prefix,
+                                content_key_prefix)
+
+# url_config attributes which affect the rendered gemtext of a page
+rendering_config_keys: list = [
+    'feathers',
+    'links_mode',
+    'html_tags_ban',
+    'gemtext_filters',
+    'http_links_domains',
+    'images'
+]
 
 # Default cache size limit (in megabytes)
 default_size_limit_mb: int = 2048
 
+# Codecs for the compression of the cached bodies
+body_codecs: tuple = ('zstd', 'zlib')
+
+# Compression of the cached bodies (see configure_compression())
+body_compression: dict = {
+    'codec': None,
+    'level': None,
+    'min_size': 1024
+}
+
+# Deduplication of the cached bodies (see configure_dedup())
+body_dedup: dict = {
+    'enabled': False,
+    'min_size': 16384
+}
+
+# Content types that are never deduplicated (pages differ between URLs)
+dedup_ctypes_exclude: list = ['text/html', 'application/xhtml+xml']
+
+# Cache backends: single-shard or sharded cache
+CacheBackend = Union[diskcache.Cache, diskcache.FanoutCache]
+
+# Cache-Control directives (with an optional value)
+cache_control_re = re.compile(
+    r'\s*([\w-]+)\s*(?:=\s*(?:"([^"]*)"|([^,\s]*)))?\s*(?:,|$)')
+
 
 def humanize_seconds(seconds: int) -> str:
     return str(timedelta(seconds=seconds))
@@ -48,7 +116,38 @@ def mbtobytes(size: Union[int, float]) -> float:
     return size * 1024 * 1024
 
 
-def configure_cache(config: DictConfig) -> diskcache.Cache:
+class FileBody:
+    """
+    Body of a cached resource stored in a file, read in chunks
+    """
+
+    def __init__(self, fd: BinaryIO, chunk_size: int = 65536):
+        self.fd = fd
+        self.chunk_size = chunk_size
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        while True:
+            chunk = self.fd.read(self.chunk_size)
+
+            if not chunk:
+                break
+
+            yield chunk
+            await asyncio.sleep(0)
+
+    def release(self) -> None:
+        self.fd.close()
+
+
+def configure_cache(config: DictConfig) -> CacheBackend:
+    """
+    Open the diskcache. If cache_shards is greater than 1, a sharded
+    cache (FanoutCache) is used: each shard has its own SQLite database,
+    so concurrent writes don't wait on each other. An existing
+    single-shard cache in the cache directory is migrated to the sharded
+    cache.
+    """
+
     cache_dir: Path = Path(
         config.cache_path if config.cache_path else default_cache_dir()
     )
@@ -70,12 +169,493 @@ def configure_cache(config: DictConfig) -> diskcache.Cache:
     else:
         size_limit_mb = default_size_limit_mb
 
-    return diskcache.Cache(
-        str(cache_dir),
-        eviction_policy=cpolicy,
-        size_limit=mbtobytes(size_limit_mb)
+    shards = config.get('cache_shards', 1)
+
+    if isinstance(shards, int) and shards > 1:
+        cache = diskcache.FanoutCache(
+            str(cache_dir),
+            shards=shards,
+            eviction_policy=cpolicy,
+            size_limit=mbtobytes(size_limit_mb)
+        )
+
+        if cache_dir.joinpath(diskcache.core.DBNAME).is_file():
+            migrate_single_cache(cache_dir, cache)
+    else:
+        cache = diskcache.Cache(
+            str(cache_dir),
+            eviction_policy=cpolicy,
+            size_limit=mbtobytes(size_limit_mb)
+        )
+
+    configure_compression(config)
+    configure_dedup(config)
+    accesslog.configure_access_log(config)
+
+    if config.get('cache_statistics', False) is True:
+        # diskcache's own hits/misses counters (this costs a write
+        # on every cache lookup)
+        cache.stats(enable=True)
+
+    return cache
+
+
+def configure_compression(config: DictConfig) -> Optional[str]:
+    """
+    Configure the compression of the cached bodies from the
+    cache_compression setting: 'zstd', 'zlib', or 'auto' (or true) for
+    zstd if the zstandard module is available, and zlib otherwise.
+    Returns the codec (None if compression is disabled).
+    """
+
+    codec = config.get('cache_compression', None)
+
+    if codec in ['auto', True]:
+        codec = 'zstd' if have_zstd else 'zlib'
+    elif codec == 'zstd' and not have_zstd:
+        logger.warning('zstandard is not installed, compressing the '
+                       'cache with zlib')
+        codec = 'zlib'
+    elif codec not in body_codecs:
+        codec = None
+
+    body_compression.update(
+        codec=codec,
+        level=config.get('cache_compression_level', None),
+        min_size=config.get('cache_compression_min_size', 1024)
     )
 
+    return codec
+
+
+def compress_body(data: bytes, codec: str,
+                  level: Optional[int] = None) -> bytes:
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(
+            level=level if level is not None else 3).compress(data)
+    elif codec == 'zlib':
+        return zlib.compress(data, level if level is not None else 6)
+
+    raise ValueError(f'Unknown codec: {codec}')
+
+
+def decompress_body(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if not have_zstd:  # pragma: no cover
+            raise ValueError('zstandard is not installed')
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'zlib':
+        return zlib.decompress(data)
+
+    raise ValueError(f'Unknown codec: {codec}')
+
+
+def encode_body(data) -> tuple:
+    """
+    Compress the body of a resource if compression is enabled and the
+    body is big enough. Returns the body to store, and the attributes to
+    store in the entry's metadata (the codec, whether the body is text,
+    and its uncompressed size).
+    """
+
+    codec = body_compression['codec']
+
+    if not codec or not isinstance(data, (bytes, str)) or \
+       len(data) < body_compression['min_size']:
+        return data, {}
+
+    raw = data.encode() if isinstance(data, str) else data
+    compressed = compress_body(raw, codec, body_compression['level'])
+
+    if len(compressed) >= len(raw):
+        # Not compressible
+        return data, {}
+
+    return compressed, {
+        'codec': codec,
+        'text': isinstance(data, str),
+        'size': len(data)
+    }
+
+
+def decode_body(data, meta: Optional[dict]):
+    """
+    Return the uncompressed body of a cached resource (entries without
+    a codec are returned as is)
+    """
+
+    if not isinstance(meta, dict) or not meta.get('codec'):
+        return data
+
+    raw = decompress_body(data, meta['codec'])
+
+    return raw.decode() if meta.get('text') else raw
+
+
+def configure_dedup(config: DictConfig) -> bool:
+    """
+    Configure the deduplication of the cached bodies: with cache_dedup
+    enabled, the bodies bigger than cache_dedup_min_size bytes (except
+    HTML pages) are stored once by content hash, in content entries
+    referenced by the URL entries.
+    """
+
+    body_dedup.update(
+        enabled=config.get('cache_dedup', False) is True,
+        min_size=config.get('cache_dedup_min_size', 16384)
+    )
+
+    return body_dedup['enabled']
+
+
+def dedupable(ctype: Optional[str], size: int) -> bool:
+    return body_dedup['enabled'] and size >= body_dedup['min_size'] and \
+        (ctype or '').split(';')[0].strip() not in dedup_ctypes_exclude
+
+
+def content_digest(data: Union[bytes, str]) -> str:
+    """
+    Return the content hash of a body. The kind of body (text, bytes or
+    file) is part of the digest, since they're stored differently.
+    """
+
+    if isinstance(data, str):
+        return 'text-' + hashlib.sha256(data.encode()).hexdigest()
+
+    return 'bytes-' + hashlib.sha256(data).hexdigest()
+
+
+def file_digest(fd: BinaryIO, chunk_size: int = 65536) -> str:
+    """
+    Return the content hash of a file, and rewind it
+    """
+
+    sha = hashlib.sha256()
+
+    for chunk in iter(lambda: fd.read(chunk_size), b''):
+        sha.update(chunk)
+
+    fd.seek(0, 0)
+    return 'file-' + sha.hexdigest()
+
+
+def extend_expiration(cache: CacheBackend,
+                      key: str,
+                      expire: Optional[int]) -> bool:
+    """
+    Extend the expiration time of a cache entry to expire seconds from
+    now, if it expires sooner (a shared entry lives as long as the
+    entries referencing it)
+    """
+
+    value, expire_at = cache.get(key, read=True, expire_time=True,
+                                 retry=True)
+
+    if isinstance(value, io.IOBase):
+        value.close()
+
+    if value is None:
+        return False
+    elif expire_at is None:
+        return True
+    elif expire is None or time.time() + expire > expire_at:
+        return cache.touch(key, expire=expire, retry=True)
+
+    return True
+
+
+def store_content(cache: CacheBackend,
+                  digest: str,
+                  value,
+                  expire: Optional[int],
+                  read: bool = False) -> Tuple[str, bool]:
+    """
+    Store a content entry, unless an entry with the same content hash
+    exists, in which case its expiration time is extended. Returns the
+    key of the content entry, and whether it was stored.
+    """
+
+    key: str = f'{content_key_prefix}{digest}'
+
+    with key_shard(cache, key).transact(retry=True):
+        if key in cache and extend_expiration(cache, key, expire):
+            return key, False
+
+        cache.set(key, value, expire=expire, read=read, tag=content_tag,
+                  retry=True)
+        return key, True
+
+
+def release_content(cache: CacheBackend,
+                    index: CacheIndex,
+                    content_key: str) -> bool:
+    """
+    Remove a content entry if no entry references it anymore
+    """
+
+    with key_shard(cache, content_key).transact(retry=True):
+        if index.content_refs(content_key) == 0:
+            return cache.delete(content_key, retry=True)
+
+    return False
+
+
+def gc_contents(cache: CacheBackend) -> int:
+    """
+    Remove the content entries that are not referenced by any (unexpired)
+    entry of the metadata index: the entries referencing them were
+    evicted, or expired earlier than them. Returns the number of content
+    entries removed.
+    """
+
+    index = cache_index(cache)
+    referenced = index.referenced_contents()
+    removed: int = 0
+
+    for key in list(cache):
+        if not isinstance(key, str) or \
+           not key.startswith(content_key_prefix) or key in referenced:
+            continue
+
+        if release_content(cache, index, key):
+            removed += 1
+
+    if removed:
+        logger.info(f'Removed {removed} orphaned content entries')
+
+    return removed
+
+
+def migrate_cache(src: CacheBackend, dst: CacheBackend) -> int:
+    """
+    Copy the entries of a cache to another cache, with their
+    expiration time and tag. Expired entries are not copied.
+    """
+
+    count: int = 0
+
+    for key in list(src):
+        value, expire_at, tag = src.get(key, read=True, expire_time=True,
+                                        tag=True, retry=True)
+        read: bool = isinstance(value, io.IOBase)
+        now = time.time()
+
+        try:
+            if value is None or (expire_at is not None and expire_at <= now):
+                continue
+
+            dst.set(key, value,
+                    expire=expire_at - now if expire_at else None,
+                    read=read, tag=tag, retry=True)
+            count += 1
+        finally:
+            if read:
+                value.close()
+
+    return count
+
+
+def migrate_single_cache(cache_dir: Path,
+                         cache: diskcache.FanoutCache) -> int:
+    """
+    Move the entries of the single-shard cache stored in cache_dir to a
+    sharded cache (stored in subdirectories of cache_dir), and remove the
+    single-shard cache's files.
+    """
+
+    src = diskcache.Cache(str(cache_dir))
+
+    try:
+        count = migrate_cache(src, cache)
+        src.clear(retry=True)
+    finally:
+        src.close()
+
+    for name in [diskcache.core.DBNAME,
+                 f'{diskcache.core.DBNAME}-wal',
+                 f'{diskcache.core.DBNAME}-shm']:
+        try:
+            cache_dir.joinpath(name).unlink()
+        except FileNotFoundError:
+            continue
+
+    # Remove the (now empty) data directories of the single-shard cache
+    for path in cache_dir.iterdir():
+        if path.is_dir() and len(path.name) == 2:
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:  # pragma: no cover
+                    continue
+
+    logger.info(f'{cache_dir}: migrated {count} entries to a sharded '
+                f'cache ({len(cache._shards)} shards)')
+    return count
+
+
+def cache_size_limit(cache: CacheBackend) -> int:
+    """
+    Return the size limit of the cache (the size limit of a sharded cache
+    is split between its shards)
+    """
+
+    if isinstance(cache, diskcache.FanoutCache):
+        return sum(shard.size_limit for shard in cache._shards)
+
+    return cache.size_limit
+
+
+def key_shard(cache: CacheBackend, key: str) -> diskcache.Cache:
+    """
+    Return the cache shard that stores this key (the cache itself if it's
+    not sharded). Transactions on a single key only need to lock its
+    shard.
+    """
+
+    if isinstance(cache, diskcache.FanoutCache):
+        return cache._shards[cache._hash(key) % cache._count]
+
+    return cache
+
+
+# Metadata indexes of the caches, by cache directory
+cache_indexes: Dict[str, CacheIndex] = {}
+cache_indexes_lock = threading.Lock()
+
+
+def cache_index(cache: diskcache.Cache) -> CacheIndex:
+    """
+    Return the metadata index of a cache, creating it if needed. If the
+    index did not exist, it's built from the entries of the cache.
+    """
+
+    index = cache_indexes.get(cache.directory)
+
+    if index is not None:
+        return index
+
+    # The cache is used from the cache I/O threads
+    with cache_indexes_lock:
+        index = cache_indexes.get(cache.directory)
+
+        if index is None:
+            index = CacheIndex(Path(cache.directory).joinpath(index_db_name))
+
+            if index.created:
+                rebuild_index(cache, index)
+            else:
+                index.purge_expired()
+
+            cache_indexes[cache.directory] = index
+
+    return index
+
+
+def flush_index(cache: diskcache.Cache) -> int:
+    """
+    Write the hits and misses counted in memory to the metadata index of
+    a cache, and count the evictions found. Returns the number of
+    evictions.
+    """
+
+    evicted = cache_index(cache).flush()
+
+    for host in evicted:
+        cache_stats.record_eviction(host)
+
+    return len(evicted)
+
+
+def flush_indexes() -> None:
+    """
+    Flush the metadata indexes of all the caches (on shutdown)
+    """
+
+    for index in list(cache_indexes.values()):
+        for host in index.flush():
+            cache_stats.record_eviction(host)
+
+
+def rebuild_index(cache: diskcache.Cache, index: CacheIndex) -> int:
+    """
+    Add the resources stored in the cache to its metadata index. This
+    reads every cache entry, it's only done once, when the index is
+    created.
+    """
+
+    count: int = 0
+
+    for key in list(cache):
+        if not isinstance(key, str) or key.startswith(internal_key_prefixes):
+            continue
+
+        try:
+            url = URL(key)
+            assert url.scheme and url.host
+
+            entry, expire_at = cache.get(key, expire_time=True)
+            ctype, data, meta = entry
+            meta = meta if isinstance(meta, dict) else {}
+            content = meta.get('content', meta.get('blob'))
+
+            index.add(key, key, url.host, ctype,
+                      size=meta.get('size', data_size(data)),
+                      expires=expire_at,
+                      stored=raw_version(meta),
+                      content=content if content and content.startswith(
+                          content_key_prefix) else None)
+            count += 1
+        except BaseException:  # pragma: no cover
+            continue
+
+    return count
+
+
+def data_size(data) -> int:
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    elif isinstance(data, FileBody):
+        try:
+            return os.fstat(data.fd.fileno()).st_size
+        except (AttributeError, OSError):  # pragma: no cover
+            return 0
+
+    return 0
+
+
+def index_resource(cache: diskcache.Cache,
+                   cache_key: str,
+                   url: URL,
+                   ctype: str,
+                   size: int,
+                   expire: Optional[int],
+                   stored: Optional[float] = None,
+                   content: Optional[str] = None) -> None:
+    """
+    Add a resource to the metadata index. If the resource referenced
+    another content entry, the content entry is removed if it's not
+    referenced anymore.
+    """
+
+    try:
+        index = cache_index(cache)
+        previous = index.content(cache_key)
+
+        index.add(
+            cache_key, cache_key, url.host, ctype,
+            size=size,
+            expires=time.time() + expire if expire is not None else None,
+            stored=stored,
+            content=content
+        )
+
+        if previous and previous != content:
+            release_content(cache, index, previous)
+    except Exception:  # pragma: no cover
+        logger.warning(f'{cache_key}: could not index: '
+                       f'{traceback.format_exc()}')
+
 
 def cache_key_for_url(url: URL) -> str:
     """
@@ -89,101 +669,530 @@ def cache_key_for_url(url: URL) -> str:
                .with_query(None))
 
 
+def ttl_lifetime(ttl: Union[int, float, None]) -> Optional[int]:
+    """
+    Return the cache lifetime for a ttl (None means forever)
+    """
+    if isinstance(ttl, (int, float)) and ttl >= 0:
+        return int(ttl)
+
+    # Negative ttl = never lifetime
+    return None
+
+
+def stale_lifetime(lifetime: Optional[int],
+                   stale_ttl: Union[int, float, None]) -> Optional[int]:
+    """
+    Return the lifetime of a cache entry which can be served stale for
+    stale_ttl seconds once its ttl expires (None means forever)
+    """
+    if lifetime is None or not isinstance(stale_ttl, (int, float)) or \
+       stale_ttl <= 0:
+        return lifetime
+
+    return lifetime + int(stale_ttl)
+
+
+def resource_meta(lifetime: Optional[int], **extra) -> dict:
+    """
+    Return the metadata stored with a cached resource: the time it was
+    stored and the time until which it's fresh (None means forever)
+    """
+    now = time.time()
+
+    return dict(extra,
+                stored=now,
+                fresh_until=now + lifetime if lifetime is not None else None)
+
+
+def resource_stale(meta: Optional[dict]) -> bool:
+    """
+    Return True if the cached resource with this metadata has expired and
+    is kept in the cache to be served stale
+    """
+    if not isinstance(meta, dict) or meta.get('fresh_until') is None:
+        return False
+
+    return time.time() >= meta['fresh_until']
+
+
+def parse_cache_control(value: Optional[str]) -> dict:
+    """
+    Parse the value of a Cache-Control header and return its directives
+    (lowercased) as a dict. Directives without a value are set to True.
+    """
+
+    directives: dict = {}
+
+    if not isinstance(value, str):
+        return directives
+
+    for match in cache_control_re.finditer(value):
+        name, qval, val = match.groups()
+
+        if not name:  # pragma: no cover
+            continue
+
+        directives[name.lower()] = qval if qval is not None else (
+            val if val else True)
+
+    return directives
+
+
+def response_validators(headers: Mapping[str, str]) -> dict:
+    """
+    Return the cache validators of an HTTP response (ETag, Last-Modified,
+    and the Cache-Control max-age)
+    """
+
+    validators: dict = {}
+    etag = headers.get('ETag')
+    lastm = headers.get('Last-Modified')
+
+    if etag:
+        validators['etag'] = etag
+
+    if lastm:
+        validators['last_modified'] = lastm
+
+    try:
+        validators['max_age'] = int(parse_cache_control(
+            headers.get('Cache-Control'))['max-age'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    return validators
+
+
+def http_date(value: Optional[str]) -> Optional[float]:
+    """
+    Return the timestamp of an HTTP date header value, or None if it's
+    invalid
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def http_cache_ttl(headers: Mapping[str, str],
+                   default: int = 0,
+                   ttl_min: int = 0,
+                   ttl_max: Optional[int] = None) -> Optional[int]:
+    """
+    Return the cache ttl of an HTTP response derived from its headers
+    (Cache-Control's s-maxage and max-age, or Expires, or a heuristic
+    based on Last-Modified), clamped between ttl_min and ttl_max. If the
+    headers don't give a freshness lifetime, default is used.
+
+    Returns None if the response must not be cached (no-store, private,
+    or "Vary: *").
+    """
+
+    cctl = parse_cache_control(headers.get('Cache-Control'))
+
+    if 'no-store' in cctl or 'private' in cctl or \
+       headers.get('Vary', '').strip() == '*':
+        return None
+
+    date = http_date(headers.get('Date')) or time.time()
+    ttl = None
+
+    try:
+        age = max(int(headers.get('Age', 0)), 0)
+    except (TypeError, ValueError):
+        age = 0
+
+    if 'no-cache' in cctl:
+        # Stored, but must be revalidated
+        ttl = 0
+    else:
+        for directive in ['s-maxage', 'max-age']:
+            try:
+                ttl = int(cctl[directive]) - age
+                break
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    if ttl is None and 'Expires' in headers:
+        expires = http_date(headers.get('Expires'))
+
+        # An invalid Expires date means "already expired"
+        ttl = int(expires - date) if expires else 0
+    elif ttl is None and 'Last-Modified' in headers:
+        lastm = http_date(headers.get('Last-Modified'))
+
+        if lastm and lastm < date:
+            # Heuristic freshness: 10% of the time since the last change
+            ttl = int((date - lastm) / 10)
+
+    if ttl is None:
+        if default < 0:
+            # No freshness information, cached forever by default
+            return default
+
+        ttl = default
+
+    ttl = max(ttl, ttl_min, 0)
+
+    return min(ttl, ttl_max) if ttl_max is not None else ttl
+
+
+def revalidable(validators: Optional[dict]) -> bool:
+    """
+    Return True if a resource can be revalidated with a conditional
+    request with these validators
+    """
+    return isinstance(validators, dict) and bool(
+        validators.get('etag') or validators.get('last_modified'))
+
+
+def conditional_fetch_args(meta: Optional[dict]) -> dict:
+    """
+    Return the crawler.fetch keyword arguments to revalidate the cached
+    resource with this metadata with a conditional request
+    """
+
+    validators = meta.get('validators') if isinstance(meta, dict) else None
+
+    if not revalidable(validators):
+        return {}
+
+    return {
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified')
+    }
+
+
+def log_cached(cache_key: str, lifetime: Optional[int]) -> None:
+    if lifetime is None:
+        logger.info(f'{cache_key}: cached forever')
+    else:
+        logger.info(
+            f'{cache_key}: cached for {humanize_seconds(lifetime)}')
+
+
 def cache_resource(cache: diskcache.Cache,
                    url: URL, ctype: str, data,
-                   ttl: Union[int, float] = None) -> bool:
+                   ttl: Union[int, float] = None,
+                   stale_ttl: Union[int, float] = None,
+                   validators: Optional[dict] = None) -> bool:
     """
-    Cache the content associated with a URL
+    Cache the content associated with a URL. If stale_ttl is set, the
+    entry is kept in the cache (and can be served stale) for stale_ttl
+    seconds after the ttl expires. The validators of the response (see
+    response_validators()) are stored with the entry.
     """
-    lifetime = None
 
     if not isinstance(url, URL):
         raise ValueError('Invalid url parameter')
 
     cache_key: str = cache_key_for_url(url)
+    lifetime = ttl_lifetime(ttl)
+    expire = stale_lifetime(lifetime, stale_ttl)
 
-    if isinstance(ttl, (int, float)):
-        if ttl >= 0:
-            lifetime = int(ttl)
-        elif ttl < 0:
-            # Negative ttl = never lifetime
-            lifetime = None
+    log_cached(cache_key, lifetime)
 
-    if lifetime is None:
-        logger.info(f'{cache_key}: cached forever')
+    started = time.monotonic()
+    body, codec_attrs = encode_body(data)
+    content_key, deduped = None, False
+
+    if dedupable(ctype, data_size(data)):
+        # Store the body in a content entry, shared by the URLs with
+        # the same content
+        content_key, stored = store_content(
+            cache, content_digest(data), (body, codec_attrs), expire)
+        deduped = not stored
+
+        meta = resource_meta(lifetime, validators=validators,
+                             content=content_key, size=data_size(data))
+        body = None
     else:
-        logger.info(
-            f'{cache_key}: cached for {humanize_seconds(lifetime)}')
+        meta = resource_meta(lifetime, validators=validators, **codec_attrs)
 
-    return cache.set(cache_key,
-                     (ctype, data, None),
-                     expire=lifetime, retry=True)
+    if not cache.set(cache_key, (ctype, body, meta),
+                     expire=expire, retry=True):  # pragma: no cover
+        return False
 
+    cache_stats.record_store(url.host, time.monotonic() - started,
+                             data_size(data), deduped=deduped)
+    hot_tier.invalidate(cache_key)
 
-def cache_update_expiration(cache: diskcache.Cache,
-                            url: URL,
-                            ttl: Union[int, float] = None) -> bool:
+    index_resource(cache, cache_key, url, ctype, data_size(data), expire,
+                   stored=meta['stored'], content=content_key)
+    return True
+
+
+def cache_resource_file(cache: diskcache.Cache,
+                        url: URL, ctype: str, fd: BinaryIO,
+                        ttl: Union[int, float] = None,
+                        stale_ttl: Union[int, float] = None,
+                        validators: Optional[dict] = None) -> bool:
+    """
+    Cache the content associated with a URL, read from a file. The
+    content is stored in a file in the cache directory, and is
+    referenced by the URL's cache entry. With deduplication, the file is
+    stored in a content entry, shared by the URLs with the same content.
+    """
+
+    if not isinstance(url, URL):
+        raise ValueError('Invalid url parameter')
+
+    cache_key: str = cache_key_for_url(url)
+    lifetime = ttl_lifetime(ttl)
+    expire = stale_lifetime(lifetime, stale_ttl)
+
+    log_cached(cache_key, lifetime)
+
+    try:
+        size = os.fstat(fd.fileno()).st_size
+    except (AttributeError, OSError):  # pragma: no cover
+        size = 0
+
+    started = time.monotonic()
+    content_key, deduped = None, False
+
+    if dedupable(ctype, size):
+        content_key, stored = store_content(cache, file_digest(fd), fd,
+                                            expire, read=True)
+        blob_key, deduped = content_key, not stored
+    else:
+        blob_key = f'{blob_key_prefix}{cache_key}'
+
+        if not cache.set(blob_key, fd, read=True, tag=blob_tag,
+                         expire=expire, retry=True):  # pragma: no cover
+            return False
+
+    meta = resource_meta(lifetime, blob=blob_key, validators=validators)
+
+    if not cache.set(cache_key, (ctype, None, meta),
+                     expire=expire, retry=True):  # pragma: no cover
+        return False
+
+    cache_stats.record_store(url.host, time.monotonic() - started, size,
+                             deduped=deduped)
+    hot_tier.invalidate(cache_key)
+
+    index_resource(cache, cache_key, url, ctype, size, expire,
+                   stored=meta['stored'], content=content_key)
+    return True
+
+
+def get_resource(cache: diskcache.Cache, url: URL) -> Optional[tuple]:
+    """
+    Return the cached (ctype, data, meta) tuple for a URL, or None.
+    The data of file-backed entries is returned as a FileBody.
+    """
+
+    cache_key: str = cache_key_for_url(url)
+    cached = cache.get(cache_key, retry=True)
+
+    if not cached:
+        # Removed from the index by the next flush, if it was evicted
+        cache_index(cache).missed(cache_key, url.host)
+        return None
+
+    ctype, data, meta = cached
+
+    try:
+        if isinstance(meta, dict) and meta.get('content'):
+            content = cache.get(meta['content'], retry=True)
+
+            if content is None:
+                # The content entry was evicted
+                cache_stats.record_eviction(url.host)
+                return None
+
+            data = decode_body(*content)
+        else:
+            data = decode_body(data, meta)
+    except Exception:
+        logger.warning(f'{cache_key}: could not decompress: '
+                       f'{traceback.format_exc()}')
+        return None
+
+    cache_index(cache).hit(cache_key)
+
+    if isinstance(meta, dict) and meta.get('blob'):
+        fd = cache.get(meta['blob'], read=True, retry=True)
+
+        if fd is None:  # pragma: no cover
+            return None
+
+        data = FileBody(fd)
+
+    return ctype, data, meta
+
+
+def url_config_fingerprint(config: DictConfig,
+                           url_config: dict,
+                           **extra) -> str:
     """
-    Update the expiration time for this url.
+    Return a fingerprint of the url_config attributes (and the levior
+    config settings) that have an effect on the rendered gemtext.
+    Extra keyword arguments (e.g the service mode) are part of the
+    fingerprint.
     """
 
-    return cache.touch(cache_key_for_url(url), expire=ttl)
+    def value(val):
+        if isinstance(val, Container):
+            return OmegaConf.to_container(val)
+        return val
+
+    attrs = {key: value(url_config.get(key))
+             for key in rendering_config_keys}
+    attrs.update({
+        'feathers_default': config.get('feathers_default'),
+        'links_mode_default': config.get('links_mode'),
+        'port': config.get('port')
+    })
+    attrs.update({key: value(val) for key, val in extra.items()})
+
+    return hashlib.sha1(
+        json.dumps(attrs, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
 
 
-def persist_access_log(cache: diskcache.Cache,
-                       access_log: GmiDocument,
-                       key: str = None,
-                       expire: float = None) -> bool:
+def rendered_cache_key(url: URL, fingerprint: str) -> str:
     """
-    Cache this access log in the diskcache
+    Return the diskcache key for the rendered gemtext of this URL
+    """
+    return f'{rendered_key_prefix}{fingerprint}:{cache_key_for_url(url)}'
+
+
+def cache_rendered(cache: diskcache.Cache,
+                   url: URL,
+                   fingerprint: str,
+                   gemtext: str,
+                   title: Optional[str] = None) -> bool:
+    """
+    Cache the rendered gemtext for a URL. The entry expires at the same
+    time as the cached raw content of the URL, and is not stored if the
+    raw content is not cached. The entry is bound to the version of the
+    raw content it was rendered from.
 
-    :param GmiDocument access_log: Access log stored as a gmi document
-    :param str key: cache key
-    :param float expire: Cache lifetime in seconds
+    The version and the expiration time of the raw content are read from
+    the metadata index, the raw content itself is not read.
     """
 
-    key: str = key if key else global_access_log_key
-    fd = BytesIO()
+    cache_key: str = cache_key_for_url(url)
+    entry = cache_index(cache).entry(cache_key)
 
-    for line in access_log.emit_trim_gmi():
-        fd.write(f'{line}\n'.encode())
+    if entry is None or cache_key not in cache:
+        return False
 
-    fd.seek(0, 0)  # needed
+    expire_at = entry['expires']
 
-    return cache.set(key, fd, tag=access_log_tag, expire=expire, read=True)
+    if expire_at:
+        lifetime = expire_at - time.time()
 
+        if lifetime <= 0:  # pragma: no cover
+            return False
+    else:
+        lifetime = None
 
-def load_cached_access_log(cache: diskcache.Cache,
-                           key: str = None) -> Optional[GmiDocument]:
+    return cache.set(rendered_cache_key(url, fingerprint),
+                     (gemtext, title, entry['stored']),
+                     expire=lifetime, tag=rendered_tag, retry=True)
+
+
+def raw_version(meta: Optional[dict]) -> Optional[float]:
     """
-    Load the access log cached in the diskcache and return a trimgmi
-    Document rebuilt from the cached bytes.
+    Return the version (the time it was stored) of a cached resource
     """
+    return meta.get('stored') if isinstance(meta, dict) else None
 
-    key: str = key if key else global_access_log_key
-    doc = GmiDocument()
 
-    try:
-        fd = cache.get(key, read=True)
-        assert fd is not None
+def get_rendered(cache: diskcache.Cache,
+                 url: URL,
+                 fingerprint: str,
+                 meta: Optional[dict] = None) -> Optional[tuple]:
+    """
+    Return the cached (gemtext, title) tuple for a URL rendered with
+    the url_config matching this fingerprint. If the metadata of the
+    cached raw content is passed, the rendered gemtext is only returned
+    if it was rendered from this version of the raw content.
+    """
 
-        for lineb in fd.readlines():
-            doc.append(lineb.decode())
+    rendered = cache.get(rendered_cache_key(url, fingerprint), retry=True)
 
-        return doc
-    except (diskcache.Timeout, AssertionError):  # pragma: no cover
-        return GmiDocument()
-    except BaseException:  # pragma: no cover
-        traceback.print_exc()
+    if not rendered:
         return None
 
+    gemtext, title = rendered[:2]
+    version = rendered[2] if len(rendered) > 2 else None
+
+    if meta is not None and version != raw_version(meta):
+        # The raw content was refreshed since
+        return None
+
+    return gemtext, title
+
+
+def cache_update_expiration(cache: diskcache.Cache,
+                            url: URL,
+                            ttl: Union[int, float] = None,
+                            stale_ttl: Union[int, float] = None) -> bool:
+    """
+    Update the expiration time for this url: the cached resource is
+    fresh again for ttl seconds (e.g after a 304 Not Modified response).
+    The version of the cached content is unchanged.
+    """
+
+    cache_key: str = cache_key_for_url(url)
+    lifetime = ttl_lifetime(ttl)
+    expire = stale_lifetime(lifetime, stale_ttl)
+
+    hot_tier.invalidate(cache_key)
+
+    with key_shard(cache, cache_key).transact(retry=True):
+        cached = cache.get(cache_key)
+
+        if cached is None:
+            return False
+
+        ctype, data, meta = cached
+
+        cache_index(cache).touch(
+            cache_key,
+            time.time() + expire if expire is not None else None
+        )
+
+        if not isinstance(meta, dict):
+            return cache.touch(cache_key, expire=expire)
+
+        meta = dict(meta, fresh_until=time.time() + lifetime
+                    if lifetime is not None else None)
+
+        for key in [meta.get('blob'), meta.get('content')]:
+            if not key:
+                continue
+            elif key.startswith(content_key_prefix):
+                # Shared content: only extend its lifetime
+                extend_expiration(cache, key, expire)
+            else:
+                cache.touch(key, expire=expire)
+
+        log_cached(cache_key, lifetime)
+
+        return cache.set(cache_key, (ctype, data, meta), expire=expire)
+
+
+def uncache_resource(cache: diskcache.Cache, url: URL) -> bool:
+    """
+    Remove the cached resource for this URL from the cache
+    """
+
+    cache_key: str = cache_key_for_url(url)
+    index = cache_index(cache)
+    content_key = index.content(cache_key)
+
+    index.remove(cache_key)
+    hot_tier.invalidate(cache_key)
 
-async def cache_persist_task(cache: diskcache.Cache,
-                             access_log: GmiDocument) -> None:
-    while True:
-        await asyncio.sleep(3)
+    deleted = cache.delete(cache_key, retry=True)
 
-        if access_log._scount > 0:
-            persist_access_log(cache, access_log)
+    if content_key:
+        release_content(cache, index, content_key)
 
-            access_log._scount = 0
+    return deleted
@@ -0,0 +1,241 @@
+import asyncio
+import concurrent.futures
+import logging
+import re
+import sys
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple, Union
+
+from md2gemini import md2gemini
+from omegaconf import Container
+from omegaconf import DictConfig
+from omegaconf import OmegaConf
+
+from . import crawler
+from . import timing
+
+
+logger = logging.getLogger()
+
+# Conversion executor types
+executor_types: list = ['process', 'thread', 'inline']
+
+# Levior config settings used by the page converter
+converter_config_keys: list = ['port', 'feathers_default']
+
+# Default timeout (in seconds) for the conversion of a page
+default_convert_timeout: int = 30
+
+executor: Optional[concurrent.futures.Executor] = None
+
+
+def executor_type(config: DictConfig) -> str:
+    etype = config.get('convert_executor', 'process')
+    return etype if etype in executor_types else 'process'
+
+
+def get_executor(config: DictConfig) -> Optional[concurrent.futures.Executor]:
+    """
+    Return the conversion executor, creating it if needed. Returns None
+    if pages are converted inline (on the event loop).
+    """
+
+    global executor
+
+    etype = executor_type(config)
+
+    if etype == 'inline':
+        return None
+
+    if executor is None:
+        workers = config.get('convert_workers', None)
+
+        if etype == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='levior-convert'
+            )
+        else:
+            opts: dict = {'max_workers': workers}
+            max_tasks = config.get('convert_max_tasks_per_child', None)
+
+            if max_tasks and sys.version_info >= (3, 11):
+                opts['max_tasks_per_child'] = max_tasks
+
+            executor = concurrent.futures.ProcessPoolExecutor(**opts)
+
+        logger.debug(f'Conversion executor started ({etype})')
+
+    return executor
+
+
+def shutdown_executor(wait: bool = False) -> None:
+    """
+    Shut down the conversion executor
+    """
+
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait=wait)
+        executor = None
+
+
+def reset_executor(pool: concurrent.futures.Executor) -> None:
+    """
+    Replace a conversion executor which has a stuck worker. The worker
+    processes of a process pool are killed (the conversions running in
+    the other workers fail with BrokenProcessPool). A thread can't be
+    stopped: the threads of a thread pool are abandoned to the stuck
+    conversions, and the next pages are converted in a new pool.
+    """
+
+    global executor
+
+    if executor is pool:
+        executor = None
+
+    if isinstance(pool, concurrent.futures.ProcessPoolExecutor):
+        for proc in list((pool._processes or {}).values()):
+            proc.kill()
+
+    pool.shutdown(wait=False)
+
+
+def conversion_snapshot(config: DictConfig,
+                        url_config: dict,
+                        **opts) -> dict:
+    """
+    Return a picklable snapshot of the settings needed to convert
+    a page with this url_config.
+    """
+
+    def value(val):
+        if isinstance(val, Container):
+            return OmegaConf.to_container(val, resolve=True)
+        return val
+
+    return {
+        'config': {key: value(config.get(key))
+                   for key in converter_config_keys
+                   if config.get(key) is not None},
+        'url_config': {key: value(val) for key, val in url_config.items()},
+        **opts
+    }
+
+
+def gemtext_title_extract(gemtext: str) -> str:
+    for line in gemtext.splitlines():
+        ma = re.match(r'^#\s(.*)$', line)
+        if ma:
+            return ma.group(1)
+
+
+def convert_page(snapshot: dict,
+                 html: Union[str, bytes]) -> Tuple[Optional[str],
+                                                   Optional[str], dict]:
+    """
+    Convert an HTML page to gemtext (HTML => Markdown => gemtext).
+    Runs in the conversion executor.
+
+    Returns a (gemtext, title, timings) tuple. The gemtext is None if the
+    markdownification failed, timings is the time spent in each step.
+    """
+
+    timings: dict = {}
+    started = time.monotonic()
+
+    conv = crawler.PageConverter(
+        domain=snapshot.get('domain'),
+        http_proxy_mode=snapshot.get('proxy_mode', False),
+        url_config=snapshot['url_config'],
+        levior_config=OmegaConf.create(snapshot['config']),
+        autolinks=False,
+        wrap=True,
+        wrap_width=80
+    )
+
+    conv.req_path = snapshot.get('req_path', '/')
+
+    if snapshot.get('gemini_server_host'):
+        conv.gemini_server_host = snapshot['gemini_server_host']
+
+    md = conv.convert(html)
+    timings['markdownify'] = time.monotonic() - started
+
+    if not md:
+        return None, None, timings
+
+    links_mode = snapshot.get('links_mode')
+    started = time.monotonic()
+
+    gemtext = md2gemini(
+        md,
+        links=links_mode if links_mode else 'paragraph',
+        checklist=False,
+        strip_html=True,
+        plain=True
+    )
+    timings['md2gemini'] = time.monotonic() - started
+
+    return gemtext, gemtext_title_extract(gemtext) if gemtext else None, \
+        timings
+
+
+async def html2gemtext(config: DictConfig,
+                       url_config: dict,
+                       html: Union[str, bytes],
+                       **opts) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Convert an HTML page to gemtext in the conversion executor
+    (a process pool by default). The time spent in each step is recorded
+    in the timing context of the request.
+
+    The timeout only stops waiting for the worker, the worker itself
+    keeps running the conversion. The executor is therefore replaced
+    when a conversion times out (see reset_executor), so that a few
+    pathological pages can't take all the workers. The conversions which
+    fail because their process pool broke (a worker died, or the pool
+    was replaced) are retried once in a new pool.
+
+    :raises asyncio.TimeoutError: if the conversion takes too long
+    """
+
+    loop = asyncio.get_running_loop()
+    snapshot = conversion_snapshot(config, url_config, **opts)
+    timeout = config.get('convert_timeout', default_convert_timeout)
+    pool = get_executor(config)
+
+    if pool is None:
+        gemtext, title, timings = convert_page(snapshot, html)
+
+    for attempt in range(2 if pool is not None else 0):
+        try:
+            gemtext, title, timings = await asyncio.wait_for(
+                loop.run_in_executor(pool, convert_page, snapshot, html),
+                timeout
+            )
+            break
+        except asyncio.TimeoutError:
+            logger.warning(f'Conversion timed out after {timeout} s, '
+                           'replacing the conversion executor')
+            reset_executor(pool)
+            raise
+        except BrokenProcessPool:
+            # A worker died or was killed: convert the page in a new pool
+            logger.warning('Conversion process pool is broken, restarting it')
+
+            if executor is pool:
+                shutdown_executor()
+
+            if attempt > 0:
+                raise
+
+            pool = get_executor(config)
+
+    for phase, duration in timings.items():
+        timing.record(phase, duration)
+
+    return gemtext, title
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from omegaconf import DictConfig
-from typing import Optional, List, Mapping
+from typing import Optional, List, Mapping, AsyncIterator
 import asyncio
 import aiohttp
 import logging
@@ -15,8 +15,9 @@ from urllib.parse import urljoin
 from yarl import URL
 from markdownify import MarkdownConverter
 
+from . import timing
 from .web import random_useragent
-from .web import get_proxy_connector
+from .web import get_client_session
 
 
 try:
@@ -28,6 +29,11 @@ except Exception:  # pragma: no cover
 
 rhtml_session = None
 ctypes_html: list = ['text/html', 'application/xhtml+xml']
+ctypes_feeds: list = ['application/xml',
+                      'application/x-rss+xml',
+                      'application/rss+xml',
+                      'text/xml',
+                      'application/atom+xml']
 user_agent_default: str = 'Mozilla/5.0 (X11; Linux x86_64; rv:54.0) Gecko/20100101 Firefox/64.0'  # noqa
 scripts_re = re.compile(r'(?s)<(script).*?</\1>', re.MULTILINE)
 
@@ -40,6 +46,49 @@ class RedirectRequired(Exception):
     url: URL
 
 
+class StreamedBody:
+    """
+    Body of an HTTP response that is streamed in chunks instead
+    of being read in memory.
+    """
+
+    def __init__(self, response: aiohttp.ClientResponse,
+                 chunk_size: int = 65536):
+        self.response = response
+        self.chunk_size = chunk_size
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        chunks = self.response.content.iter_chunked(self.chunk_size)
+
+        while True:
+            with timing.measure('download'):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+
+            yield chunk
+
+    def release(self) -> None:
+        self.response.release()
+
+
+def stream_required(config: DictConfig, ctype: str, clength: int) -> bool:
+    """
+    Return True if the body of a response with this content type and
+    length must be streamed. HTML pages and feeds are always read in
+    memory (they're converted), other resources are streamed if their
+    length is unknown or above the max in-memory size (in megabytes).
+    """
+
+    if ctype in ctypes_html or ctype in ctypes_feeds:
+        return False
+
+    max_size = config.get('max_inmemory_size', 8)
+
+    return clength == 0 or clength > max_size * 1024 * 1024
+
+
 async def on_request_start(session, trace_config_ctx, params):
     trace_config_ctx.request_start = asyncio.get_event_loop().time()
 
@@ -49,8 +98,8 @@ async def on_request_end(session, trace_config_ctx, params):
         asyncio.get_event_loop().time() - trace_config_ctx.request_start
     ) * 1000)
 
-    print(f'Req time: {elapsed_time} msecs, '
-          f'headers: {dict(params.response.request_info.headers)}')
+    logger.debug(f'Req time: {elapsed_time} msecs, '
+                 f'headers: {dict(params.response.request_info.headers)}')
 
 
 async def fetch(url: URL,
@@ -62,13 +111,22 @@ async def fetch(url: URL,
                 verify_ssl: bool = True,
                 allow_redirects: bool = False,
                 http_headers: Optional[Mapping[str, str]] = {},
-                user_agent: Optional[str] = None) -> tuple:
+                user_agent: Optional[str] = None,
+                etag: Optional[str] = None,
+                last_modified: Optional[str] = None) -> tuple:
     """
     :param URL url: The requested URL
     :param DictConfig config: Configuration
     :param bool verify_ssl: Verify SSL certificate validity
     :param str user_agent: HTTP user agent
+    :param str etag: ETag of the cached resource (conditional request)
+    :param str last_modified: Last-Modified date of the cached resource
+        (conditional request)
     :rtype: tuple
+
+    Requests go through the pooled session for this proxy config
+    (see :func:`levior.web.get_client_session`). If the resource has not
+    been modified, the response's status is 304 and no data is returned.
     """
 
     global rhtml_session
@@ -83,15 +141,11 @@ async def fetch(url: URL,
             if isinstance(value, str):
                 headers[header] = value
 
-    if proxy_url:
-        connector = get_proxy_connector(proxy_url)
-    else:
-        connector = aiohttp.TCPConnector(
-            limit=20,
-            limit_per_host=5,
-            use_dns_cache=False,
-            force_close=True
-        )
+    if isinstance(etag, str):
+        headers['If-None-Match'] = etag
+
+    if isinstance(last_modified, str):
+        headers['If-Modified-Since'] = last_modified
 
     if trace:
         trace_config = aiohttp.TraceConfig()
@@ -111,65 +165,82 @@ async def fetch(url: URL,
             fragment=url.fragment
         )
 
-    async with aiohttp.ClientSession(
-            trace_configs=[trace_config] if trace_config else [],
-            connector=connector) as session:
-        try:
-            async with session.get(url, headers=headers,
-                                   allow_redirects=allow_redirects,
-                                   verify_ssl=verify_ssl) as response:
-                location = response.headers.get('Location')
+    session = get_client_session(
+        config,
+        proxy_url=proxy_url,
+        verify_ssl=verify_ssl,
+        trace_configs=[trace_config] if trace_config else None
+    )
 
-                if location and response.status in range(300, 310):
-                    # Catch redirects so that we can notify the gemini browser
-                    raise RedirectRequired(url=URL(location))
+    response = await session.get(url, headers=headers,
+                                 allow_redirects=allow_redirects)
+    streamed = False
 
-                if response.status != 200:
-                    return response, None, None, None
+    try:
+        location = response.headers.get('Location')
 
-                ctypeh = response.headers.get('Content-Type')
-                ctype = ctypeh.split(';').pop(0)
-                clength = int(response.headers.get('Content-Length', 0))
+        if location and response.status in range(300, 310):
+            # Catch redirects so that we can notify the gemini browser
+            raise RedirectRequired(url=URL(location))
 
-                if ctype not in ctypes_html:
-                    return response, ctype, clength, await response.read()
+        if response.status != 200:
+            return response, None, None, None
 
-                try:
-                    jsmatch = None
-                    html_text = await response.text()
+        ctypeh = response.headers.get('Content-Type')
+        ctype = ctypeh.split(';').pop(0)
+        clength = int(response.headers.get('Content-Length', 0))
+
+        if ctype not in ctypes_html:
+            if stream_required(config, ctype, clength):
+                # The body will be streamed, the response is released
+                # by the consumer
+                streamed = True
+                return response, ctype, clength, StreamedBody(
+                    response,
+                    chunk_size=config.get('stream_chunk_size', 65536)
+                )
+
+            with timing.measure('download'):
+                return response, ctype, clength, await response.read()
+
+        try:
+            jsmatch = None
+
+            with timing.measure('download'):
+                html_text = await response.text()
 
-                    use_jsr = (config.js_render and url_config.get(
-                        'js_render', False))
+            use_jsr = (config.js_render and url_config.get(
+                'js_render', False))
 
-                    if have_rhtml and use_jsr:
-                        jsmatch = scripts_re.search(html_text)
+            if have_rhtml and use_jsr:
+                jsmatch = scripts_re.search(html_text)
 
-                    if have_rhtml and (jsmatch or config.js_render_always):
-                        # Use requests-html to render the JS code
+            if have_rhtml and (jsmatch or config.js_render_always):
+                # Use requests-html to render the JS code
 
-                        if rhtml_session is None:
-                            # No session yet, create one
-                            rhtml_session = AsyncHTMLSession()
+                if rhtml_session is None:
+                    # No session yet, create one
+                    rhtml_session = AsyncHTMLSession()
 
-                        rhtml = HTML(html=html_text, session=rhtml_session)
-                        await rhtml.arender()
+                rhtml = HTML(html=html_text, session=rhtml_session)
 
-                        return response, ctype, clength, rhtml.html
+                with timing.measure('js_render'):
+                    await rhtml.arender()
 
-                    return response, ctype, clength, html_text
-                except Exception:
-                    # Revert to ISO-8859-1 if chardet fails
+                return response, ctype, clength, rhtml.html
 
-                    logger.warning(traceback.format_exc())
+            return response, ctype, clength, html_text
+        except Exception:
+            # Revert to ISO-8859-1 if chardet fails
 
-                    return response, ctype, clength, \
-                        await response.text('ISO-8859-1')
+            logger.warning(traceback.format_exc())
 
-        except (aiohttp.ClientProxyConnectionError,
-                aiohttp.ClientConnectorError) as err:
-            raise err
-        except Exception as err:
-            raise err
+            with timing.measure('download'):
+                return response, ctype, clength, \
+                    await response.text('ISO-8859-1')
+    finally:
+        if not streamed:
+            response.release()
 
 
 class BaseConverter(MarkdownConverter):
@@ -18,8 +18,16 @@ from yarl import URL
 
 
 from . import __appname__
+from . import cacheio
+from . import caching
+from . import conversion
 from . import crawler
+from . import timing
+from . import web
+from .watchdog import watchdog
+from .watchdog import stall_logger
 from . import __version__
+from .__main__ import levior_cache_warmup
 from .__main__ import levior_configure_server
 from .rdf import rdf_graph_init
 
@@ -111,6 +119,36 @@ parser.add_argument(
     '(least-recently-stored, least-recently-used, '
     'least-frequently-used, none)')
 
+parser.add_argument(
+    '--cache-shards',
+    dest='cache_shards',
+    type=int,
+    default=1,
+    help='Number of cache shards (a sharded cache allows concurrent writes)')
+
+parser.add_argument(
+    '--cache-warmup',
+    dest='cache_warmup',
+    type=str,
+    default=None,
+    help='Warm up the cache with the URLs of a file (list of URLs, or '
+    'sitemap), or of the persisted access log ("access-log"), and exit')
+
+parser.add_argument(
+    '--cache-warmup-concurrency',
+    dest='cache_warmup_concurrency',
+    type=int,
+    default=8,
+    help='Maximum number of concurrent requests during a cache warm-up')
+
+parser.add_argument(
+    '--cache-warmup-host-rate',
+    dest='cache_warmup_host_rate',
+    type=float,
+    default=1.0,
+    help='Maximum number of requests per second to a host during a cache '
+    'warm-up (0: no limit)')
+
 parser.add_argument(
     '--persist-access-log',
     dest='persist_access_log',
@@ -260,6 +298,20 @@ async def stop_process(server, graph, sig, loop) -> None:
         # Close the AsyncHTMLSession, this will stop the browser process
         await crawler.rhtml_session.close()
 
+    # Close the pooled HTTP sessions (and their keep-alive connections)
+    await web.close_client_sessions()
+
+    # Stop the conversion workers
+    conversion.shutdown_executor()
+
+    # Stop the cache I/O threads
+    cacheio.shutdown_executor()
+
+    # Write the hit counts of the cache lookups
+    caching.flush_indexes()
+
+    watchdog.stop()
+
     for task in tasks.all_tasks():
         task.cancel()
 
@@ -294,6 +346,20 @@ def run():
         )
         sys.exit(0)
 
+    if cli_cfg.cache_warmup:
+        # Warm up the cache and exit
+        status = loop.run_until_complete(levior_cache_warmup(cli_cfg, graph))
+
+        loop.run_until_complete(web.close_client_sessions())
+        conversion.shutdown_executor()
+        cacheio.shutdown_executor()
+        caching.flush_indexes()
+
+        if graph is not None:
+            graph.close()
+
+        sys.exit(status)
+
     log_formatter = logging.Formatter('%(message)s')
 
     logger = logging.getLogger()
@@ -325,6 +391,23 @@ def run():
             stream_handler.setFormatter(log_formatter)
             logger.addHandler(stream_handler)
 
+        keep_fds: list = [file_handler.stream.fileno()] if \
+            config.daemonize else []
+
+        if config.get('slow_request_log'):
+            # Slow requests are also logged in a separate file
+            slow_handler = logging.FileHandler(config.slow_request_log, 'a')
+            slow_handler.setFormatter(log_formatter)
+            timing.slow_logger.addHandler(slow_handler)
+            keep_fds.append(slow_handler.stream.fileno())
+
+        if config.get('stall_log'):
+            # Diagnostics log of the event loop stalls
+            stall_handler = logging.FileHandler(config.stall_log, 'a')
+            stall_handler.setFormatter(log_formatter)
+            stall_logger.addHandler(stall_handler)
+            keep_fds.append(stall_handler.stream.fileno())
+
         if have_pyppeteer and config.js_render:
             # If pyppeteer is installed and the user wants to
             # render JS code, check that chromium is installed early on
@@ -358,7 +441,7 @@ def run():
                 action=daemon_run,
                 verbose=True,
                 logger=logger,
-                keep_fds=[file_handler.stream.fileno()],
+                keep_fds=keep_fds,
                 auto_close_fds=False
             )
             srvd.start()
@@ -46,7 +46,7 @@ async def feed_fromurl(url: URL,
     connector = get_proxy_connector(proxy_url)
 
     if isinstance(etag, str):
-        headers["ETag"] = etag
+        headers["If-None-Match"] = etag
 
     if isinstance(last_modified, str):
         headers["If-Modified-Since"] = last_modified
@@ -1,14 +1,15 @@
 import asyncio
 import logging
-import re
 import sys
 import traceback
 import os.path
 import io
+import tempfile
+import time
 
 from yarl import URL
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Union, Mapping
 from datetime import datetime
 from rdflib import Literal
 
@@ -19,8 +20,6 @@ from aiogemini.server import _RequestHandler, Request, Response
 import diskcache
 import routes
 
-from md2gemini import md2gemini
-
 from omegaconf import OmegaConf
 from omegaconf import DictConfig
 
@@ -28,15 +27,32 @@ from trimgmi import Document as GmiDocument
 
 from IPy import IP
 
+from . import accesslog
 from . import bytes_to_humanr
 from . import crawler
 from . import feed2gem
 from . import mounts
 from . import caching
+from . import cacheio
+from . import conversion
 from . import __version__
 
 from .filters import run_gemtext_filters
 
+from . import metrics as service_metrics
+from . import timing
+from .accesslog import AccessLog
+from .hottier import hot_tier
+from .metrics import metrics
+from .watchdog import watchdog
+from .prefetch import prefetcher
+from .singleflight import SingleFlight
+from .warmup import WarmupError
+from .stats import cache_stats
+from .rules import URLRule
+from .rules import URLRulesIndex
+
+from .request import local_request
 from .request import log_request
 from .request import get_req_ipaddr
 from .request import ipaddr_allowed
@@ -50,16 +66,51 @@ from .response import redirect_response
 from .response import proxy_reqrefused_response
 from .response import markdownification_error
 from .response import gmidoc_response
+from .response import stream_response
 
 from . import rdf
 
 
 logger = logging.getLogger()
 
+# Coalesce concurrent upstream fetches and page renderings
+fetch_flights = SingleFlight('fetch')
+render_flights = SingleFlight('render')
+
+# Cache keys of the resources being revalidated in the background
+revalidating: set = set()
+
+# Background tasks, referenced until they're done
+background_jobs: set = set()
+
+
+def background_job_done(task: asyncio.Task) -> None:
+    background_jobs.discard(task)
+
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f'Background task failed: {task.exception()!r}')
+
+
+def run_in_background(coro) -> asyncio.Task:
+    """
+    Run a coroutine in a background task. The task is referenced until
+    it's done (so that it can't be garbage-collected while it runs), and
+    its exception, if any, is logged.
+    """
+
+    task = asyncio.ensure_future(coro)
+    background_jobs.add(task)
+    task.add_done_callback(background_job_done)
+    return task
+
+
+def rule_url_config(config: DictConfig,
+                    rule: Optional[URLRule]) -> dict:
+    """
+    Return the url_config for a matching URL rule (or the default
+    url_config if rule is None)
+    """
 
-def get_url_config(config: DictConfig,
-                   rules: list,
-                   url: URL) -> dict:
     url_config = {
         'cache': False,
         'ttl': config.cache_ttl_default,
@@ -68,49 +119,71 @@ def get_url_config(config: DictConfig,
         'proxy_url': None
     }
 
-    for rule in rules:
-        if any(reg.search(str(url)) for reg in rule.regexps):
-            url_config.update(rule.config)
+    if rule is None:
+        return url_config
 
-            # Get the 'proxy' attribute from the rule's context
-            p_url = rule.context.get('proxy')
+    url_config.update(rule.config)
 
-            if p_url:
-                url_config['proxy_url'] = p_url
-            else:
-                # Default
-                url_config['proxy_url'] = config.get('proxy', None)
+    # Get the 'proxy' attribute from the rule's context
+    p_url = rule.context.get('proxy')
 
-            # UA
-            url_config['user_agent'] = rule.context.get(
-                'http_user_agent',
-                config.get('http_user_agent')
-            )
+    if p_url:
+        url_config['proxy_url'] = p_url
+    else:
+        # Default
+        url_config['proxy_url'] = config.get('proxy', None)
 
-            # HTTP headers
-            try:
-                url_config['http_headers'] = dict(rule.context.get(
-                    'http_headers',
-                    config.get('http_headers', {})
-                ))
-            except Exception:
-                pass
+    # UA
+    url_config['user_agent'] = rule.context.get(
+        'http_user_agent',
+        config.get('http_user_agent')
+    )
 
-            # First hit wins
-            break
+    # HTTP headers
+    try:
+        url_config['http_headers'] = dict(rule.context.get(
+            'http_headers',
+            config.get('http_headers', {})
+        ))
+    except Exception:
+        pass
 
     return url_config
 
 
-def urlq(req: Request) -> Optional[str]:
-    return list(req.url.query.keys()).pop(0) if req.url.query else None
+def get_url_config(config: DictConfig,
+                   rules: Union[URLRulesIndex, list],
+                   url: URL) -> dict:
+    """
+    Return the url_config for this URL. The first matching rule
+    (by priority) wins.
+    """
+
+    urls: str = str(url)
 
+    if isinstance(rules, URLRulesIndex):
+        cached = rules.lru_get(urls)
 
-def gemtext_title_extract(gemtext: str) -> str:
-    for line in gemtext.splitlines():
-        ma = re.match(r'^#\s(.*)$', line)
-        if ma:
-            return ma.group(1)
+        if cached:
+            rule, url_config = cached
+        else:
+            rule = rules.match(urls)
+            url_config = rule_url_config(config, rule)
+            rules.lru_put(urls, (rule, url_config))
+    else:
+        rule = next((r for r in rules if any(
+            reg.search(urls) for reg in r.regexps)), None)
+        url_config = rule_url_config(config, rule)
+
+    if rule is not None:
+        rule.match_count += 1
+
+    # Return a copy, the url_config can be modified by the controllers
+    return dict(url_config, http_headers=dict(url_config['http_headers']))
+
+
+def urlq(req: Request) -> Optional[str]:
+    return list(req.url.query.keys()).pop(0) if req.url.query else None
 
 
 def page_prepend_actions(config: DictConfig,
@@ -139,6 +212,489 @@ def page_prepend_actions(config: DictConfig,
     return actions + gemtext
 
 
+async def render_page(config: DictConfig,
+                      url_config: dict,
+                      data: str,
+                      **opts) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Convert an HTML page to gemtext and run the rule's gemtext filters
+    on the document. Returns a (gemtext, title) tuple, the gemtext is None
+    if the markdownification failed.
+
+    :raises asyncio.TimeoutError: if the conversion takes too long
+    """
+
+    gemtext_filters = url_config.get('gemtext_filters', [])
+
+    gemtext, doc_title = await conversion.html2gemtext(
+        config, url_config, data, **opts
+    )
+
+    if gemtext and gemtext_filters:
+        # Construct a GmiDocument with what we received
+        doc = GmiDocument()
+        for line in gemtext.splitlines():
+            doc.append(line)
+
+        # Run the filters on the document
+        with timing.measure('filters'):
+            fdoc = await run_gemtext_filters(
+                doc, OmegaConf.to_container(gemtext_filters)
+            )
+        await asyncio.sleep(0)
+
+        gemtext = '\n'.join(
+            [geml for geml in fdoc.emit_trim_gmi()]
+        )
+
+    return gemtext, doc_title
+
+
+async def coalesced_fetch(url: URL,
+                          config: DictConfig,
+                          url_config: dict,
+                          **kwargs) -> tuple:
+    """
+    Fetch a URL with crawler.fetch. Concurrent fetches of the same URL
+    are coalesced into a single upstream request.
+    """
+
+    key = f'{caching.cache_key_for_url(url)}?{url.query_string}'
+
+    if kwargs.get('etag') or kwargs.get('last_modified'):
+        # Conditional requests are only coalesced with each other
+        key += f'#{kwargs.get("etag")}#{kwargs.get("last_modified")}'
+
+    result, shared = await fetch_flights.run(
+        key, crawler.fetch, url, config, url_config, **kwargs
+    )
+
+    if shared and isinstance(result[3], crawler.StreamedBody):
+        # A streamed body can only be consumed once
+        return await crawler.fetch(url, config, url_config, **kwargs)
+
+    return result
+
+
+def url_cache_ttl(config: DictConfig, url_config: dict) -> int:
+    """
+    Return the cache ttl for the resources matching this url_config
+    """
+
+    try:
+        return int(url_config.get('ttl', config.cache_ttl_default))
+    except (TypeError, ValueError):  # pragma: no cover
+        return config.cache_ttl_default
+
+
+def resource_cache_ttl(config: DictConfig,
+                       url_config: dict,
+                       headers: Optional[Mapping[str, str]] = None
+                       ) -> Optional[int]:
+    """
+    Return the cache ttl for a resource matching this url_config. If the
+    rule's ttl_mode is 'http', the ttl is derived from the HTTP response
+    headers (clamped between ttl_min and ttl_max), and None is returned
+    if the resource must not be cached.
+    """
+
+    ttl = url_cache_ttl(config, url_config)
+    ttl_mode = url_config.get('ttl_mode', config.get('cache_ttl_mode'))
+
+    if ttl_mode != 'http' or headers is None:
+        return ttl
+
+    return caching.http_cache_ttl(
+        headers,
+        default=ttl,
+        ttl_min=url_config.get('ttl_min', config.get('cache_ttl_min', 0)),
+        ttl_max=url_config.get('ttl_max',
+                               config.get('cache_ttl_max', 86400 * 7))
+    )
+
+
+def url_stale_window(url_config: dict, attr: str, default: int = 0) -> int:
+    """
+    Return the stale window (in seconds) set with this url_config
+    attribute (stale_while_revalidate, stale_if_error or
+    revalidate_window)
+    """
+
+    try:
+        return max(int(url_config.get(attr, default)), 0)
+    except (TypeError, ValueError):  # pragma: no cover
+        return 0
+
+
+def url_revalidate_window(config: DictConfig, url_config: dict) -> int:
+    """
+    Return how long (in seconds) expired resources that have validators
+    are kept in the cache to be revalidated with a conditional request
+    """
+
+    return url_stale_window(url_config, 'revalidate_window',
+                            config.get('cache_revalidate_window', 86400))
+
+
+def url_stale_ttl(config: DictConfig,
+                  url_config: dict,
+                  validators: Optional[dict] = None) -> int:
+    """
+    Return how long (in seconds) expired resources matching this url_config
+    are kept in the cache to be served stale (or revalidated, if the
+    resource has validators)
+    """
+
+    windows = [url_stale_window(url_config, 'stale_while_revalidate'),
+               url_stale_window(url_config, 'stale_if_error')]
+
+    if caching.revalidable(validators):
+        windows.append(url_revalidate_window(config, url_config))
+
+    return max(windows)
+
+
+def stale_serve_mode(config: DictConfig,
+                     url_config: dict,
+                     meta: dict) -> Optional[str]:
+    """
+    Return how an expired cached resource can be served: 'revalidate'
+    (served while it's refreshed in the background), 'error' (served only
+    if the resource cannot be fetched), 'validate' (served only if a
+    conditional request says it has not been modified), or None.
+    """
+
+    age = time.time() - meta['fresh_until']
+
+    if age < url_stale_window(url_config, 'stale_while_revalidate'):
+        return 'revalidate'
+    elif age < url_stale_window(url_config, 'stale_if_error'):
+        return 'error'
+    elif caching.revalidable(meta.get('validators')) and \
+            age < url_revalidate_window(config, url_config):
+        return 'validate'
+
+    return None
+
+
+async def fetch_first(try_urls: list,
+                      config: DictConfig,
+                      url_config: dict,
+                      timeout: Optional[float] = None,
+                      **kwargs) -> tuple:
+    """
+    Fetch the URLs in try_urls until one of them can be fetched, and
+    return the fetch result of that URL (or a tuple of Nones).
+
+    :raises crawler.RedirectRequired: if a redirect is required
+    """
+
+    for try_url in try_urls:
+        try:
+            fetched = await asyncio.wait_for(
+                coalesced_fetch(try_url, config, url_config, **kwargs),
+                timeout
+            )
+        except crawler.RedirectRequired:
+            raise
+        except Exception as err:
+            metrics.fetch_error(service_metrics.fetch_error_type(err))
+            logger.debug(f'{try_url}: fetch failed: '
+                         f'{traceback.format_exc()}')
+            continue
+
+        if fetched[0] is not None and fetched[0].status >= 400:
+            metrics.fetch_error(f'http_{fetched[0].status // 100}xx')
+
+        return fetched
+
+    return None, None, None, None
+
+
+def not_modified(resp) -> bool:
+    return resp is not None and resp.status == 304
+
+
+async def revalidate_resource(config: DictConfig,
+                              cache: diskcache.Cache,
+                              url_config: dict,
+                              url: URL,
+                              try_urls: list,
+                              meta: Optional[dict] = None,
+                              **kwargs) -> bool:
+    """
+    Refetch a stale cached resource and store it in the cache. If the
+    cached resource has validators, it's fetched with a conditional
+    request. The stale entry is left untouched if the resource cannot be
+    fetched.
+    """
+
+    cache_key: str = caching.cache_key_for_url(url)
+    data = None
+
+    if cache_key in revalidating:
+        return False
+
+    revalidating.add(cache_key)
+
+    try:
+        resp, rsc_ctype, _, data = await fetch_first(
+            try_urls, config, url_config,
+            timeout=config.get('revalidate_timeout', 30),
+            **kwargs,
+            **caching.conditional_fetch_args(meta)
+        )
+
+        ttl = resource_cache_ttl(config, url_config,
+                                 resp.headers if resp else None)
+
+        if resp and resp.status in [200, 304] and ttl is None:
+            # The resource must not be cached anymore
+            return await cacheio.uncache_resource(cache, url)
+        elif not_modified(resp):
+            return await cacheio.cache_update_expiration(
+                cache, url, ttl=ttl,
+                stale_ttl=url_stale_ttl(config, url_config,
+                                        meta.get('validators')))
+
+        if not resp or not rsc_ctype or resp.status != 200:
+            logger.info(f'{cache_key}: revalidation failed, serving stale')
+            return False
+
+        validators = caching.response_validators(resp.headers)
+        stale_ttl = url_stale_ttl(config, url_config, validators)
+
+        if isinstance(data, crawler.StreamedBody):
+            with tempfile.TemporaryFile() as tmpf:
+                async for chunk in data.iter_chunks():
+                    tmpf.write(chunk)
+
+                tmpf.seek(0, 0)
+                return await cacheio.cache_resource_file(
+                    cache, url, rsc_ctype, tmpf,
+                    ttl=ttl, stale_ttl=stale_ttl, validators=validators)
+
+        return await cacheio.cache_resource(cache, url, rsc_ctype, data,
+                                            ttl=ttl, stale_ttl=stale_ttl,
+                                            validators=validators)
+    except crawler.RedirectRequired:
+        logger.info(f'{cache_key}: redirected, not revalidated')
+        return False
+    except asyncio.CancelledError:
+        raise
+    except Exception:  # pragma: no cover
+        traceback.print_exc()
+        return False
+    finally:
+        if isinstance(data, crawler.StreamedBody):
+            data.release()
+
+        revalidating.discard(cache_key)
+
+
+async def lookup_cached(config: DictConfig,
+                        cache: Optional[diskcache.Cache],
+                        url_config: dict,
+                        url: URL,
+                        try_urls: list,
+                        **kwargs) -> Tuple[Optional[tuple], Optional[tuple]]:
+    """
+    Look for a resource in the cache. Returns a (cached, stale) tuple:
+    cached is the cache entry that can be served, and stale is an
+    expired cache entry that can be revalidated, or served if the fetch
+    fails (see fetch_or_stale()). When the rule allows it, expired entries
+    are served (as cached) while they're revalidated in the background.
+    """
+
+    with timing.measure('cache_lookup'):
+        cached = await cacheio.get_resource(cache, url) if cache else None
+
+    if not cached or not caching.resource_stale(cached[2]):
+        return cached, None
+
+    mode = stale_serve_mode(config, url_config, cached[2])
+
+    if mode == 'revalidate':
+        run_in_background(revalidate_resource(
+            config, cache, url_config, url, try_urls,
+            meta=cached[2], **kwargs))
+
+        return cached, None
+    elif mode in ['error', 'validate']:
+        return None, cached
+
+    release_stale(cached)
+
+    return None, None
+
+
+def cache_outcome(url_config: dict,
+                  cached: Optional[tuple],
+                  resp=None) -> str:
+    """
+    Return the cache outcome of a request (see stats.outcomes), from the
+    cache entry being served (if any) and the upstream response
+    """
+
+    if not cached:
+        return 'miss' if url_config.get('cache') else 'bypass'
+    elif not_modified(resp):
+        return 'revalidated'
+    elif resp is not None or caching.resource_stale(cached[2]):
+        return 'stale'
+
+    return 'hit'
+
+
+def record_cache_outcome(url_config: dict,
+                         url: URL,
+                         cached: Optional[tuple],
+                         resp=None) -> str:
+    outcome = cache_outcome(url_config, cached, resp)
+
+    cache_stats.record_outcome(
+        outcome, url_config, url.host,
+        size=caching.data_size(cached[1]) if cached else 0
+    )
+    return outcome
+
+
+def hot_tier_key(config: DictConfig,
+                 url_config: dict,
+                 url: URL,
+                 proxy_mode: bool = False,
+                 gemini_server_host: Optional[str] = None) -> tuple:
+    return hot_tier.key(
+        caching.cache_key_for_url(url),
+        caching.url_config_fingerprint(
+            config, url_config,
+            proxy_mode=proxy_mode,
+            gemini_server_host=gemini_server_host
+        )
+    )
+
+
+def fresh_until(meta: Optional[dict],
+                is_cached: bool,
+                ttl: Optional[int]) -> Tuple[bool, Optional[float]]:
+    """
+    Return the time until which a resource that is (or was just) cached
+    is fresh, as a (known, fresh_until) tuple (fresh_until is None if the
+    resource never expires)
+    """
+
+    if not is_cached:
+        lifetime = caching.ttl_lifetime(ttl)
+        return True, time.time() + lifetime if lifetime is not None else None
+    elif isinstance(meta, dict) and 'fresh_until' in meta:
+        return True, meta['fresh_until']
+
+    return False, None
+
+
+async def serve_hot(req: Request,
+                    config: DictConfig,
+                    cache: Optional[diskcache.Cache],
+                    url_config: dict,
+                    url: URL,
+                    graph=None,
+                    **fingerprint_opts) -> Optional[Tuple[Response, str]]:
+    """
+    Serve a rendered response from the in-memory hot tier, if it's there.
+    Returns a (response, title) tuple, or None.
+    """
+
+    if not hot_tier.enabled or cache is None or not url_config.get('cache'):
+        return None
+
+    with timing.measure('cache_lookup'):
+        entry = hot_tier.get(hot_tier_key(config, url_config, url,
+                                          **fingerprint_opts))
+
+    if entry is None:
+        return None
+
+    cache_stats.record_outcome('hit', url_config, url.host, size=entry.size)
+    req.cache_outcome = 'hit'
+
+    if graph is not None and entry.source_ctype in crawler.ctypes_html and \
+       config.get('graph_visited_pages', True) is True:
+        asyncio.get_event_loop().call_later(
+            3.0,
+            rdf.graph_resource,
+            graph, entry.body.decode(), req.url,
+            entry.source_ctype,
+            entry.title
+        )
+
+    return await data_response(req, entry.body, entry.ctype), entry.title
+
+
+def release_stale(stale: Optional[tuple]) -> None:
+    if stale and isinstance(stale[1], caching.FileBody):
+        stale[1].release()
+
+
+async def fetch_or_stale(config: DictConfig,
+                         cache: diskcache.Cache,
+                         url_config: dict,
+                         url: URL,
+                         try_urls: list,
+                         stale: Optional[tuple],
+                         **kwargs) -> Tuple[tuple, Optional[tuple]]:
+    """
+    Fetch a resource. If an expired cache entry (stale) is passed, the
+    resource is fetched with a conditional request.
+
+    Returns a (fetched, cached) tuple: fetched is the fetch result, and
+    cached is the stale cache entry if it must be served instead (the
+    resource has not been modified, or it cannot be fetched and the rule
+    allows serving it stale).
+
+    :raises crawler.RedirectRequired: if a redirect is required
+    """
+
+    meta = stale[2] if stale else None
+    on_error: bool = meta is not None and stale_serve_mode(
+        config, url_config, meta) == 'error'
+
+    try:
+        fetched = await fetch_first(
+            try_urls, config, url_config,
+            timeout=config.get('revalidate_timeout', 30) if on_error
+            else None,
+            **kwargs,
+            **caching.conditional_fetch_args(meta)
+        )
+    except crawler.RedirectRequired:
+        release_stale(stale)
+        raise
+
+    resp = fetched[0]
+
+    if stale and not_modified(resp):
+        # Not modified: the cached resource is fresh again
+        ttl = resource_cache_ttl(config, url_config, resp.headers)
+
+        if ttl is None:
+            await cacheio.uncache_resource(cache, url)
+        else:
+            await cacheio.cache_update_expiration(
+                cache, url,
+                ttl=ttl,
+                stale_ttl=url_stale_ttl(config, url_config,
+                                        meta.get('validators'))
+            )
+
+        return fetched, stale
+    elif on_error and (not resp or resp.status >= 500):
+        logger.info(f'{url}: upstream error, serving stale')
+        return fetched, stale
+
+    release_stale(stale)
+    return fetched, None
+
+
 async def build_response(req: Request,
                          config: DictConfig,
                          url_config: dict,
@@ -149,6 +705,9 @@ async def build_response(req: Request,
                          domain: str = None,
                          gemini_server_host: str = None,
                          is_cached: bool = False,
+                         meta: Optional[dict] = None,
+                         rsc_headers: Optional[Mapping[str, str]] = None,
+                         cache_url: Optional[URL] = None,
                          proxy_mode: bool = False,
                          req_path: str = None) -> Tuple[Response, str]:
     """
@@ -161,22 +720,31 @@ async def build_response(req: Request,
     :param str rsc_ctype: Resource content type
     :param bytes data: Resource data as bytes
     :param bool is_cached: Cached status in disk cache for this URL
+    :param dict meta: Metadata of the cache entry for this URL
+    :param rsc_headers: Headers of the HTTP response (cache validators
+        and ttl)
+    :param URL cache_url: URL of the resource in the cache (defaults
+        to the request's URL)
     """
 
-    loop = asyncio.get_event_loop()
-    fdoc: GmiDocument = None
     loop = asyncio.get_event_loop()
     gemtext: str = None
     doc_title: str = None
+    cache_url: URL = cache_url if cache_url else req.url
 
-    url_cache: bool = cache and not is_cached and url_config.get('cache')
+    # An empty diskcache is falsy, compare with None
+    url_cache: bool = cache is not None and not is_cached and \
+        bool(url_config.get('cache'))
     links_mode: str = url_config.get('links_mode', config.links_mode)
-    cache_ttl = None
+    validators = caching.response_validators(rsc_headers) if \
+        rsc_headers is not None else None
+    cache_ttl = resource_cache_ttl(config, url_config, rsc_headers)
+    stale_ttl = url_stale_ttl(config, url_config, validators)
 
-    try:
-        cache_ttl = int(url_config.get('ttl', config.cache_ttl_default))
-    except (TypeError, ValueError):  # pragma: no cover
-        cache_ttl = config.cache_ttl_default
+    if cache_ttl is None:
+        # Uncacheable (unless a cache ttl is set in the query)
+        url_cache = False
+        cache_ttl = url_cache_ttl(config, url_config)
 
     # Look for a cache ttl option in the query
     try:
@@ -194,13 +762,13 @@ async def build_response(req: Request,
     except (AssertionError, TypeError, ValueError):
         pass
 
-    gemtext_filters = url_config.get('gemtext_filters', [])
-
-    if rsc_ctype in ['application/xml',
-                     'application/x-rss+xml',
-                     'application/rss+xml',
-                     'text/xml',
-                     'application/atom+xml']:
+    if isinstance(data, (crawler.StreamedBody, caching.FileBody)):
+        # Large resource: stream it
+        return (await stream_resource(
+            req, cache if url_cache and not is_cached else None,
+            rsc_ctype, data, ttl=cache_ttl, stale_ttl=stale_ttl,
+            validators=validators, cache_url=cache_url), None)
+    elif rsc_ctype in crawler.ctypes_feeds:
         # Atom or RSS feed: return a tinylog if we manage to convert it
 
         tinyl = await loop.run_in_executor(
@@ -217,57 +785,51 @@ async def build_response(req: Request,
     elif rsc_ctype in crawler.ctypes_html:
         # HTML => Markdown => gemtext
 
-        conv = crawler.PageConverter(
-            domain=domain,
-            http_proxy_mode=proxy_mode,
-            url_config=url_config,
-            levior_config=config,
-            autolinks=False,
-            wrap=True,
-            wrap_width=80
-        )
-
-        conv.req_path = req_path if req_path else req.url.path
-
-        if gemini_server_host:
-            conv.gemini_server_host = gemini_server_host
-
-        md = conv.convert(data)
-
-        if not md:
-            return (await markdownification_error(req, req.url), None)
-
-        gemtext = md2gemini(
-            md,
-            links=links_mode if links_mode else 'paragraph',
-            checklist=False,
-            strip_html=True,
-            plain=True
+        rendered = None
+        fingerprint = caching.url_config_fingerprint(
+            config, url_config,
+            proxy_mode=proxy_mode,
+            gemini_server_host=gemini_server_host
         )
+        url_render_cache: bool = cache is not None and bool(
+            is_cached or url_cache)
 
-        if not gemtext:
-            return (await error_response(
-                req,
-                f'Geminification of {req.url} resulted in an empty document'
-            ), None)
-
-        doc_title = gemtext_title_extract(gemtext)
+        if is_cached and url_render_cache:
+            # Look for the rendered gemtext in the cache
+            rendered = await cacheio.get_rendered(cache, cache_url,
+                                                  fingerprint, meta=meta)
 
-        if gemtext_filters:
-            # Construct a GmiDocument with what we received
-            doc = GmiDocument()
-            for line in gemtext.splitlines():
-                doc.append(line)
+        if rendered:
+            gemtext, doc_title = rendered
+        else:
+            try:
+                # Concurrent renderings of this page are coalesced
+                with timing.measure('convert'):
+                    (gemtext, doc_title), _ = await render_flights.run(
+                        f'{fingerprint}:{req.url}',
+                        render_page,
+                        config, url_config, data,
+                        domain=domain,
+                        proxy_mode=proxy_mode,
+                        req_path=req_path if req_path else req.url.path,
+                        gemini_server_host=gemini_server_host,
+                        links_mode=links_mode
+                    )
+            except asyncio.TimeoutError:
+                return (await error_response(
+                    req,
+                    f'Conversion of {req.url} timed out'
+                ), None)
 
-            # Run the filters on the document
-            fdoc = await run_gemtext_filters(
-                doc, OmegaConf.to_container(gemtext_filters)
-            )
-            await asyncio.sleep(0)
+            if gemtext is None:
+                return (await markdownification_error(req, req.url), None)
 
-            gemtext = '\n'.join(
-                [geml for geml in fdoc.emit_trim_gmi()]
-            )
+            if not gemtext:
+                return (await error_response(
+                    req,
+                    f'Geminification of {req.url} resulted in an '
+                    'empty document'
+                ), None)
 
         graph_pages = config.get('graph_visited_pages', True)
 
@@ -281,108 +843,535 @@ async def build_response(req: Request,
                 doc_title
             )
 
-        # Prepend the cache links if this page is not cached
-        if not is_cached and (config.get('page_cachelinks', False) or
-                              config.get('page_cachelinks_show', False)):
-            gemtext = page_prepend_actions(config, gemtext, req.url)
+        if url_cache:
+            await cacheio.cache_resource(cache, cache_url, rsc_ctype, data,
+                                         ttl=cache_ttl, stale_ttl=stale_ttl,
+                                         validators=validators)
+
+        if url_render_cache and not rendered:
+            await cacheio.cache_rendered(cache, cache_url, fingerprint,
+                                         gemtext, doc_title)
+
+        if url_render_cache and hot_tier.enabled:
+            known, expires = fresh_until(meta, is_cached, cache_ttl)
+
+            if known:
+                hot_tier.put(
+                    hot_tier.key(caching.cache_key_for_url(cache_url),
+                                 fingerprint),
+                    'text/gemini', gemtext.encode(), doc_title,
+                    expires=expires,
+                    source_ctype=rsc_ctype
+                )
+
+        if prefetcher.enabled:
+            # Prefetch the links of the page (if the rule has a policy)
+            prefetcher.schedule(req, url_config, gemtext)
+
+        # Prepend the cache links if this page is not cached
+        if not is_cached and (config.get('page_cachelinks', False) or
+                              config.get('page_cachelinks_show', False)):
+            gemtext = page_prepend_actions(config, gemtext, req.url)
+
+        return (await data_response(req, gemtext.encode(), 'text/gemini'),
+                doc_title)
+    else:
+        if data:
+            if not is_cached and url_cache:
+                await cacheio.cache_resource(
+                    cache, cache_url, rsc_ctype, data,
+                    ttl=cache_ttl, stale_ttl=stale_ttl,
+                    validators=validators)
+
+            if (is_cached or url_cache) and hot_tier.enabled and \
+               isinstance(data, bytes):
+                known, expires = fresh_until(meta, is_cached, cache_ttl)
+
+                if known:
+                    hot_tier.put(
+                        hot_tier_key(config, url_config, cache_url,
+                                     proxy_mode=proxy_mode,
+                                     gemini_server_host=gemini_server_host),
+                        rsc_ctype, data, expires=expires)
+
+            return (await data_response(req, data, rsc_ctype),
+                    doc_title)
+        else:
+            return (await error_response(req, 'Empty page'), None)
+
+
+async def stream_resource(req: Request,
+                          cache: Optional[diskcache.Cache],
+                          rsc_ctype: str,
+                          body,
+                          ttl: Optional[int] = None,
+                          stale_ttl: Optional[int] = None,
+                          validators: Optional[dict] = None,
+                          cache_url: Optional[URL] = None) -> Response:
+    """
+    Stream a resource's body to the client. If a cache is passed, the
+    body is also written to a temporary file, which is stored in the
+    cache once the transfer is complete.
+    """
+
+    tee = tempfile.TemporaryFile() if cache is not None else None
+
+    try:
+        resp = await stream_response(req, body.iter_chunks(), rsc_ctype,
+                                     tee=tee)
+
+        if tee is not None:
+            tee.seek(0, 0)
+            await cacheio.cache_resource_file(
+                cache, cache_url if cache_url else req.url, rsc_ctype, tee,
+                ttl=ttl, stale_ttl=stale_ttl, validators=validators)
+
+        return resp
+    finally:
+        body.release()
+
+        if tee is not None:
+            tee.close()
+
+
+def cache_listing_filters(query) -> dict:
+    """
+    Return the cache listing filters (host, ctype, min_size, max_size)
+    passed in the query of a /cache request
+    """
+
+    filters: dict = {}
+
+    for key in ['host', 'ctype']:
+        if query.get(key):
+            filters[key] = query[key]
+
+    for key in ['min_size', 'max_size']:
+        try:
+            filters[key] = int(query[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    return filters
+
+
+async def build_cache_listing(req: Request,
+                              config: DictConfig,
+                              cache: diskcache.Cache) -> Response:
+    """
+    List the entries in the cache, one page at a time, and show the
+    content's URL and its expiration time for each entry. The entries
+    are read from the cache's metadata index, and can be filtered by
+    host, content type and size with the query
+    (e.g: /cache?host=example.org&ctype=image&min_size=1024&page=2).
+    """
+
+    filters = cache_listing_filters(req.url.query)
+    page_size: int = config.get('cache_listing_page_size', 50)
+
+    try:
+        page = max(int(req.url.query.get('page', 1)), 1)
+    except (TypeError, ValueError):
+        page = 1
+
+    def list_entries() -> tuple:
+        # Runs in the cache I/O executor: the index is built (from all
+        # the cache entries) on first use
+        index = caching.cache_index(cache)
+        entries, evicted = [], []
+
+        # Write the hit counts
+        caching.flush_index(cache)
+
+        for entry in index.query(offset=(page - 1) * page_size,
+                                 limit=page_size,
+                                 **filters):
+            if entry['key'] in cache:
+                entries.append(entry)
+            else:
+                # Evicted from the cache
+                index.remove(entry['key'])
+                evicted.append(entry)
+
+        return (index.count(**filters), entries, evicted,
+                cache.volume(), caching.cache_size_limit(cache))
+
+    total, entries, evicted, volume, limit = await cacheio.run(
+        'cache_listing', list_entries)
+
+    for entry in evicted:
+        cache_stats.record_eviction(entry['host'])
+
+    gemtext: str = f'Cache size: {bytes_to_humanr(volume)} '
+    gemtext += f'(limit: {bytes_to_humanr(limit)})\n'
+    gemtext += f'# Cache entries ({total})\n'
+
+    if filters:
+        gemtext += 'Filters: ' + ', '.join(
+            f'{key}: {val}' for key, val in filters.items()) + '\n'
+
+    for entry in entries:
+        exp_dt = datetime.fromtimestamp(entry['expires']) if \
+            entry['expires'] else None
+
+        gemtext += f'=> {entry["url"]}  {entry["url"]} ('
+        gemtext += f'{entry["ctype"]}, {bytes_to_humanr(entry["size"])}, '
+        gemtext += f'hits: {entry["hits"]}, '
+
+        if exp_dt:
+            gemtext += f'expires: {exp_dt})\n'
+        else:
+            gemtext += 'no expiration date)\n'
+
+    if page > 1:
+        gemtext += f'=> {req.url.update_query(page=page - 1)}  ' \
+            'Previous page\n'
+
+    if page * page_size < total:
+        gemtext += f'=> {req.url.update_query(page=page + 1)}  Next page\n'
+
+    return await data_response(req, gemtext.encode(), 'text/gemini')
+
+
+def access_log_filters(query) -> dict:
+    """
+    Return the access log filters (host, status, since, until) passed in
+    the query of an /access_log request. The status is a full status
+    code, or a status class (e.g: 5 for all the 5x statuses), and the
+    dates are ISO 8601 dates or UNIX timestamps.
+    """
+
+    filters: dict = {}
+
+    if query.get('host'):
+        filters['host'] = query['host']
+
+    try:
+        filters['status'] = int(query['status'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    for key in ['since', 'until']:
+        if not query.get(key):
+            continue
+
+        try:
+            filters[key] = float(query[key])
+        except ValueError:
+            try:
+                filters[key] = datetime.fromisoformat(
+                    query[key]).timestamp()
+            except ValueError:
+                continue
+
+    return filters
+
+
+async def build_access_log_listing(req: Request,
+                                   config: DictConfig,
+                                   cache: Optional[diskcache.Cache],
+                                   access_log: AccessLog) -> Response:
+    """
+    List the requests in the access log, most recent first, one page at
+    a time. The requests can be filtered by host, status and date with
+    the query (e.g: /access_log?host=example.org&status=5&page=2).
+
+    When the access log is persisted, the requests are read from the
+    access log database (the last few seconds of requests are not there
+    yet), otherwise from the in-memory access log.
+    """
+
+    filters = access_log_filters(req.url.query)
+    page_size: int = config.get('access_log_page_size', 50)
+
+    try:
+        page = max(int(req.url.query.get('page', 1)), 1)
+    except (TypeError, ValueError):
+        page = 1
+
+    def list_records(source) -> tuple:
+        return source.count(**filters), source.query(
+            offset=(page - 1) * page_size, limit=page_size, **filters)
+
+    if cache is not None and config.get('persist_access_log', False):
+        # The database is filled from the segments on first use: read it
+        # in the cache I/O executor
+        total, records = await cacheio.run(
+            'access_log_listing',
+            lambda: list_records(accesslog.access_log_db(cache)))
+    else:
+        total, records = list_records(access_log)
+
+    gemtext: str = f'# Access log ({total})\n'
+
+    if filters:
+        gemtext += 'Filters: ' + ', '.join(
+            f'{key}: {val}' for key, val in filters.items()) + '\n'
+
+    for record in records:
+        gemtext += record.gemtext() + '\n'
+
+    if page > 1:
+        gemtext += f'=> {req.url.update_query(page=page - 1)}  ' \
+            'Previous page\n'
+
+    if page * page_size < total:
+        gemtext += f'=> {req.url.update_query(page=page + 1)}  Next page\n'
+
+    return await data_response(req, gemtext.encode(), 'text/gemini')
+
+
+def stats_counters_gmi(counters: dict, stores: bool = True) -> str:
+    ratio = counters['hit_ratio']
+    latency = counters['store_latency']
+
+    gemtext: str = f'* Hit ratio: {ratio:.1%}\n' if ratio is not None \
+        else '* Hit ratio: n/a\n'
+    gemtext += f'* Hits: {counters["hits"]}, '
+    gemtext += f'stale: {counters["stale"]}, '
+    gemtext += f'revalidated: {counters["revalidated"]}, '
+    gemtext += f'misses: {counters["misses"]}, '
+    gemtext += f'not cacheable: {counters["bypass"]}\n'
+    gemtext += f'* Bytes saved: {bytes_to_humanr(counters["bytes_saved"])}\n'
+
+    if not stores:
+        # Stores and evictions are not counted by rule
+        return gemtext
+
+    gemtext += f'* Stores: {counters["stores"]} '
+    gemtext += f'({bytes_to_humanr(counters["bytes_stored"])}'
+
+    if latency is not None:
+        gemtext += f', average latency: {latency * 1000:.2f} ms'
+
+    gemtext += ')\n'
+
+    if counters['deduped']:
+        gemtext += f'* Deduplicated stores: {counters["deduped"]} '
+        gemtext += f'({bytes_to_humanr(counters["bytes_deduped"])})\n'
+
+    gemtext += f'* Evictions: {counters["evictions"]}\n'
+    return gemtext
+
+
+def hot_tier_prometheus(prefix: str = 'levior_cache_memory') -> str:
+    hot = hot_tier.as_dict()
+    lines: list = []
+
+    for key in ['hits', 'misses', 'evictions', 'expirations',
+                'invalidations']:
+        lines.append(f'# TYPE {prefix}_{key}_total counter')
+        lines.append(f'{prefix}_{key}_total {hot[key]}')
+
+    for key in ['entries', 'size']:
+        lines.append(f'# TYPE {prefix}_{key} gauge')
+        lines.append(f'{prefix}_{key} {hot[key]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def flights_dict() -> dict:
+    """
+    Counters of the coalesced upstream fetches and page conversions
+    """
+
+    return {flight.name: dict(flight.stats, in_flight=len(flight))
+            for flight in [fetch_flights, render_flights]}
+
+
+def flights_prometheus(prefix: str = 'levior') -> str:
+    lines: list = []
+    flights = flights_dict()
+
+    for key, name, mtype in [
+            ('leaders', 'leader_requests_total', 'counter'),
+            ('coalesced', 'coalesced_requests_total', 'counter'),
+            ('in_flight', 'flights_in_progress', 'gauge')]:
+        lines.append(f'# TYPE {prefix}_{name} {mtype}')
+
+        for flight, counters in flights.items():
+            lines.append(f'{prefix}_{name}{{flight="{flight}"}} '
+                         f'{counters[key]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_prometheus() -> str:
+    """
+    Dump the service metrics and the cache statistics in the Prometheus
+    text exposition format
+    """
+
+    dump: str = metrics.to_prometheus() + cache_stats.to_prometheus() + \
+        cacheio.latencies_prometheus() + hot_tier_prometheus() + \
+        flights_prometheus()
+
+    if watchdog.enabled:
+        dump += '# TYPE levior_event_loop_stalls_total counter\n'
+        dump += f'levior_event_loop_stalls_total {watchdog.count}\n'
+
+    return dump
+
+
+def build_stats_page(cache: Optional[diskcache.Cache],
+                     max_hosts: int = 50) -> str:
+    """
+    Render the cache statistics as gemtext: totals, then by rule and by
+    host (the hosts with the most requests first)
+    """
+
+    stats = cache_stats.as_dict()
+
+    gemtext: str = '# Cache statistics\n'
+
+    if cache is not None:
+        gemtext += f'Cache size: {bytes_to_humanr(cache.volume())}\n'
+
+    gemtext += '=> /stats/json  JSON\n'
+    gemtext += '=> /stats/prometheus  Prometheus\n'
+    gemtext += '## Total\n'
+    gemtext += stats_counters_gmi(stats['total'])
+
+    if hot_tier.enabled:
+        hot = hot_tier.as_dict()
+
+        gemtext += '## Memory tier\n'
+        gemtext += f'* Hit ratio: {hot["hit_ratio"]:.1%}\n' if \
+            hot['hit_ratio'] is not None else '* Hit ratio: n/a\n'
+        gemtext += f'* Entries: {hot["entries"]} '
+        gemtext += f'({bytes_to_humanr(hot["size"])} of '
+        gemtext += f'{bytes_to_humanr(hot["max_bytes"])})\n'
+        gemtext += f'* Hits: {hot["hits"]}, misses: {hot["misses"]}, '
+        gemtext += f'evictions: {hot["evictions"]}, '
+        gemtext += f'expirations: {hot["expirations"]}, '
+        gemtext += f'invalidations: {hot["invalidations"]}\n'
+
+    if prefetcher.stats['queued']:
+        pstats = prefetcher.as_dict()
+
+        gemtext += '## Prefetching\n'
+        gemtext += f'* Links queued: {pstats["queued"]}, '
+        gemtext += f'prefetched: {pstats["prefetched"]}, '
+        gemtext += f'already cached: {pstats["cached"]}, '
+        gemtext += f'failed: {pstats["failed"]}, '
+        gemtext += f'dropped: {pstats["dropped"]}\n'
+        gemtext += f'* Downloaded: {bytes_to_humanr(pstats["bytes"])}\n'
+
+    flights = flights_dict()
+
+    if any(counters['coalesced'] for counters in flights.values()):
+        gemtext += '## Request coalescing\n'
+
+        for flight, counters in flights.items():
+            gemtext += f'* {flight}: {counters["leaders"]} leaders, '
+            gemtext += f'{counters["coalesced"]} coalesced requests\n'
+
+    def requests(counters: dict) -> int:
+        return sum(counters[key] for key in [
+            'hits', 'stale', 'revalidated', 'misses', 'bypass'])
+
+    for scope, title, limit in [('rules', 'By rule', None),
+                                ('hosts', 'By host', max_hosts)]:
+        if not stats[scope]:
+            continue
+
+        gemtext += f'## {title}\n'
+
+        for label, counters in sorted(stats[scope].items(),
+                                      key=lambda item: requests(item[1]),
+                                      reverse=True)[:limit]:
+            gemtext += f'### {label}\n'
+            gemtext += stats_counters_gmi(counters,
+                                          stores=scope == 'hosts')
+
+    if cacheio.latencies:
+        gemtext += '## Cache I/O latency\n'
 
-        if url_cache:
-            caching.cache_resource(cache, req.url, rsc_ctype, data,
-                                   ttl=cache_ttl)
+    for op, hist in sorted(cacheio.latencies.items()):
+        gemtext += f'* {op}: {hist.count} operations, '
+        gemtext += f'mean: {hist.mean * 1000:.2f} ms, '
+        gemtext += f'p99 < {hist.quantile(0.99) * 1000:g} ms\n'
 
-        return (await data_response(req, gemtext.encode(), 'text/gemini'),
-                doc_title)
-    else:
-        if data:
-            if not is_cached and url_cache:
-                caching.cache_resource(cache, req.url, rsc_ctype, data,
-                                       ttl=cache_ttl)
+    return gemtext
 
-            return (await data_response(req, data, rsc_ctype),
-                    doc_title)
-        else:
-            return (await error_response(req, 'Empty page'), None)
 
+# Last fetch status and duration of every feed, by feed URL
+feeds_fetch_stats: dict = {}
 
-async def build_cache_listing(req: Request,
-                              config: DictConfig,
-                              cache: diskcache.Cache) -> Response:
-    """
-    List all the entries in the cache and show the content's URL
-    and its expiration time for each entry.
-    """
+# Rule types for feeds aggregators
+feeds_aggregator_types: list = ['feed_aggregator', 'feeds_aggregator']
 
-    gemtext: str = f'Cache size: {bytes_to_humanr(cache.volume())} '
-    gemtext += f'(limit: {bytes_to_humanr(cache.size_limit)})\n'
-    gemtext += '# Cache entries\n'
 
-    for key in list(cache.iterkeys()):
-        try:
-            exp_dt, url = None, URL(key)
-            assert url.scheme
+def feed_cache_key(feed_url: str) -> str:
+    return f'feedc_{feed_url}'
 
-            entry, expires = cache.get(key, expire_time=True)
 
-            if expires:
-                exp_dt = datetime.fromtimestamp(expires)
+def feeds_tinylog_key(url_config: dict) -> str:
+    """
+    Cache key of the pre-rendered tinylog of a feeds aggregator
+    """
+    return f'feedsagg_{url_config.get("route")}'
 
-            gemtext += f'=> {url}  {url} '
 
-            if exp_dt:
-                gemtext += f'(expires: {exp_dt})\n'
-            else:
-                gemtext += '(no expiration date)\n'
-        except BaseException:  # pragma: no cover
-            continue
+def cached_feed(cache: diskcache.Cache,
+                feed_url: str,
+                feed_config: DictConfig):
+    """
+    Return the cached feed for this feed URL, or None
+    """
 
-    return await data_response(req, gemtext.encode(), 'text/gemini')
+    cached = cache.get(feed_cache_key(feed_url))
 
+    if cached and 'feed' in cached:
+        feed = cached['feed']
+        feed.feed_config = feed_config
+        return feed
 
-async def feeds_aggregate(req: Request,
-                          config: DictConfig,
-                          cache: diskcache.Cache,
-                          url_config: dict,
-                          gemini_server_host: str = None) -> Response:
-    feed_only_idx: int
-    gemtext: str = None
-    feeds: list = []
 
-    feeds_config = url_config.get('feeds')
-    sort_mode = url_config.get('sort_mode', 'date')
+async def feed_fetch(cache: diskcache.Cache,
+                     feed_url: str,
+                     feed_config: DictConfig,
+                     url_config: dict,
+                     semaphore: Optional[asyncio.Semaphore] = None,
+                     min_age: Optional[float] = None):
+    """
+    Fetch a feed and cache it. If the feed has not been modified, or if
+    the request times out, the cached feed is returned. The fetch status
+    and duration are recorded in feeds_fetch_stats.
 
-    try:
-        # If an integer is passed in the query, only the feed
-        # corresponding to this index will be shown
-        feed_only_idx: int = int(list(req.url.query.keys()).pop(0)) if \
-            req.url.query else -1
-    except (ValueError, TypeError):  # pragma: no cover
-        feed_only_idx = -1
+    If min_age is set, the cached feed is returned without fetching the
+    feed if it was fetched less than min_age seconds ago.
+    """
 
-    for feed_idx, (feed_url, feed_config) in enumerate(feeds_config.items()):
-        # Skip this feed if it doesn't match the requested feed index
-        if feed_only_idx >= 0 and feed_idx != feed_only_idx:
-            continue
+    loop = asyncio.get_event_loop()
+    feed, status = None, 'error'
+    semaphore = semaphore if semaphore else asyncio.Semaphore()
 
-        # Skip this feed if it's disabled
-        if feed_config.get('enabled', True) is False:
-            continue
+    # Feed cache expire (in seconds)
+    cache_expire_time: int = feed_config.get('expire_time',
+                                             3600 * 24 * 3)
 
-        feed = None
+    # Cache vars
+    cache_key = feed_cache_key(feed_url)
+    cached_etag, cached_lastm = None, None
+    async with semaphore:
+        # Read the cache with the semaphore held, so that the feeds are
+        # fetched in order
+        cached = await cacheio.get_value(cache, cache_key)
+
+        if cached:
+            cached_etag = cached.get('etag')
+            cached_lastm = cached.get('last-modified')
 
-        # Feed cache expire (in seconds)
-        cache_expire_time: int = feed_config.get('expire_time',
-                                                 3600 * 24 * 3)
+            if min_age and 'feed' in cached and \
+               time.time() - cached.get('date', 0) < min_age:
+                feed = cached['feed']
+                feed.feed_config = feed_config
+                return feed
 
-        # Cache vars
-        cache_key = f'feedc_{feed_url}'
-        cached_etag, cached_lastm = None, None
-        cached = cache.get(cache_key)
+        started = loop.time()
 
         try:
-            if cached:
-                cached_etag = cached.get('etag')
-                cached_lastm = cached.get('last-modified')
-
             resp, data, feed, etag, lastm = await feed2gem.feed_fromurl(
                 URL(feed_url),
                 etag=cached_etag,
@@ -401,31 +1390,150 @@ async def feeds_aggregate(req: Request,
                     # so that we can serialize the feed object
                     del feed['bozo_exception']
 
-                with cache.transact():
-                    cache.set(cache_key, {
-                        'etag': etag,
-                        'last-modified': lastm,
-                        'feed': feed
-                    }, expire=cache_expire_time)
+                await cacheio.set_value(cache, cache_key, {
+                    'etag': etag,
+                    'last-modified': lastm,
+                    'date': time.time(),
+                    'feed': feed
+                }, expire=cache_expire_time, retry=True)
 
                 feed.feed_config = feed_config
-                feeds.append(feed)
+                status = 'fetched'
+            else:
+                feed, status = None, 'empty'
         except (feed2gem.FeedNotModified,
-                asyncio.CancelledError,
-                asyncio.TimeoutError):
+                asyncio.TimeoutError) as err:
             """
             Not modified, or timeout.
             If the feed had been cached, serve that.
             """
 
-            if cached and 'feed' in cached:
-                feed = cached['feed']
-                feed.feed_config = feed_config
-                feeds.append(feed)
+            status = 'not-modified' if isinstance(
+                err, feed2gem.FeedNotModified) else 'timeout'
+            feed = await cacheio.run('get', cached_feed,
+                                     cache, feed_url, feed_config)
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        except Exception:  # pragma: no cover
+            traceback.print_exc()
+        finally:
+            duration = loop.time() - started
+            feeds_fetch_stats[feed_url] = {
+                'status': status,
+                'duration': duration,
+                'date': datetime.now()
+            }
+
+            logger.debug(f'Feed {feed_url}: {status} '
+                         f'({round(duration * 1000)} msecs)')
 
+    return feed
+
+
+async def aggregate_feeds(config: DictConfig,
+                          cache: diskcache.Cache,
+                          url_config: dict,
+                          feed_only_idx: int = -1,
+                          refresh_interval: Optional[float] = None) -> list:
+    """
+    Fetch the feeds of a feeds aggregator rule and return them. The
+    feeds are fetched concurrently (feeds_concurrency), and the cached
+    version of the feeds that are not fetched before the deadline
+    (feeds_aggregate_timeout) is used.
+
+    :param int feed_only_idx: Only fetch the feed with this index
+    :param float refresh_interval: Don't refetch feeds fetched less than
+        this number of seconds ago (can be set per feed)
+    """
+
+    feeds: list = []
+    tasks: dict = {}
+
+    feeds_config = url_config.get('feeds')
+
+    semaphore = asyncio.Semaphore(url_config.get(
+        'feeds_concurrency', config.get('feeds_concurrency', 8)))
+    deadline = url_config.get(
+        'aggregate_timeout', config.get('feeds_aggregate_timeout', 20))
+
+    for feed_idx, (feed_url, feed_config) in enumerate(feeds_config.items()):
+        # Skip this feed if it doesn't match the requested feed index
+        if feed_only_idx >= 0 and feed_idx != feed_only_idx:
             continue
-        except BaseException:  # pragma: no cover
-            traceback.print_exc()
+
+        # Skip this feed if it's disabled
+        if feed_config.get('enabled', True) is False:
+            continue
+
+        tasks[feed_url] = asyncio.ensure_future(feed_fetch(
+            cache, feed_url, feed_config, url_config,
+            semaphore=semaphore,
+            min_age=feed_config.get('refresh_interval', refresh_interval)
+            if refresh_interval else None
+        ))
+
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    else:
+        pending = set()
+
+    for feed_url, task in tasks.items():
+        if task in pending:
+            # Missed the deadline: use the cached feed
+            task.cancel()
+            feed = await cacheio.run('get', cached_feed,
+                                     cache, feed_url, feeds_config[feed_url])
+        elif task.exception() is None:
+            feed = task.result()
+        else:  # pragma: no cover
+            feed = None
+
+        if feed:
+            feeds.append(feed)
+
+    return feeds
+
+
+def cache_feeds_tinylog(cache: diskcache.Cache,
+                        url_config: dict,
+                        gemtext: str,
+                        expire: Optional[float] = None) -> bool:
+    """
+    Store the pre-rendered tinylog of a feeds aggregator
+    """
+    return cache.set(feeds_tinylog_key(url_config), gemtext,
+                     expire=expire, retry=True)
+
+
+async def feeds_aggregate(req: Request,
+                          config: DictConfig,
+                          cache: diskcache.Cache,
+                          url_config: dict,
+                          gemini_server_host: str = None) -> Response:
+    feed_only_idx: int
+    gemtext: str = None
+
+    sort_mode = url_config.get('sort_mode', 'date')
+
+    try:
+        # If an integer is passed in the query, only the feed
+        # corresponding to this index will be shown
+        feed_only_idx: int = int(list(req.url.query.keys()).pop(0)) if \
+            req.url.query else -1
+    except (ValueError, TypeError):  # pragma: no cover
+        feed_only_idx = -1
+
+    if feed_only_idx < 0 and config.get('feeds_background_refresh', False):
+        # Serve the tinylog pre-rendered by the feeds refresher
+        gemtext = await cacheio.get_value(cache,
+                                          feeds_tinylog_key(url_config))
+
+        if gemtext:
+            return await data_response(req, gemtext.encode(), 'text/gemini')
+
+    feeds = await aggregate_feeds(config, cache, url_config,
+                                  feed_only_idx=feed_only_idx)
 
     try:
         assert len(feeds) > 0
@@ -438,6 +1546,117 @@ async def feeds_aggregate(req: Request,
         return await error_response(req, 'Failed to aggregate feeds')
 
 
+async def feeds_refresh_task(config: DictConfig,
+                             cache: diskcache.Cache,
+                             rules) -> None:
+    """
+    Periodically refresh the feeds of every feeds aggregator rule, and
+    pre-render their tinylog, so that requests to the aggregators are
+    served from the cache.
+    """
+
+    interval = config.get('feeds_refresh_interval', 1800)
+
+    while True:
+        for rule in rules:
+            if rule.config.get('type') not in feeds_aggregator_types or \
+               not isinstance(rule.config.get('route'), str):
+                continue
+
+            url_config = rule_url_config(config, rule)
+
+            try:
+                feeds = await aggregate_feeds(config, cache, url_config,
+                                              refresh_interval=interval)
+
+                if feeds:
+                    await cacheio.run(
+                        'set', cache_feeds_tinylog,
+                        cache, url_config,
+                        feed2gem.feeds2tinylog(
+                            feeds,
+                            sort_mode=url_config.get('sort_mode', 'date')
+                        ),
+                        expire=interval * 2
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pragma: no cover
+                traceback.print_exc()
+
+        await asyncio.sleep(interval)
+
+
+async def content_gc_task(config: DictConfig,
+                          cache: diskcache.Cache) -> None:
+    """
+    Periodically remove the content entries (deduplicated bodies) that are
+    not referenced anymore
+    """
+
+    interval = config.get('cache_dedup_gc_interval', 3600)
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await cacheio.run('gc', caching.gc_contents, cache)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # pragma: no cover
+            traceback.print_exc()
+
+
+async def cache_index_flush_task(config: DictConfig,
+                                 cache: diskcache.Cache) -> None:
+    """
+    Periodically write the hits and misses of the cache lookups to the
+    cache's metadata index
+    """
+
+    interval = config.get('cache_index_flush_interval', 30)
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await cacheio.run('index_flush', caching.flush_index, cache)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # pragma: no cover
+            traceback.print_exc()
+
+
+def warmup_fetcher(request_handler: _RequestHandler,
+                   max_redirects: int = 5):
+    """
+    Return a cache warm-up fetcher (see warmup.warm_cache()) sending
+    local requests to a levior request handler: the resources are
+    fetched, rendered and cached as when a client requests them.
+    """
+
+    async def fetch(url: URL) -> int:
+        for _ in range(max_redirects + 1):
+            req = local_request(url)
+            resp = await request_handler(req)
+
+            if resp.status in [Status.REDIRECT_TEMPORARY,
+                               Status.REDIRECT_PERMANENT] and resp.reason:
+                url = URL(resp.reason)
+                continue
+            elif resp.status != Status.SUCCESS:
+                raise WarmupError(
+                    f'{resp.status.name}: {resp.reason}' if resp.reason
+                    else resp.status.name
+                )
+
+            return req.transport.size
+
+        raise WarmupError('Too many redirects')
+
+    return fetch
+
+
 def server_geminize_url(config: DictConfig, url: URL) -> str:
     if url.scheme == 'gemini':  # pragma: no cover
         return url
@@ -501,7 +1720,14 @@ async def rcontroller_root(route,
     if config.get('access_log_endpoint', False) is True:
         doc.append('=> /access_log  Access log')
 
+    if config.get('metrics_endpoint', False) is True:
+        doc.append('=> /metrics  Metrics')
+
+    if config.get('stall_watchdog', False) is True:
+        doc.append('=> /debug/stalls  Event loop stalls')
+
     doc.append('=> /cache  Cache')
+    doc.append('=> /stats  Cache statistics')
     doc.append('=> /search Web Search')
 
     if graph is not None:
@@ -542,18 +1768,87 @@ async def rcontroller_cache(route,
     return await build_cache_listing(req, config, cache)
 
 
+async def rcontroller_stats(route,
+                            req: Request,
+                            config: DictConfig,
+                            cache: diskcache.Cache,
+                            **kwargs) -> Response:
+    """
+    Cache statistics, as gemtext, JSON (/stats/json) or in the
+    Prometheus text format (/stats/prometheus)
+    """
+
+    fmt = route.get('format')
+
+    if fmt == 'json':
+        extra: dict = {
+            'cache_io': cacheio.latencies_dict(),
+            'hot_tier': hot_tier.as_dict(),
+            'prefetch': prefetcher.as_dict(),
+            'coalescing': flights_dict(),
+            'metrics': metrics.as_dict()
+        }
+
+        if cache is not None:
+            extra['volume'] = cache.volume()
+            extra['diskcache'] = dict(zip(('hits', 'misses'),
+                                          cache.stats()))
+
+        return await data_response(req, cache_stats.to_json(**extra).encode(),
+                                   'application/json')
+    elif fmt == 'prometheus':
+        return await data_response(
+            req,
+            (cache_stats.to_prometheus() +
+             cacheio.latencies_prometheus() +
+             hot_tier_prometheus() +
+             flights_prometheus()).encode(),
+            'text/plain; version=0.0.4'
+        )
+
+    return await data_response(req, build_stats_page(cache).encode(),
+                               'text/gemini')
+
+
+async def rcontroller_metrics(route,
+                              req: Request,
+                              config: DictConfig,
+                              cache: diskcache.Cache,
+                              **kwargs) -> Response:
+    """
+    Service metrics, in the Prometheus text format
+    """
+
+    return await data_response(req, metrics_prometheus().encode(),
+                               service_metrics.prometheus_ctype)
+
+
+async def rcontroller_stalls(route,
+                             req: Request,
+                             config: DictConfig,
+                             cache: diskcache.Cache,
+                             **kwargs) -> Response:
+    """
+    The last event loop stalls detected by the watchdog (most recent
+    first), with the stack of the blocking call
+    """
+
+    gemtext: str = f'# Event loop stalls ({watchdog.count})\n'
+    gemtext += f'Threshold: {watchdog.threshold * 1000:.0f} ms\n'
+
+    for stall in reversed(list(watchdog.stalls)):
+        gemtext += stall.gemtext()
+
+    return await data_response(req, gemtext.encode(), 'text/gemini')
+
+
 async def rcontroller_access_log(route,
                                  req: Request,
                                  config: DictConfig,
                                  cache: diskcache.Cache,
                                  **kwargs) -> Response:
-    access_log_doc = kwargs.pop('access_log_doc')
-
-    data = '# Access log\n'
-    data += '\n'.join(
-        reversed([gmi for gmi in access_log_doc.emit_trim_gmi()]))
-    data += f'\n{datetime.utcnow()}'
-    return await data_response(req, data.encode())
+    return await build_access_log_listing(req, config, cache,
+                                          kwargs.pop('access_log_doc'))
 
 
 async def rcontroller_domain_prompt(route,
@@ -637,44 +1932,54 @@ async def rcontroller_domain(route,
     )
     url_http = url.with_scheme('http')
 
-    resp, rsc_ctype, rsc_clength, data = None, None, None, None
-    cached = cache.get(caching.cache_key_for_url(url)) if cache else None
+    resp, rsc_ctype, rsc_clength, data, meta = None, None, None, None, None
+    try_urls = [url] if config.get('https_only', False) else [
+        url, url_http]
+    fetch_opts: dict = {
+        'proxy_url': url_config['proxy_url'],
+        'user_agent': url_config['user_agent'],
+        'verify_ssl': config.verify_ssl
+    }
 
-    if cached:
-        rsc_ctype, data, _ = cached
-    else:
-        try_urls = [url] if config.get('https_only', False) else [
-            url, url_http]
+    hot = await serve_hot(req, config, cache, url_config, url,
+                          graph=kwargs.get('graph'),
+                          gemini_server_host=config.hostname)
 
-        for try_url in try_urls:
-            try:
-                resp, rsc_ctype, rsc_clength, data = await crawler.fetch(
-                    try_url,
-                    config,
-                    url_config,
-                    proxy_url=url_config['proxy_url'],
-                    user_agent=url_config['user_agent'],
-                    verify_ssl=config.verify_ssl
-                )
-            except crawler.RedirectRequired as redirect:
-                return await redirect_response(
-                    req,
-                    server_geminize_url(config, redirect.url)
-                )
-            except Exception:
-                continue
-            else:
-                break
+    if hot:
+        log_request(access_log_doc, req, datetime.now(), hot[0], url_config,
+                    title=hot[1], url=url)
+        return hot[0]
 
-        if not resp:
+    cached, stale = await lookup_cached(config, cache, url_config, url,
+                                        try_urls, **fetch_opts)
+
+    if not cached:
+        try:
+            with timing.measure('fetch'):
+                (resp, rsc_ctype, rsc_clength, data), cached = \
+                    await fetch_or_stale(config, cache, url_config, url,
+                                         try_urls, stale, **fetch_opts)
+        except crawler.RedirectRequired as redirect:
+            return await redirect_response(
+                req,
+                server_geminize_url(config, redirect.url)
+            )
+
+        # cached is set if the cached content must be served (not
+        # modified, or upstream error)
+        if not cached and not resp:
             return await error_response(
                 req,
                 f'Could not fetch {url} or {url_http}'
             )
-
-        if not resp or not rsc_ctype or resp.status != 200:
+        elif not cached and (not rsc_ctype or resp.status != 200):
             return await http_crawler_error_response(req, resp.status)
 
+    req.cache_outcome = record_cache_outcome(url_config, url, cached, resp)
+
+    if cached:
+        rsc_ctype, data, meta = cached
+
     resp, title = await build_response(
         req,
         config,
@@ -686,13 +1991,14 @@ async def rcontroller_domain(route,
         gemini_server_host=config.hostname,
         domain=domain,
         is_cached=cached is not None,
+        meta=meta,
+        rsc_headers=resp.headers if resp else None,
+        cache_url=url,
         req_path=path
     )
 
     log_request(access_log_doc, req, datetime.now(), resp, url_config,
-                title=title)
-
-    access_log_doc._scount += 1
+                title=title, url=url)
 
     return resp
 
@@ -798,19 +2104,70 @@ async def rcontroller_graph(route,
                                'text/gemini')
 
 
+def start_background_tasks(config: DictConfig,
+                           cache: diskcache.Cache,
+                           rules,
+                           access_log: AccessLog) -> None:
+    loop = asyncio.get_event_loop()
+
+    if config.get('persist_access_log', False) is True:
+        run_in_background(accesslog.cache_persist_task(cache, access_log))
+
+    if config.get('feeds_background_refresh', False) is True:
+        run_in_background(feeds_refresh_task(config, cache, rules))
+
+    if config.get('stall_watchdog', False) is True:
+        # The watchdog also measures the loop lag
+        watchdog.configure(config)
+        watchdog.start(loop)
+    elif config.get('metrics_endpoint', False) is True or \
+            config.get('metrics_listen'):
+        run_in_background(service_metrics.loop_lag_task(
+            config.get('metrics_loop_lag_interval', 1.0)))
+
+    if config.get('metrics_listen'):
+        # Plain HTTP listener for the metrics (host:port)
+        mhost, _, mport = str(config.metrics_listen).rpartition(':')
+        run_in_background(service_metrics.serve_http(
+            mhost if mhost else 'localhost', int(mport), metrics_prometheus))
+
+    if cache is not None and config.get('cache_dedup', False) is True:
+        run_in_background(content_gc_task(config, cache))
+
+    if cache is not None:
+        run_in_background(cache_index_flush_task(config, cache))
+
+
 def create_levior_handler(config: DictConfig,
                           cache: diskcache.Cache,
                           rules,
                           graph=None,
-                          access_log: GmiDocument = None) -> _RequestHandler:
-    loop = asyncio.get_event_loop()
+                          access_log: AccessLog = None,
+                          background_tasks: bool = True) -> _RequestHandler:
+    """
+    Create the levior request handler. If background_tasks is False (e.g:
+    for a one-shot cache warm-up), the server's background tasks (access
+    log persistence, feeds refresh, metrics listener, content GC,
+    watchdog and links prefetching) are not started.
+    """
+
     mountpoints: dict = {}
 
-    access_log_doc: GmiDocument = access_log if access_log else GmiDocument()
-    access_log_doc._scount = 0
+    access_log_doc: AccessLog = access_log if access_log is not None else \
+        AccessLog(capacity=config.get('access_log_size', 1000))
 
-    if config.get('persist_access_log', False) is True:
-        loop.create_task(caching.cache_persist_task(cache, access_log_doc))
+    if background_tasks:
+        start_background_tasks(config, cache, rules, access_log_doc)
+
+    cache_stats.max_hosts = config.get('stats_max_hosts', 1000)
+    cacheio.configure(config)
+
+    if config.get('cache_memory_limit'):
+        # In-memory hot tier (size in megabytes)
+        hot_tier.configure(
+            int(caching.mbtobytes(config.cache_memory_limit)),
+            max_entry_bytes=config.get('cache_memory_max_entry_size')
+        )
 
     ipfilter_allow: list = [
         IP(ip) for ip in config.get('client_ip_allow', [])
@@ -881,6 +2238,17 @@ def create_levior_handler(config: DictConfig,
                        controller='cache',
                        action='cache')
 
+    # Cache statistics
+    srv_routes.connect(None, "/stats",
+                       controller='stats',
+                       action='stats')
+    srv_routes.connect(None, "/stats/{format}",
+                       requirements={
+                           'format': 'json|prometheus'
+                       },
+                       controller='stats',
+                       action='stats')
+
     # Search
     srv_routes.connect(None, "/search",
                        controller='search',
@@ -892,6 +2260,18 @@ def create_levior_handler(config: DictConfig,
                            controller='access_log',
                            action="access_log")
 
+    # Metrics
+    if config.get('metrics_endpoint', False) is True:
+        srv_routes.connect(None, "/metrics",
+                           controller='metrics',
+                           action="metrics")
+
+    # Event loop stalls
+    if config.get('stall_watchdog', False) is True:
+        srv_routes.connect(None, "/debug/stalls",
+                           controller='stalls',
+                           action="stalls")
+
     # Connect the routes for the ZIM mountpoints
     for mp, mount in mountpoints.items():
         srv_routes.connect(None, mp,
@@ -906,7 +2286,7 @@ def create_levior_handler(config: DictConfig,
         rroute = rule.config.get('route')
         rtype = rule.config.get('type')
 
-        if rtype in ['feed_aggregator', 'feeds_aggregator'] and \
+        if rtype in feeds_aggregator_types and \
            isinstance(rroute, str):
             srv_routes.connect(None, rroute,
                                controller='feeds_aggregator',
@@ -944,8 +2324,10 @@ def create_levior_handler(config: DictConfig,
 
         route = srv_routes.match(req.url.path)
         ctrler = route['controller'] if route else None
+        req.controller = ctrler if ctrler else 'not_found'
 
-        url_config = get_url_config(config, rules, req.url)
+        with timing.measure('rule'):
+            url_config = get_url_config(config, rules, req.url)
 
         cresp = get_custom_reply(url_config)
         if cresp:
@@ -976,43 +2358,63 @@ def create_levior_handler(config: DictConfig,
         :rtype: Response
         """
 
-        reqd = datetime.utcnow()
+        reqd = datetime.now()
+        req.controller = 'proxy'
 
         if req.url.scheme not in ['http', 'https', 'ipfs', 'ipns']:
             return await error_response(
                 req, f'Unsupported URL scheme: {req.url.scheme}')
 
-        url_config = get_url_config(config, rules, req.url)
+        with timing.measure('rule'):
+            url_config = get_url_config(config, rules, req.url)
 
         cresp = get_custom_reply(url_config)
         if cresp:
             return await send_custom_reply(req, cresp)
 
-        cached = cache.get(
-            caching.cache_key_for_url(req.url)) if cache else None
+        resp, meta = None, None
+        fetch_opts: dict = {
+            'proxy_url': url_config['proxy_url'],
+            'verify_ssl': config.verify_ssl,
+            'user_agent': url_config['user_agent'],
+            'http_headers': url_config['http_headers']
+        }
 
-        if cached:
-            rsc_ctype, data, _ = cached
-        else:
+        hot = await serve_hot(req, config, cache, url_config, req.url,
+                              graph=graph, proxy_mode=True)
+
+        if hot:
+            log_request(access_log_doc, req, reqd, hot[0], url_config,
+                        title=hot[1])
+            return hot[0]
+
+        cached, stale = await lookup_cached(config, cache, url_config,
+                                            req.url, [req.url], **fetch_opts)
+
+        if not cached:
             try:
-                resp, rsc_ctype, rsc_clength, data = await crawler.fetch(
-                    req.url,
-                    config,
-                    url_config,
-                    proxy_url=url_config['proxy_url'],
-                    verify_ssl=config.verify_ssl,
-                    user_agent=url_config['user_agent'],
-                    http_headers=url_config['http_headers']
-                )
+                with timing.measure('fetch'):
+                    (resp, rsc_ctype, rsc_clength, data), cached = \
+                        await fetch_or_stale(config, cache, url_config,
+                                             req.url, [req.url], stale,
+                                             **fetch_opts)
             except crawler.RedirectRequired as redirect:
                 return await redirect_response(req, str(redirect.url))
 
-            except Exception:
-                return await error_response(req, traceback.format_exc())
-
-            if not resp or not rsc_ctype or resp.status != 200:
+            # cached is set if the cached content must be served (not
+            # modified, or upstream error)
+            if not cached and not resp:
+                return await error_response(
+                    req, f'Could not fetch {req.url}')
+            elif not cached and (not rsc_ctype or resp.status != 200):
                 return await http_crawler_error_response(req, resp.status)
 
+        req.cache_outcome = record_cache_outcome(url_config, req.url,
+                                                 cached, resp)
+
+        if cached:
+            rsc_ctype, data, meta = cached
+
         resp, title = await build_response(
             req,
             config,
@@ -1023,20 +2425,39 @@ def create_levior_handler(config: DictConfig,
             graph=graph,
             domain=req.url.host,
             is_cached=cached is not None,
+            meta=meta,
+            rsc_headers=resp.headers if resp else None,
             proxy_mode=True
         )
 
         log_request(access_log_doc, req, reqd, resp, url_config,
                     title=title)
-
-        access_log_doc._scount += 1
         return resp
 
     async def handle_request(req: Request) -> Response:
         """
-        Main entrypoint for requests.
+        Main entrypoint for requests. Requests slower than the
+        slow_request_threshold (in milliseconds) are logged with their
+        timing breakdown.
         """
 
+        token = timing.start()
+        status: str = 'error'
+        metrics.request_started()
+
+        try:
+            resp = await dispatch_request(req)
+            status = str(getattr(resp.status, 'value', resp.status))
+            return resp
+        finally:
+            rtimings = timing.stop(token)
+            metrics.request_done(getattr(req, 'controller', 'other'),
+                                 status, rtimings.elapsed)
+            timing.log_slow_request(
+                str(req.url), rtimings,
+                config.get('slow_request_threshold', 5000) / 1000)
+
+    async def dispatch_request(req: Request) -> Response:
         client_ip: IP = get_req_ipaddr(req)
 
         if len(ipfilter_allow) > 0 and not ipaddr_allowed(
@@ -1063,4 +2484,30 @@ def create_levior_handler(config: DictConfig,
                 f'Unauthorized request for URL: {req.url}'
             )
 
+    def prefetch_target(url: URL) -> Optional[URL]:
+        """
+        Return the upstream URL of a link, if it can be prefetched
+        """
+
+        modes = config.get('mode', 'proxy,server').split(',')
+
+        if url.scheme in ['http', 'https'] and 'proxy' in modes:
+            return url
+        elif url.scheme == 'gemini' and url.host == config.hostname and \
+                'server' in modes:
+            route = srv_routes.match(url.path)
+
+            if route and route['controller'] == 'domain':
+                return URL.build(scheme='https',
+                                 host=route['domain'],
+                                 path='/' + route.get('path', ''),
+                                 query=url.query)
+
+        return None
+
+    if cache is not None and background_tasks:
+        prefetcher.configure(
+            config, cache, handle_request, prefetch_target,
+            url_config=lambda url: get_url_config(config, rules, url))
+
     return handle_request
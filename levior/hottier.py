@@ -0,0 +1,176 @@
+import threading
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class HotEntry:
+    ctype: str
+    body: bytes
+    title: Optional[str]
+    expires: Optional[float]
+
+    # Content type of the resource the response was rendered from
+    source_ctype: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+
+class HotTier:
+    """
+    In-memory LRU cache of rendered responses, in front of the disk
+    cache, with a byte budget. Entries are keyed by the cache key of the
+    resource and the fingerprint of the rendering settings, and expire
+    when the cached resource stops being fresh. Storing or removing a
+    resource in the disk cache invalidates its entries.
+    """
+
+    def __init__(self, max_bytes: int = 0, max_entry_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size: int = 0
+        self.stats: dict = dict.fromkeys(
+            ['hits', 'misses', 'evictions', 'expirations', 'invalidations'],
+            0)
+
+        self._entries: OrderedDict = OrderedDict()
+
+        # Hot keys by resource cache key
+        self._keys: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(cache_key: str, fingerprint: str) -> tuple:
+        return cache_key, fingerprint
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        total = self.stats['hits'] + self.stats['misses']
+
+        return self.stats['hits'] / total if total else None
+
+    def configure(self,
+                  max_bytes: int,
+                  max_entry_bytes: Optional[int] = None) -> None:
+        """
+        Set the byte budget (and the maximum size of an entry, by default
+        an eighth of the budget)
+        """
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_entry_bytes = max_entry_bytes if max_entry_bytes \
+                else max_bytes // 8
+            self._shrink()
+
+    def _remove(self, key: tuple) -> HotEntry:
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+        keys = self._keys.get(key[0])
+
+        if keys is not None:
+            keys.discard(key)
+
+            if not keys:
+                del self._keys[key[0]]
+
+        return entry
+
+    def _shrink(self) -> None:
+        while self._entries and self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def get(self, key: tuple) -> Optional[HotEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            if entry.expires is not None and entry.expires <= time.time():
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self,
+            key: tuple,
+            ctype: str,
+            body: bytes,
+            title: Optional[str] = None,
+            expires: Optional[float] = None,
+            source_ctype: Optional[str] = None) -> bool:
+        """
+        Store a rendered response, expiring at the (epoch) time expires
+        (None means never). Least recently used entries are evicted to
+        stay within the byte budget.
+        """
+
+        if not self.enabled or len(body) > self.max_entry_bytes or (
+                expires is not None and expires <= time.time()):
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = HotEntry(ctype, body, title, expires,
+                                          source_ctype=source_ctype)
+            self._keys.setdefault(key[0], set()).add(key)
+            self.size += len(body)
+            self._shrink()
+
+        return True
+
+    def invalidate(self, cache_key: str) -> int:
+        """
+        Remove the entries of a resource (all its renderings)
+        """
+
+        if cache_key not in self._keys:
+            return 0
+
+        with self._lock:
+            keys = list(self._keys.get(cache_key, []))
+
+            for key in keys:
+                self._remove(key)
+
+            self.stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.size = 0
+
+    def as_dict(self) -> dict:
+        return dict(self.stats,
+                    entries=len(self._entries),
+                    size=self.size,
+                    max_bytes=self.max_bytes,
+                    hit_ratio=self.hit_ratio)
+
+
+# Hot tier of the levior cache (disabled until it's configured)
+hot_tier = HotTier()
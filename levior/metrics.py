@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import socket
+import threading
+
+from typing import Callable, Dict, Optional
+
+import aiohttp
+
+from . import cacheio
+from . import conversion
+from .stats import LatencyHistogram
+
+
+logger = logging.getLogger()
+
+# Upper bounds (in seconds) of the request latency histograms buckets
+request_buckets: tuple = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                          2.5, 5.0, 10.0, 30.0)
+
+# Upper bounds (in seconds) of the event loop lag histogram buckets
+lag_buckets: tuple = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1.0, 2.5)
+
+# Content type of the Prometheus text exposition format
+prometheus_ctype: str = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def fetch_error_type(err: BaseException) -> str:
+    """
+    Return the type of an upstream fetch error (the label of the fetch
+    errors counter)
+    """
+
+    if isinstance(err, asyncio.TimeoutError):
+        return 'timeout'
+    elif isinstance(err, (aiohttp.ClientConnectorCertificateError,
+                          aiohttp.ClientSSLError)):
+        return 'ssl'
+    elif isinstance(err, aiohttp.ClientConnectorError):
+        return 'dns' if isinstance(err.os_error, socket.gaierror) \
+            else 'connect'
+    elif isinstance(err, (aiohttp.ServerDisconnectedError,
+                          aiohttp.ClientPayloadError)):
+        return 'disconnected'
+    elif isinstance(err, aiohttp.ClientError):
+        return 'client'
+
+    return 'other'
+
+
+def executor_queue_depth(executor) -> Optional[int]:
+    """
+    Return the number of tasks waiting in an executor (for a process
+    pool, the tasks which are waiting or running)
+    """
+
+    if executor is None:
+        return None
+    elif hasattr(executor, '_work_queue'):
+        return executor._work_queue.qsize()
+    elif hasattr(executor, '_pending_work_items'):
+        return len(executor._pending_work_items)
+
+    return None  # pragma: no cover
+
+
+class Metrics:
+    """
+    Service metrics: requests and their latency by controller, requests
+    in flight, upstream fetch errors by type and event loop lag. The
+    metrics are updated with a few dict operations per request.
+    """
+
+    def __init__(self):
+        self.requests: Dict[tuple, int] = {}
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.fetch_errors: Dict[str, int] = {}
+        self.in_flight: int = 0
+        self.loop_lag: float = 0.0
+        self.loop_lag_hist = LatencyHistogram(buckets=lag_buckets)
+        self._lock = threading.Lock()
+
+    def request_started(self) -> None:
+        self.in_flight += 1
+
+    def request_done(self,
+                     controller: str,
+                     status: str,
+                     duration: float) -> None:
+        """
+        Count a request handled by a controller (status is the gemini
+        status code of the response, or error)
+        """
+
+        self.in_flight -= 1
+
+        with self._lock:
+            key = (controller, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            hist = self.latencies.get(controller)
+
+            if hist is None:
+                hist = self.latencies[controller] = LatencyHistogram(
+                    buckets=request_buckets)
+
+        hist.observe(duration)
+
+    def fetch_error(self, etype: str) -> None:
+        with self._lock:
+            self.fetch_errors[etype] = self.fetch_errors.get(etype, 0) + 1
+
+    def observe_lag(self, lag: float) -> None:
+        self.loop_lag = lag
+        self.loop_lag_hist.observe(lag)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            requests: Dict[str, dict] = {}
+
+            for (controller, status), count in self.requests.items():
+                requests.setdefault(controller, {})[status] = count
+
+            return {
+                'requests': requests,
+                'latency': {controller: hist.as_dict()
+                            for controller, hist in self.latencies.items()},
+                'fetch_errors': dict(self.fetch_errors),
+                'in_flight': self.in_flight,
+                'loop_lag': self.loop_lag,
+                'executor_queue': {
+                    'convert': executor_queue_depth(conversion.executor),
+                    'cache_io': executor_queue_depth(cacheio.executor)
+                }
+            }
+
+    def to_prometheus(self, prefix: str = 'levior') -> str:
+        """
+        Dump the metrics in the Prometheus text exposition format
+        """
+
+        data = self.as_dict()
+        lines: list = [f'# TYPE {prefix}_requests_total counter']
+
+        for controller, statuses in data['requests'].items():
+            for status, count in statuses.items():
+                lines.append(f'{prefix}_requests_total{{'
+                             f'controller="{controller}",'
+                             f'status="{status}"}} {count}')
+
+        name = f'{prefix}_request_duration_seconds'
+        lines.append(f'# TYPE {name} histogram')
+
+        with self._lock:
+            latencies = list(self.latencies.items())
+
+        for controller, hist in latencies:
+            lines += hist.to_prometheus(name, f'controller="{controller}"')
+
+        lines.append(f'# TYPE {prefix}_fetch_errors_total counter')
+
+        for etype, count in data['fetch_errors'].items():
+            lines.append(f'{prefix}_fetch_errors_total{{type="{etype}"}} '
+                         f'{count}')
+
+        lines.append(f'# TYPE {prefix}_requests_in_flight gauge')
+        lines.append(f'{prefix}_requests_in_flight {data["in_flight"]}')
+
+        lines.append(f'# TYPE {prefix}_event_loop_lag_last_seconds gauge')
+        lines.append(f'{prefix}_event_loop_lag_last_seconds '
+                     f'{data["loop_lag"]}')
+
+        name = f'{prefix}_event_loop_lag_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        lines += self.loop_lag_hist.to_prometheus(name)
+
+        lines.append(f'# TYPE {prefix}_executor_queue_depth gauge')
+
+        for pool, depth in data['executor_queue'].items():
+            if depth is not None:
+                lines.append(f'{prefix}_executor_queue_depth'
+                             f'{{executor="{pool}"}} {depth}')
+
+        return '\n'.join(lines) + '\n'
+
+
+async def loop_lag_task(interval: float = 1.0) -> None:
+    """
+    Measure the event loop lag: how late a sleep of interval seconds
+    wakes up
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        metrics.observe_lag(max(loop.time() - started - interval, 0))
+
+
+async def serve_http(host: str,
+                     port: int,
+                     render: Callable[[], str]) -> asyncio.AbstractServer:
+    """
+    Serve the metrics (rendered by render) on a plain HTTP listener, at
+    the /metrics path
+    """
+
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+
+            # Skip the headers
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            method = parts[0] if parts else None
+
+            if len(parts) > 1 and method in ['GET', 'HEAD'] and \
+               parts[1].split('?')[0] == '/metrics':
+                status, ctype = '200 OK', prometheus_ctype
+                body = render().encode()
+            else:
+                status, ctype = '404 Not Found', 'text/plain'
+                body = b'Not found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: {ctype}\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode())
+
+            if method != 'HEAD':
+                writer.write(body)
+
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+
+    logger.info(f'Metrics available on http://{host}:{port}/metrics')
+    return server
+
+
+# Metrics of the levior service
+metrics = Metrics()
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import re
+import traceback
+
+from typing import Callable, Iterator, List, Optional
+
+from aiogemini import Status
+from omegaconf import DictConfig
+from omegaconf import OmegaConf
+from yarl import URL
+
+from . import caching
+from . import cacheio
+from .request import is_background
+from .request import local_request
+
+
+logger = logging.getLogger()
+
+# Gemtext link lines
+link_re = re.compile(r'^=>\s*(\S+)')
+
+# Prefetch policy of a rule with "prefetch: true"
+default_policy: dict = {
+    # Prefetch the first max_links links of the page
+    'max_links': 3,
+
+    # Only prefetch the links to the domain of the page
+    'same_domain': True,
+
+    # Only prefetch the links matching this regular expression
+    'regexp': None
+}
+
+
+def prefetch_policy(url_config: dict) -> Optional[dict]:
+    """
+    Return the prefetch policy of a URL rule (None if the rule
+    doesn't prefetch links)
+    """
+
+    policy = url_config.get('prefetch')
+
+    if policy is True:
+        return dict(default_policy)
+    elif isinstance(policy, DictConfig):
+        policy = OmegaConf.to_container(policy)
+
+    if isinstance(policy, dict):
+        return dict(default_policy, **policy)
+
+    return None
+
+
+def gemtext_links(gemtext: str) -> Iterator[str]:
+    for line in gemtext.splitlines():
+        match = link_re.match(line)
+
+        if match:
+            yield match.group(1)
+
+
+class Prefetcher:
+    """
+    Prefetch the links of the pages in the background, so that the next
+    page requested by the client is already in the cache.
+
+    The links are requested through the levior request handler (with
+    background requests, which are not logged and don't prefetch their own
+    links), by a few workers, at a global bandwidth budget. Links are
+    dropped when the queue is full: prefetching is best-effort and must
+    not compete with the clients' requests.
+    """
+
+    def __init__(self):
+        self.concurrency: int = 2
+        self.bandwidth: int = 0
+        self.stats: dict = dict.fromkeys(
+            ['queued', 'prefetched', 'cached', 'dropped', 'failed', 'bytes'],
+            0)
+
+        self._handler: Optional[Callable] = None
+        self._target: Optional[Callable] = None
+        self._url_config: Optional[Callable] = None
+        self._cache: Optional[caching.CacheBackend] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: set = set()
+        self._workers: list = []
+        self._next_slot: float = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._handler is not None
+
+    def configure(self,
+                  config: DictConfig,
+                  cache: caching.CacheBackend,
+                  request_handler: Callable,
+                  target: Callable[[URL], Optional[URL]],
+                  url_config: Optional[Callable[[URL], dict]] = None
+                  ) -> None:
+        """
+        Configure the prefetcher: request_handler is the levior request
+        handler, target returns the URL of the upstream resource for
+        the URL of a link (None if the link can't be prefetched), and
+        url_config returns the url_config of an upstream URL (the links
+        whose rule doesn't cache the resources are not prefetched)
+        """
+
+        self.concurrency = config.get('prefetch_concurrency', 2)
+
+        # Bandwidth budget, in KB/s (0: no limit)
+        self.bandwidth = int(config.get('prefetch_bandwidth', 0) * 1024)
+
+        self._queue = asyncio.Queue(
+            maxsize=config.get('prefetch_queue_size', 128))
+        self._cache = cache
+        self._handler = request_handler
+        self._target = target
+        self._url_config = url_config
+        self._pending.clear()
+        self._workers = []
+
+    def candidates(self,
+                   page_url: URL,
+                   gemtext: str,
+                   policy: dict) -> List[URL]:
+        """
+        Return the URLs of the links of a page to prefetch
+        """
+
+        page_target = self._target(page_url)
+        regexp = re.compile(policy['regexp']) if policy.get('regexp') \
+            else None
+        urls: List[URL] = []
+
+        for link in gemtext_links(gemtext):
+            if len(urls) >= policy['max_links']:
+                break
+
+            try:
+                url = page_url.join(URL(link))
+                target = self._target(url)
+            except ValueError:
+                continue
+
+            if target is None or url == page_url or url in urls:
+                continue
+            elif policy['same_domain'] and (
+                    page_target is None or target.host != page_target.host):
+                continue
+            elif regexp and not regexp.search(str(target)):
+                continue
+            elif self._url_config and \
+                    not self._url_config(target).get('cache'):
+                # Not cached: the prefetched page would be thrown away
+                continue
+
+            urls.append(url)
+
+        return urls
+
+    def schedule(self, req, url_config: dict, gemtext: str) -> int:
+        """
+        Queue the prefetch of the links of a page, if the rule has a
+        prefetch policy. Returns the number of links queued.
+        """
+
+        policy = prefetch_policy(url_config)
+
+        if not self.enabled or not policy or is_background(req):
+            return 0
+
+        if not self._workers:
+            self._workers = [
+                asyncio.ensure_future(self.worker())
+                for _ in range(max(self.concurrency, 1))
+            ]
+
+        queued: int = 0
+
+        for url in self.candidates(req.url, gemtext, policy):
+            if url in self._pending:
+                continue
+
+            try:
+                self._queue.put_nowait(url)
+            except asyncio.QueueFull:
+                self.stats['dropped'] += 1
+                break
+
+            self._pending.add(url)
+            queued += 1
+
+        self.stats['queued'] += queued
+        return queued
+
+    async def _wait_budget(self) -> None:
+        delay = self._next_slot - asyncio.get_running_loop().time()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _spend(self, size: int) -> None:
+        if self.bandwidth:
+            now = asyncio.get_running_loop().time()
+            self._next_slot = max(now, self._next_slot) + \
+                size / self.bandwidth
+
+    async def prefetch(self, url: URL) -> bool:
+        target = self._target(url)
+
+        if await cacheio.run('get', self._cached, target):
+            self.stats['cached'] += 1
+            return False
+
+        await self._wait_budget()
+
+        req = local_request(url, background=True)
+        resp = await self._handler(req)
+
+        self._spend(req.transport.size)
+        self.stats['bytes'] += req.transport.size
+
+        if resp.status != Status.SUCCESS:
+            self.stats['failed'] += 1
+            return False
+
+        self.stats['prefetched'] += 1
+        return True
+
+    def _cached(self, target: URL) -> bool:
+        return caching.cache_key_for_url(target) in self._cache
+
+    async def worker(self) -> None:
+        while True:
+            url = await self._queue.get()
+
+            try:
+                await self.prefetch(url)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats['failed'] += 1
+                logger.debug(f'{url}: prefetch failed: '
+                             f'{traceback.format_exc()}')
+            finally:
+                self._pending.discard(url)
+                self._queue.task_done()
+
+    def as_dict(self) -> dict:
+        return dict(self.stats,
+                    pending=len(self._pending),
+                    concurrency=self.concurrency,
+                    bandwidth=self.bandwidth)
+
+
+# Links prefetcher (disabled until it's configured)
+prefetcher = Prefetcher()
@@ -1,16 +1,61 @@
+import asyncio
 import logging
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from IPy import IP
+from yarl import URL
 from aiogemini.server import Request, Response
 
-from trimgmi import Document as GmiDocument
+from . import timing
+from .accesslog import AccessLog
+from .accesslog import AccessRecord
 
 
 logger = logging.getLogger()
 
 
+class LocalTransport(asyncio.Transport):
+    """
+    Transport of the requests made by levior itself (e.g: cache warm-up).
+    The response is discarded, only its size is counted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.size: int = 0
+        self._closing: bool = False
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self) -> None:
+        self._closing = True
+
+    def get_extra_info(self, name, default=None):
+        return ('127.0.0.1', 0) if name == 'peername' else default
+
+
+def local_request(url: URL, background: bool = False) -> Request:
+    """
+    Build a request for a URL, which can be passed to the levior request
+    handler. Background requests (e.g: prefetches) are not logged.
+    """
+
+    req = Request(url=url)
+    req.transport = LocalTransport()
+    req.protocol = asyncio.streams.FlowControlMixin()
+    req.background = background
+    return req
+
+
+def is_background(req: Request) -> bool:
+    return getattr(req, 'background', False)
+
+
 def get_req_ipaddr(req: Request) -> IP:
     try:
         peer = req.transport.get_extra_info('peername')
@@ -26,26 +71,39 @@ def ipaddr_allowed(ip: IP, ipflist: List[IP]) -> bool:
     return any(ip in ipf for ipf in ipflist)
 
 
-def log_request(access_log: GmiDocument,
+def log_request(access_log: AccessLog,
                 req: Request, reqd: datetime,
                 resp: Response, url_config,
-                title: str = None) -> None:
+                title: str = None,
+                url: Optional[URL] = None) -> None:
     """
-    Log a request's URL and response status as a gemtext link.
+    Record a request in the access log: the URL, the response status,
+    content type and size, the cache outcome and the timings of the
+    request. url is the URL of the upstream resource, if any.
     """
 
-    rdt: str = reqd.strftime("%d/%b/%Y %H:%M:%S")
-    client_ip = get_req_ipaddr(req)
+    if is_background(req):
+        return
 
-    gemline: str = f'=> {req.url}  [{rdt}] '
-    if title:
-        gemline += title
-    else:
-        gemline += str(req.url)
+    rtimings = timing.timings()
+    client_ip = get_req_ipaddr(req)
 
-    gemline += f' (origin: {client_ip}, status: {resp.status.value}, '
-    gemline += f'ctype: {resp.content_type})'
+    record = AccessRecord(
+        time=reqd.timestamp(),
+        url=str(req.url),
+        host=url.host if url else req.url.host,
+        status=resp.status.value,
+        client=str(client_ip) if client_ip else None,
+        ctype=resp.content_type,
+        size=getattr(resp, 'size', None),
+        title=title,
+        outcome=getattr(req, 'cache_outcome', None),
+        fetch_time=rtimings.get('fetch') if rtimings else None,
+        convert_time=rtimings.get('convert') if rtimings else None,
+        duration=rtimings.elapsed if rtimings else None,
+        timings=rtimings.as_dict() if rtimings else None
+    )
 
-    access_log.append(gemline)
+    access_log.append(record)
 
-    logger.info(gemline)
+    logger.info(record.gemtext())
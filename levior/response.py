@@ -1,9 +1,13 @@
+from typing import AsyncIterator, BinaryIO, Optional
+
 from yarl import URL
 from aiogemini import Status, GEMINI_MEDIA_TYPE
 from aiogemini.server import Request, Response
 
 from trimgmi import Document as GmiDocument
 
+from . import timing
+
 
 def data_response_init(req: Request, content_type=GEMINI_MEDIA_TYPE,
                        status=Status.SUCCESS) -> Response:  # pragma: no cover
@@ -22,8 +26,43 @@ async def data_response(req: Request, data, content_type=GEMINI_MEDIA_TYPE,
     response.status = status
     response.reason = reason
     response.start(req)
-    await response.write(data)
-    await response.write_eof()
+    response.size = len(data)
+
+    with timing.measure('write'):
+        await response.write(data)
+        await response.write_eof()
+
+    return response
+
+
+async def stream_response(req: Request,
+                          chunks: AsyncIterator[bytes],
+                          content_type=GEMINI_MEDIA_TYPE,
+                          tee: Optional[BinaryIO] = None,
+                          status=Status.SUCCESS) -> Response:
+    """
+    Send a response whose body is written chunk by chunk (each write
+    waits for the transport to drain). Chunks are also written to the
+    tee file if one is passed.
+    """
+    response = Response()
+    response.content_type = content_type
+    response.status = status
+    response.start(req)
+    response.size = 0
+
+    async for chunk in chunks:
+        with timing.measure('write'):
+            await response.write(chunk)
+
+        response.size += len(chunk)
+
+        if tee is not None:
+            tee.write(chunk)
+
+    with timing.measure('write'):
+        await response.write_eof()
+
     return response
 
 
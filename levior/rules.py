@@ -1,7 +1,8 @@
 import re
 
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import List
+from typing import Any, Dict, Iterator, List, Pattern
 from typing import Optional
 
 from omegaconf import DictConfig
@@ -83,3 +84,258 @@ def parse_rules(config: DictConfig,
             rules.append(_rule)
 
     return rules
+
+
+# Regexp characters that end the literal prefix of a pattern
+regexp_meta_chars: str = '.^$*+?{}[]()|\\'
+
+# Escaped characters that are literals
+regexp_escaped_literals: str = './-:?+*()[]{}^$|#&=~%@!,;\\'
+
+# Matches a {m,n} repetition quantifier
+regexp_repeat_re = re.compile(r'\{(\d*)(?:(,)(\d*))?\}')
+
+# Matches a literal prefix starting with a scheme and a complete host
+literal_host_re = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*://([^/?#:@]+)[/:]')
+
+# Finds the hosts in a URL string
+url_hosts_re = re.compile(r'://([^/?#:@]*)')
+
+# Regexp flags for which literals can't be extracted
+regexp_noliteral_flags = re.IGNORECASE | re.VERBOSE
+
+
+def regexp_literal_prefix(pattern: str) -> str:
+    """
+    Return the literal string that every match of this regexp
+    starts with (an empty string if there's none).
+    """
+
+    if '|' in pattern:
+        # Alternations: no guaranteed prefix
+        return ''
+
+    pos = 1 if pattern.startswith('^') else 0
+    prefix: list = []
+
+    while pos < len(pattern):
+        char = pattern[pos]
+
+        if char == '\\':
+            char = pattern[pos + 1:pos + 2]
+
+            if not char or char not in regexp_escaped_literals:
+                break
+
+            step = 2
+        elif char in regexp_meta_chars:
+            break
+        else:
+            step = 1
+
+        quantifier = pattern[pos + step:pos + step + 1]
+
+        if quantifier in ['?', '*', '{']:
+            # Optional character
+            break
+
+        prefix.append(char)
+        pos += step
+
+        if quantifier == '+':
+            break
+
+    return ''.join(prefix)
+
+
+def regexp_required_literal(pattern: str) -> str:
+    """
+    Return the longest literal string that every match of this regexp
+    contains (an empty string if there's none). Only the characters
+    outside of groups and character classes are considered.
+    """
+
+    runs: list = []
+    run: list = []
+    depth, pos = 0, 0
+
+    def end_run():
+        if run:
+            runs.append(''.join(run))
+            run.clear()
+
+    while pos < len(pattern):
+        char = pattern[pos]
+        step, literal = 1, None
+
+        if char == '\\':
+            step = 2
+            esc = pattern[pos + 1:pos + 2]
+
+            if depth == 0 and esc and esc in regexp_escaped_literals:
+                literal = esc
+        elif char == '[':
+            # Skip the character class
+            end = pos + 1
+            if pattern[end:end + 1] == '^':
+                end += 1
+            if pattern[end:end + 1] == ']':
+                end += 1
+            while end < len(pattern) and pattern[end] != ']':
+                end += 2 if pattern[end] == '\\' else 1
+            step = end - pos + 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            # Top-level alternation: no guaranteed literal
+            return ''
+        elif char not in regexp_meta_chars and depth == 0:
+            literal = char
+
+        quantifier = pattern[pos + step:pos + step + 1]
+        repeat = regexp_repeat_re.match(pattern, pos + step) \
+            if quantifier == '{' else None
+
+        if repeat and (repeat.group(1) or repeat.group(2)):
+            # {m,n} quantifier: the atom is required if m > 0, but what
+            # follows isn't contiguous to it. Skip the quantifier's body.
+            if literal is not None and int(repeat.group(1) or 0) > 0:
+                run.append(literal)
+
+            end_run()
+            pos = repeat.end()
+            continue
+
+        if literal is not None and quantifier not in ['?', '*', '{']:
+            run.append(literal)
+
+            if quantifier == '+':
+                end_run()
+        else:
+            end_run()
+
+        pos += step
+
+    end_run()
+
+    return max(runs, key=len) if runs else ''
+
+
+@dataclass
+class RulesBucket:
+    # Positions (priority order) of the rules in this bucket
+    positions: list = field(default_factory=list)
+    patterns: list = field(default_factory=list)
+
+    # Alternation of all the patterns, used to skip the bucket quickly
+    regex: Optional[Pattern] = field(default=None)
+
+    def compile(self) -> None:
+        self.positions = sorted(set(self.positions))
+
+        if any(re.search(r'\\\d|\(\?P=|\(\?\(', p)
+               for p in self.patterns):
+            # Backreferences would break in an alternation
+            return
+
+        try:
+            self.regex = re.compile('|'.join(
+                f'(?:{p})' for p in self.patterns))
+        except re.error:
+            self.regex = None
+
+
+class URLRulesIndex:
+    """
+    Precompiled index of URL rules.
+
+    Rules whose regexps start with a literal scheme and host are put in
+    per-host buckets, the others in a generic bucket. Matching a URL only
+    checks the buckets of the hosts found in the URL, and the rules are
+    tried in priority order (the first hit wins). A regexp is only run
+    if the URL contains the literal string required by the regexp.
+
+    The rule matched for a URL is kept in an LRU.
+    """
+
+    def __init__(self, rules: List[URLRule], lru_size: int = 4096):
+        self.rules: List[URLRule] = list(rules)
+        self.lru_size = lru_size
+        self._lru: OrderedDict = OrderedDict()
+        self._generic = RulesBucket()
+        self._hosts: Dict[str, RulesBucket] = {}
+        self._prefilters: List[list] = []
+
+        for pos, rule in enumerate(self.rules):
+            self._prefilters.append([
+                (regexp_required_literal(reg.pattern)
+                 if not reg.flags & regexp_noliteral_flags else '', reg)
+                for reg in rule.regexps
+            ])
+
+            for reg in rule.regexps:
+                hostm = literal_host_re.match(
+                    regexp_literal_prefix(reg.pattern)
+                ) if not reg.flags & regexp_noliteral_flags else None
+
+                if hostm:
+                    bucket = self._hosts.setdefault(hostm.group(1),
+                                                    RulesBucket())
+                else:
+                    bucket = self._generic
+
+                bucket.positions.append(pos)
+                bucket.patterns.append(reg.pattern)
+
+        for bucket in [self._generic] + list(self._hosts.values()):
+            bucket.compile()
+
+    def __iter__(self) -> Iterator[URLRule]:
+        return iter(self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __getitem__(self, idx: int) -> URLRule:
+        return self.rules[idx]
+
+    def match(self, url: str) -> Optional[URLRule]:
+        """
+        Return the first rule (by priority) matching this URL
+        """
+
+        candidates: set = set()
+        buckets = [self._generic] + [
+            self._hosts[host] for host in set(url_hosts_re.findall(url))
+            if host in self._hosts
+        ]
+
+        for bucket in buckets:
+            if bucket.regex is not None and not bucket.regex.search(url):
+                continue
+
+            candidates.update(bucket.positions)
+
+        for pos in sorted(candidates):
+            if any(literal in url and reg.search(url)
+                   for literal, reg in self._prefilters[pos]):
+                return self.rules[pos]
+
+        return None
+
+    def lru_get(self, key: str) -> Any:
+        value = self._lru.get(key)
+
+        if value is not None:
+            self._lru.move_to_end(key)
+
+        return value
+
+    def lru_put(self, key: str, value: Any) -> None:
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+logger = logging.getLogger()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls made with the same key: the first call
+    (the leader) runs, and the calls made while it's running wait for
+    the leader's result (or exception) instead of running again.
+    """
+
+    def __init__(self, name: str = 'flight'):
+        self.name = name
+        self.stats: dict = {
+            'leaders': 0,
+            'coalesced': 0
+        }
+        self._flights: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self,
+                  key: str,
+                  fn: Callable[..., Awaitable],
+                  *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Run fn(*args, **kwargs), unless a call with the same key is
+        already running, in which case its result is awaited.
+
+        Returns a (result, shared) tuple, shared is True if the result
+        comes from another call. If the leader is cancelled, one of the
+        waiting calls becomes the leader, the others wait for it.
+        """
+
+        flight = self._flights.get(key)
+
+        if flight is not None:
+            self.stats['coalesced'] += 1
+
+            logger.debug(f'{self.name}: coalesced request for {key}')
+
+        while flight is not None:
+            try:
+                return await asyncio.shield(flight), True
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+
+            # The leader was cancelled: wait for the call which took
+            # over, or run the call ourselves
+            flight = self._flights.get(key)
+
+        flight = asyncio.get_running_loop().create_future()
+
+        # Avoid "exception was never retrieved" warnings
+        flight.add_done_callback(
+            lambda fut: fut.cancelled() or fut.exception())
+
+        self._flights[key] = flight
+        self.stats['leaders'] += 1
+
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as err:
+            flight.set_exception(err)
+            raise
+        else:
+            flight.set_result(result)
+            return result, False
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
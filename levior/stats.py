@@ -0,0 +1,295 @@
+import bisect
+import json
+import threading
+
+from dataclasses import dataclass, field, fields, asdict
+from typing import Dict, Optional
+
+
+# Cache outcomes of a request
+outcomes: tuple = ('hit', 'stale', 'revalidated', 'miss', 'bypass')
+
+# Name of the counters for the hosts that are not tracked individually
+other_hosts: str = 'other'
+
+# Upper bounds (in seconds) of the latency histograms buckets
+latency_buckets: tuple = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                          0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+@dataclass
+class CacheCounters:
+    hits: int = field(default=0)
+    stale: int = field(default=0)
+    revalidated: int = field(default=0)
+    misses: int = field(default=0)
+    bypass: int = field(default=0)
+    bytes_saved: int = field(default=0)
+    evictions: int = field(default=0)
+    stores: int = field(default=0)
+    bytes_stored: int = field(default=0)
+    store_time: float = field(default=0.0)
+
+    # Stores of a body already in the cache (content deduplication)
+    deduped: int = field(default=0)
+    bytes_deduped: int = field(default=0)
+
+    @property
+    def served_from_cache(self) -> int:
+        return self.hits + self.stale + self.revalidated
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        """
+        Ratio of the cacheable requests served from the cache (None if
+        there were no cacheable requests)
+        """
+        total = self.served_from_cache + self.misses
+
+        return self.served_from_cache / total if total else None
+
+    @property
+    def store_latency(self) -> Optional[float]:
+        """
+        Average time (in seconds) to store a resource in the cache
+        """
+        return self.store_time / self.stores if self.stores else None
+
+    def as_dict(self) -> dict:
+        return dict(asdict(self),
+                    hit_ratio=self.hit_ratio,
+                    store_latency=self.store_latency)
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations (in seconds), with fixed buckets
+    """
+
+    def __init__(self, buckets: tuple = latency_buckets):
+        self.buckets = buckets
+        # The last bucket counts the durations above the last bound
+        self.counts: list = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, duration: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+            self.count += 1
+            self.sum += duration
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate a quantile (the upper bound of the bucket it falls in,
+        or infinity)
+        """
+
+        if not self.count:
+            return None
+
+        rank, seen = q * self.count, 0
+
+        for idx, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= rank and count:
+                return self.buckets[idx] if idx < len(self.buckets) \
+                    else float('inf')
+
+        return float('inf')  # pragma: no cover
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            cumulative, buckets = 0, {}
+
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': buckets
+            }
+
+    def to_prometheus(self, name: str, labels: str = '') -> list:
+        """
+        Return the lines of this histogram in the Prometheus text
+        exposition format (labels is a comma-separated list of labels)
+        """
+
+        data = self.as_dict()
+        sep = ',' if labels else ''
+        lines: list = [
+            f'{name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+            for bound, count in data['buckets'].items()
+        ]
+
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} '
+                     f'{data["count"]}')
+
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {data["sum"]}')
+        lines.append(f'{name}_count{suffix} {data["count"]}')
+        return lines
+
+
+def rule_label(url_config: Optional[dict]) -> str:
+    """
+    Return the label identifying a URL rule in the statistics: its name,
+    or its URL regular expression(s)
+    """
+
+    if not url_config:
+        return 'default'
+
+    label = url_config.get('name', url_config.get(
+        'url', url_config.get('regexp')))
+
+    if label is None:
+        return 'default'
+    elif isinstance(label, str):
+        return label
+
+    return ','.join(str(reg) for reg in label)
+
+
+class CacheStats:
+    """
+    Cache statistics: counters of cache hits, stale serves, revalidations,
+    misses, bytes saved, evictions and stores (with their latency), in
+    total and by rule and by host.
+    """
+
+    def __init__(self, max_hosts: int = 1000):
+        self.max_hosts = max_hosts
+        self.total = CacheCounters()
+        self.by_rule: Dict[str, CacheCounters] = {}
+        self.by_host: Dict[str, CacheCounters] = {}
+        self._lock = threading.Lock()
+
+    def _counters(self,
+                  url_config: Optional[dict] = None,
+                  host: Optional[str] = None) -> list:
+        counters: list = [self.total]
+
+        if url_config is not None:
+            counters.append(self.by_rule.setdefault(
+                rule_label(url_config), CacheCounters()))
+
+        if host:
+            if host not in self.by_host and \
+               len(self.by_host) >= self.max_hosts:
+                host = other_hosts
+
+            counters.append(self.by_host.setdefault(host, CacheCounters()))
+
+        return counters
+
+    def record_outcome(self,
+                       outcome: str,
+                       url_config: Optional[dict] = None,
+                       host: Optional[str] = None,
+                       size: int = 0) -> None:
+        """
+        Record the cache outcome of a request (see outcomes). size is the
+        size of the content served from the cache.
+        """
+
+        attr = {'hit': 'hits', 'miss': 'misses'}.get(outcome, outcome)
+
+        with self._lock:
+            for counters in self._counters(url_config, host):
+                setattr(counters, attr, getattr(counters, attr) + 1)
+
+                if outcome in ['hit', 'stale', 'revalidated']:
+                    counters.bytes_saved += size
+
+    def record_store(self,
+                     host: Optional[str],
+                     duration: float,
+                     size: int = 0,
+                     deduped: bool = False) -> None:
+        with self._lock:
+            for counters in self._counters(host=host):
+                counters.stores += 1
+                counters.bytes_stored += size
+                counters.store_time += duration
+
+                if deduped:
+                    counters.deduped += 1
+                    counters.bytes_deduped += size
+
+    def record_eviction(self, host: Optional[str] = None) -> None:
+        with self._lock:
+            for counters in self._counters(host=host):
+                counters.evictions += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.total = CacheCounters()
+            self.by_rule.clear()
+            self.by_host.clear()
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'total': self.total.as_dict(),
+                'rules': {label: c.as_dict()
+                          for label, c in self.by_rule.items()},
+                'hosts': {host: c.as_dict()
+                          for host, c in self.by_host.items()}
+            }
+
+    def to_json(self, **extra) -> str:
+        return json.dumps(dict(self.as_dict(), **extra), indent=2)
+
+    def to_prometheus(self, prefix: str = 'levior_cache') -> str:
+        """
+        Dump the statistics in the Prometheus text exposition format. The
+        per-rule and per-host counters have their own metric names (e.g:
+        levior_cache_rule_hits_total), so that summing a metric doesn't
+        count an event several times.
+        """
+
+        lines: list = []
+
+        def esc(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n')
+
+        stats = self.as_dict()
+
+        for cfield in fields(CacheCounters):
+            name = f'{prefix}_{cfield.name}_total'
+
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {stats["total"][cfield.name]}')
+
+        for scope, key in [('rules', 'rule'), ('hosts', 'host')]:
+            for cfield in fields(CacheCounters):
+                name = f'{prefix}_{key}_{cfield.name}_total'
+
+                lines.append(f'# TYPE {name} counter')
+
+                for label, counters in stats[scope].items():
+                    lines.append(f'{name}{{{key}="{esc(label)}"}} '
+                                 f'{counters[cfield.name]}')
+
+        ratio = stats['total']['hit_ratio']
+
+        lines.append(f'# TYPE {prefix}_hit_ratio gauge')
+        lines.append(f'{prefix}_hit_ratio '
+                     f'{ratio if ratio is not None else "NaN"}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Statistics of the levior cache
+cache_stats = CacheStats()
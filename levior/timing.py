@@ -0,0 +1,193 @@
+import contextvars
+import logging
+import time
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Dict, Iterator, Optional
+
+import aiohttp
+
+
+# Logger of the requests slower than the slow request threshold
+slow_logger = logging.getLogger('levior.slow')
+
+# Phases of a request, in order
+phases: tuple = (
+    'rule',          # URL rule match
+    'cache_lookup',  # Hot tier and disk cache lookups
+    'dns',           # DNS resolution of the upstream host
+    'connect',       # Connection (and TLS handshake) to the upstream host
+    'ttfb',          # Time to the first byte of the upstream response
+    'download',      # Upstream response body
+    'js_render',     # Javascript rendering (requests-html)
+    'markdownify',   # HTML => Markdown
+    'md2gemini',     # Markdown => gemtext
+    'filters',       # Gemtext filters
+    'write'          # Response write
+)
+
+
+class RequestTimings:
+    """
+    Timing context of a request: the time spent (in seconds) in each
+    phase of the request (see phases), and in the broader fetch and
+    convert steps. The phases of a fetch or a conversion shared with
+    another request (coalesced) are recorded by the leading request only.
+    """
+
+    def __init__(self):
+        self.started: float = time.monotonic()
+        self.finished: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished if self.finished else time.monotonic()) - \
+            self.started
+
+    def add(self, phase: str, duration: float) -> None:
+        if self.finished is None:
+            self.phases[phase] = self.phases.get(phase, 0) + duration
+
+    def get(self, phase: str) -> Optional[float]:
+        return self.phases.get(phase)
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        started = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - started)
+
+    def finish(self) -> float:
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+        return self.elapsed
+
+    def as_dict(self) -> Dict[str, float]:
+        """
+        The time spent in each phase (see phases), in milliseconds
+        """
+
+        return {phase: round(self.phases[phase] * 1000, 2)
+                for phase in phases if phase in self.phases}
+
+    def summary(self) -> str:
+        return ', '.join(f'{phase}: {duration:.0f} ms'
+                         for phase, duration in self.as_dict().items())
+
+
+# Timing context of the request being handled
+current_timings: contextvars.ContextVar = contextvars.ContextVar(
+    'current_timings', default=None)
+
+
+def start() -> contextvars.Token:
+    """
+    Start the timing context of a request. Returns the token to pass to
+    stop() when the request is done.
+    """
+
+    return current_timings.set(RequestTimings())
+
+
+def stop(token: contextvars.Token) -> RequestTimings:
+    rtimings = current_timings.get()
+    rtimings.finish()
+    current_timings.reset(token)
+    return rtimings
+
+
+def timings() -> Optional[RequestTimings]:
+    return current_timings.get()
+
+
+def record(phase: str, duration: float) -> None:
+    """
+    Record the time spent in a phase of the current request (if any)
+    """
+
+    rtimings = current_timings.get()
+
+    if rtimings is not None:
+        rtimings.add(phase, duration)
+
+
+@contextmanager
+def measure(phase: str) -> Iterator[None]:
+    """
+    Measure the time spent in a phase of the current request (if any)
+    """
+
+    rtimings = current_timings.get()
+
+    if rtimings is None:
+        yield
+    else:
+        with rtimings.measure(phase):
+            yield
+
+
+def log_slow_request(url: str,
+                     rtimings: RequestTimings,
+                     threshold: float) -> bool:
+    """
+    Log a request in the slow requests log if it took longer than
+    threshold seconds (0: disabled)
+    """
+
+    if not threshold or rtimings.elapsed < threshold:
+        return False
+
+    slow_logger.warning(f'Slow request: {url} ({rtimings.elapsed:.3f} s): '
+                        f'{rtimings.summary()}')
+    return True
+
+
+async def on_dns_resolvehost_start(session, ctx, params) -> None:
+    ctx.dns_start = time.monotonic()
+
+
+async def on_dns_resolvehost_end(session, ctx, params) -> None:
+    ctx.dns = time.monotonic() - ctx.dns_start
+    record('dns', ctx.dns)
+
+
+async def on_connection_create_start(session, ctx, params) -> None:
+    ctx.connect_start = time.monotonic()
+
+
+async def on_connection_create_end(session, ctx, params) -> None:
+    # The connection time includes the DNS resolution
+    elapsed = time.monotonic() - ctx.connect_start
+    record('connect', max(elapsed - getattr(ctx, 'dns', 0), 0))
+
+
+async def on_request_headers_sent(session, ctx, params) -> None:
+    ctx.headers_sent = time.monotonic()
+
+
+async def on_request_end(session, ctx, params) -> None:
+    # Called when the response's headers are received
+    if getattr(ctx, 'headers_sent', None):
+        record('ttfb', time.monotonic() - ctx.headers_sent)
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    aiohttp trace config recording the DNS, connection and TTFB times of
+    the upstream requests in the timing context of the current request
+    """
+
+    config = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+    config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    config.on_connection_create_start.append(on_connection_create_start)
+    config.on_connection_create_end.append(on_connection_create_end)
+    config.on_request_headers_sent.append(on_request_headers_sent)
+    config.on_request_end.append(on_request_end)
+    return config
@@ -0,0 +1,218 @@
+import asyncio
+import gzip
+import logging
+import time
+import xml.etree.ElementTree as ElementTree
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from yarl import URL
+
+from . import accesslog
+from . import caching
+
+
+logger = logging.getLogger()
+
+
+class WarmupError(Exception):
+    """
+    Raised by a warm-up fetcher when a URL could not be fetched
+    """
+
+
+@dataclass
+class WarmupReport:
+    total: int = 0
+    fetched: int = 0
+    size: int = 0
+    elapsed: float = 0.0
+
+    # Errors by URL
+    failed: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Number of URLs fetched per second
+        """
+        return self.fetched / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bandwidth(self) -> float:
+        """
+        Bytes fetched per second
+        """
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'total': self.total,
+            'fetched': self.fetched,
+            'failed': len(self.failed),
+            'size': self.size,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'bandwidth': self.bandwidth
+        }
+
+
+class HostRateLimiter:
+    """
+    Limit the rate of the requests made to each host (rate requests per
+    second, 0 means no limit). Requests to a host are spaced by 1 / rate
+    seconds.
+    """
+
+    def __init__(self, rate: float = 0):
+        self.interval = 1 / rate if rate and rate > 0 else 0
+        self._next: Dict[str, float] = {}
+
+    async def wait(self, host: Optional[str]) -> None:
+        if not self.interval:
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next.get(host, 0))
+
+        # Reserve the slot before sleeping, the next request to this
+        # host gets the following one
+        self._next[host] = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def warmup_urls_sitemap(data: bytes) -> List[URL]:
+    """
+    Return the URLs of the pages listed in a sitemap (the sitemaps of a
+    sitemap index are not followed)
+    """
+
+    root = ElementTree.fromstring(data)
+
+    if root.tag.endswith('sitemapindex'):
+        logger.warning('Sitemap indexes are not followed, use the sitemaps')
+        return []
+
+    return [URL(elem.text.strip()) for elem in root.iter()
+            if elem.tag.endswith('loc') and elem.text]
+
+
+def warmup_urls_file(path: Union[Path, str]) -> List[URL]:
+    """
+    Read the URLs to warm up from a file: a list of URLs (one per line,
+    lines starting with '#' are ignored), or a sitemap (XML, optionally
+    gzipped)
+    """
+
+    data = Path(path).read_bytes()
+
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+
+    if data.lstrip().startswith(b'<'):
+        return warmup_urls_sitemap(data)
+
+    return [URL(line.strip()) for line in data.decode().splitlines()
+            if line.strip() and not line.lstrip().startswith('#')]
+
+
+def warmup_urls_access_log(cache: caching.CacheBackend,
+                           key: str = None,
+                           lines: int = 10000) -> List[URL]:
+    """
+    Return the URLs of the last lines of the persisted access log, most
+    requested first
+    """
+
+    log = accesslog.load_cached_access_log(cache, key=key, capacity=lines)
+    counts: Dict[str, int] = {}
+
+    for record in log.records():
+        counts[record.url] = counts.get(record.url, 0) + 1
+
+    return [URL(url) for url in sorted(counts, key=lambda u: -counts[u])]
+
+
+def warmup_order(urls: List[URL]) -> List[URL]:
+    """
+    Deduplicate the URLs and interleave them by host (round robin), so
+    that the workers are not all waiting on the rate limit of one host
+    """
+
+    by_host: OrderedDict = OrderedDict()
+
+    for url in OrderedDict.fromkeys(urls):
+        by_host.setdefault(url.host, []).append(url)
+
+    ordered: List[URL] = []
+    queues = [iter(host_urls) for host_urls in by_host.values()]
+
+    while queues:
+        for queue in list(queues):
+            url = next(queue, None)
+
+            if url is None:
+                queues.remove(queue)
+            else:
+                ordered.append(url)
+
+    return ordered
+
+
+async def warm_cache(urls: List[URL],
+                     fetch: Callable[[URL], Awaitable[int]],
+                     concurrency: int = 8,
+                     host_rate: float = 1.0,
+                     progress: Optional[Callable] = None) -> WarmupReport:
+    """
+    Warm up the cache by fetching (and rendering) a list of URLs, with at
+    most concurrency fetches in flight and host_rate requests per second
+    to each host.
+
+    fetch is a coroutine function fetching a URL into the cache and
+    returning the size of the response, it raises WarmupError (or any
+    exception) on failure. progress, if set, is called with the URL and
+    the error (None on success) after each fetch.
+    """
+
+    queue: asyncio.Queue = asyncio.Queue()
+    limiter = HostRateLimiter(host_rate)
+    report = WarmupReport()
+
+    for url in warmup_order(urls):
+        queue.put_nowait(url)
+
+    report.total = queue.qsize()
+
+    async def worker() -> None:
+        while not queue.empty():
+            url = queue.get_nowait()
+            error: Optional[str] = None
+
+            await limiter.wait(url.host)
+
+            try:
+                report.size += await fetch(url)
+                report.fetched += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                error = str(err) or err.__class__.__name__
+                report.failed[str(url)] = error
+
+            if progress:
+                progress(url, error)
+
+    started = time.monotonic()
+
+    await asyncio.gather(*[worker() for _ in range(
+        max(1, min(concurrency, report.total)))])
+
+    report.elapsed = time.monotonic() - started
+    return report
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+from omegaconf import DictConfig
+
+from .metrics import metrics
+
+
+# Logger of the event loop stalls (diagnostics log)
+stall_logger = logging.getLogger('levior.stalls')
+
+# Directory of the levior package (to find the levior frames of a stack)
+package_dir: str = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Stall:
+    """
+    A stall of the event loop: a callback blocked the loop for duration
+    seconds. stack is the stack of the loop's thread while it was blocked.
+    """
+
+    time: float
+    duration: float
+    location: str
+    stack: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        return {
+            'time': self.time,
+            'duration': self.duration,
+            'location': self.location,
+            'stack': self.stack
+        }
+
+    def gemtext(self) -> str:
+        sdt = datetime.fromtimestamp(self.time).strftime('%d/%b/%Y %H:%M:%S')
+
+        return f'## [{sdt}] {self.duration * 1000:.0f} ms: ' \
+            f'{self.location}\n```\n{"".join(self.stack).rstrip()}\n```\n'
+
+
+def stall_location(frames: traceback.StackSummary) -> str:
+    """
+    Return where the loop is blocked: the innermost levior frame, and the
+    innermost frame if it's not in levior (e.g: in diskcache)
+    """
+
+    def fmt(frame: traceback.FrameSummary) -> str:
+        return f'{frame.name} ({os.path.basename(frame.filename)}:' \
+            f'{frame.lineno})'
+
+    if not frames:
+        return 'unknown'
+
+    ours = [frame for frame in frames
+            if frame.filename.startswith(package_dir) and
+            os.path.basename(frame.filename) != 'watchdog.py']
+
+    if not ours:
+        return fmt(frames[-1])
+    elif ours[-1] is frames[-1]:
+        return fmt(ours[-1])
+
+    return f'{fmt(ours[-1])} -> {fmt(frames[-1])}'
+
+
+class StallWatchdog:
+    """
+    Event loop watchdog: a heartbeat task measures the loop lag
+    continuously, and a monitor thread records the stack of the loop's
+    thread when the loop hasn't run the heartbeat for longer than the
+    threshold (a callback is blocking the loop: a conversion, a cache
+    operation, an RDF graph write, etc). The stalls are logged to the
+    levior.stalls logger, and the last ones are kept in memory.
+    """
+
+    def __init__(self, threshold: float = 0.25, history: int = 50):
+        self.threshold = threshold
+        self.interval: float = min(threshold / 2, 0.1)
+        self.stalls: deque = deque(maxlen=history)
+        self.count: int = 0
+
+        self._beat: Optional[float] = None
+        self._captured: Optional[float] = None
+        self._current: Optional[Stall] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def configure(self, config: DictConfig) -> None:
+        """
+        Configure the watchdog: stalls longer than stall_threshold
+        milliseconds are recorded, the last stall_history ones are kept
+        """
+
+        self.threshold = config.get('stall_threshold', 250) / 1000
+        self.interval = min(self.threshold / 2, 0.1)
+        self.stalls = deque(self.stalls,
+                            maxlen=config.get('stall_history', 50))
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Start the watchdog. Must be called from the thread running loop.
+        """
+
+        if self.enabled:
+            return
+
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._task = loop.create_task(self.heartbeat())
+        self._thread = threading.Thread(target=self.monitor,
+                                        name='levior-watchdog',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+        if self._task is not None:
+            self._task.cancel()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self._thread, self._task, self._beat = None, None, None
+
+    async def heartbeat(self) -> None:
+        while True:
+            self._beat = started = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            lag = max(time.monotonic() - started - self.interval, 0)
+            metrics.observe_lag(lag)
+
+            with self._lock:
+                stall, self._current = self._current, None
+
+            if stall is not None:
+                stall.duration = lag
+                self.record(stall)
+
+    def record(self, stall: Stall) -> None:
+        self.stalls.append(stall)
+        self.count += 1
+
+        stall_logger.warning(
+            f'Event loop blocked for {stall.duration * 1000:.0f} ms in '
+            f'{stall.location}:\n{"".join(stall.stack).rstrip()}')
+
+    def monitor(self) -> None:
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+
+            if beat is None or beat == self._captured:
+                continue
+
+            late = time.monotonic() - beat - self.interval
+
+            if late < self.threshold:
+                continue
+
+            # The loop is blocked: capture the stack of its thread
+            self._captured = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            frames = traceback.extract_stack(frame) if frame else \
+                traceback.StackSummary()
+
+            with self._lock:
+                self._current = Stall(
+                    time=time.time() - late,
+                    duration=late,
+                    location=stall_location(frames),
+                    stack=frames.format()
+                )
+
+    def as_dict(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'threshold': self.threshold,
+            'count': self.count,
+            'stalls': [stall.as_dict() for stall in self.stalls]
+        }
+
+
+# Event loop watchdog (disabled until it's started)
+watchdog = StallWatchdog()
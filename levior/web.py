@@ -1,6 +1,12 @@
-from typing import Union, Optional, List
+import asyncio
+import logging
+import threading
+
+from typing import Union, Optional, List, Dict, Tuple
 from yarl import URL
 
+import aiohttp
+from omegaconf import DictConfig
 from omegaconf import ListConfig
 
 from random_user_agent.user_agent import UserAgent
@@ -12,6 +18,10 @@ from random_user_agent.params import HardwareType
 
 from aiohttp_socks import ProxyConnector, ChainProxyConnector
 
+from . import timing
+
+
+logger = logging.getLogger()
 
 user_agent_rotator = UserAgent(
     software_types=[SoftwareType.WEB_BROWSER.value],
@@ -91,16 +101,147 @@ def valid_proxy_url(url: Union[URL, str, None]) -> bool:
 
 def get_proxy_connector(
         proxy_url: Optional[Union[List[str], ListConfig, URL, str]] = None,
-        proxy_chain: Optional[List[str]] = []
-) -> Union[ProxyConnector, ChainProxyConnector, None]:
+        proxy_chain: Optional[List[str]] = [],
+        **kwargs) -> Union[ProxyConnector, ChainProxyConnector, None]:
+    """
+    Return a proxy connector for a proxy URL or a proxy chain. Extra
+    keyword arguments are passed to the underlying TCP connector.
+    """
     if isinstance(proxy_url, (ListConfig, list)):
         return ChainProxyConnector.from_urls([
             url for url in proxy_url if isinstance(url, str) and
             valid_proxy_url(url)
-        ])
+        ], **kwargs)
     elif isinstance(proxy_url, (str, URL)) and valid_proxy_url(proxy_url):
         return ProxyConnector.from_url(
-            str(proxy_url) if isinstance(proxy_url, URL) else proxy_url
+            str(proxy_url) if isinstance(proxy_url, URL) else proxy_url,
+            **kwargs
         )
     else:
         return None
+
+
+# Long-lived HTTP client sessions, keyed by (proxy key, verify_ssl, trace)
+client_sessions: Dict[Tuple, Tuple[aiohttp.ClientSession,
+                                   asyncio.AbstractEventLoop]] = {}
+
+
+def proxy_key(proxy_url: Optional[Union[List[str], ListConfig,
+                                        URL, str]] = None) -> tuple:
+    """
+    Return a hashable key identifying a proxy URL or a proxy chain
+    """
+    if isinstance(proxy_url, (ListConfig, list)):
+        return tuple(str(url) for url in proxy_url)
+    elif isinstance(proxy_url, (str, URL)) and valid_proxy_url(proxy_url):
+        return (str(proxy_url), )
+
+    return ()
+
+
+def connector_options(config: Optional[DictConfig] = None) -> dict:
+    """
+    Return the TCP connector options (connection limits, keep-alive idle
+    timeout, DNS cache lifetime) from the levior config.
+    """
+    cfg = config if config is not None else {}
+
+    return {
+        'limit': cfg.get('http_pool_limit', 100),
+        'limit_per_host': cfg.get('http_pool_limit_per_host', 8),
+        'keepalive_timeout': cfg.get('http_keepalive_timeout', 30),
+        'ttl_dns_cache': cfg.get('http_dns_cache_ttl', 300),
+        'use_dns_cache': True,
+        'enable_cleanup_closed': True
+    }
+
+
+def get_client_session(
+        config: Optional[DictConfig] = None,
+        proxy_url: Optional[Union[List[str], ListConfig, URL, str]] = None,
+        verify_ssl: bool = True,
+        trace_configs: Optional[List[aiohttp.TraceConfig]] = None
+) -> aiohttp.ClientSession:
+    """
+    Return the pooled aiohttp session for this proxy configuration,
+    creating it if needed. Sessions keep their connections alive and
+    reuse the DNS cache and TLS sessions across requests. They don't
+    keep cookies: the sessions are shared by all the clients.
+
+    :param DictConfig config: Levior config (connector options)
+    :param proxy_url: Proxy URL or proxy chain
+    :param bool verify_ssl: Verify SSL certificate validity
+    :rtype: aiohttp.ClientSession
+    """
+
+    loop = asyncio.get_running_loop()
+    key = (proxy_key(proxy_url), verify_ssl, bool(trace_configs))
+    entry = client_sessions.get(key)
+
+    if entry:
+        session, sloop = entry
+
+        if not session.closed and sloop is loop:
+            return session
+
+        close_session(session, sloop)
+
+    opts = connector_options(config)
+
+    if not verify_ssl:
+        opts['ssl'] = False
+
+    connector = get_proxy_connector(proxy_url, **opts)
+
+    if connector is None:
+        connector = aiohttp.TCPConnector(**opts)
+
+    session = aiohttp.ClientSession(
+        connector=connector,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        trace_configs=[timing.trace_config()] + (
+            trace_configs if trace_configs else [])
+    )
+
+    client_sessions[key] = (session, loop)
+
+    logger.debug(f'HTTP session created for proxy: {key[0] or "none"}')
+
+    return session
+
+
+def close_session(session: aiohttp.ClientSession,
+                  sloop: asyncio.AbstractEventLoop) -> None:
+    """
+    Close a session bound to another event loop, on its loop (the loop
+    is run in a thread if it's stopped). If the loop is closed, only the
+    connector's transports can be closed.
+    """
+
+    if session.closed:
+        return
+    elif sloop.is_closed():
+        # No public synchronous API to close a connector
+        session.connector._close()
+    elif sloop.is_running():
+        asyncio.run_coroutine_threadsafe(session.close(), sloop)
+    else:
+        thread = threading.Thread(target=sloop.run_until_complete,
+                                  args=(session.close(), ))
+        thread.start()
+        thread.join()
+
+
+async def close_client_sessions() -> None:
+    """
+    Close all the pooled HTTP client sessions
+    """
+
+    for key, (session, sloop) in list(client_sessions.items()):
+        if sloop is asyncio.get_running_loop():
+            if not session.closed:
+                await session.close()
+        else:
+            close_session(session, sloop)
+
+        del client_sessions[key]
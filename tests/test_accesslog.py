@@ -0,0 +1,175 @@
+import asyncio
+import io
+import time
+
+import pytest
+
+from omegaconf import OmegaConf
+
+from levior import accesslog
+from levior import caching
+from levior.accesslog import AccessLog
+from levior.accesslog import AccessLogDB
+from levior.accesslog import AccessLogStore
+from levior.accesslog import AccessRecord
+
+
+def record(idx: int, **kwargs) -> AccessRecord:
+    return AccessRecord(**dict(dict(time=1700000000 + idx,
+                                    url=f'gemini://localhost/{idx}',
+                                    host='example.org',
+                                    status=20), **kwargs))
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return caching.configure_cache(OmegaConf.create({
+        'cache_eviction_policy': 'least-recently-used',
+        'cache_path': str(tmpdir.join('diskcache')),
+        'cache_size_limit': int(1e6)
+    }))
+
+
+class TestAccessLog:
+    def test_ring_buffer(self):
+        log = AccessLog(capacity=3)
+
+        for idx in range(5):
+            log.append(record(idx))
+
+        assert len(log) == 3
+        assert [rec.url for rec in log.records()] == [
+            f'gemini://localhost/{idx}' for idx in range(2, 5)]
+        assert log.pending == 3
+        assert log.drain() == [record(idx) for idx in range(2, 5)]
+        assert log.pending == 0
+
+        log.restore([record(5)])
+        assert log.pending == 0
+        assert list(log.emit_trim_gmi())[-1].startswith(
+            '=> gemini://localhost/5  [')
+
+    def test_record(self):
+        rec = record(1, client='127.0.0.1', ctype='text/gemini', size=512,
+                     title='Page', outcome='miss', fetch_time=0.25,
+                     duration=0.3, timings={'rule': 0.1})
+        gemline = rec.gemtext()
+
+        assert gemline.startswith('=> gemini://localhost/1  [')
+        assert gemline.endswith('] Page (origin: 127.0.0.1, status: 20, '
+                                'ctype: text/gemini, size: 512, '
+                                'cache: miss, fetch: 250 ms, '
+                                'duration: 300 ms)')
+
+        assert AccessRecord.from_line(rec.to_json()) == rec
+        assert AccessRecord.from_line('garbage') is None
+
+        # Gemtext line written by an older version
+        old = AccessRecord.from_line(
+            '=> https://b.org/  [01/Jan/2024 10:00:01] B (origin: 1.2.3.4, '
+            'status: 51, ctype: None)')
+        assert old.host == 'b.org'
+        assert old.status == 51
+        assert old.title == 'B'
+        assert old.ctype is None
+
+        assert rec.matches(host='example.org', status=2, since=1700000001)
+        assert not rec.matches(status=5)
+        assert not rec.matches(until=1700000001)
+
+    def test_query(self, tmpdir):
+        records = [record(idx, host=f'host{idx % 2}.org',
+                          status=20 if idx % 3 else 51)
+                   for idx in range(10)]
+        records[-1].duration = 0.25
+        records[-1].timings = {'rule': 0.05, 'write': 0.1}
+        log = AccessLog()
+        log.restore(records[2:])
+        db = AccessLogDB(str(tmpdir.join('requests.db')), max_rows=8)
+        db.add(records)
+
+        # The oldest records are removed from the database
+        assert db.count() == 8
+        assert [rec.url for rec in db.query(limit=3)] == [
+            f'gemini://localhost/{idx}' for idx in [9, 8, 7]]
+        assert db.query(limit=1)[0] == records[-1]
+
+        for source in [db, log]:
+            assert source.count(host='host1.org') == 4
+            assert [rec.url for rec in source.query(
+                host='host0.org', status=5)] == [
+                'gemini://localhost/6']
+            assert [rec.url for rec in source.query(
+                since=1700000004, until=1700000006)] == [
+                'gemini://localhost/5', 'gemini://localhost/4']
+            assert len(source.query(offset=2, limit=2, status=20)) == 2
+
+        db.close()
+
+    def test_store(self, tmpdir):
+        store = AccessLogStore(str(tmpdir.join('log')), segment_size=100,
+                               max_segments=2)
+        lines = [f'=> /page/{idx}  [01/Jan/2024 10:00:00]'
+                 for idx in range(20)]
+
+        for idx in range(0, 20, 2):
+            store.append(lines[idx:idx + 2])
+
+        # Rotated (and gzipped) segments, the oldest ones are removed
+        rotated = store.rotated()
+        assert len(rotated) == 2
+        assert all(path.suffix == '.gz' for path in rotated)
+
+        assert store.tail(3) == lines[-3:]
+        tail = store.tail(100)
+        assert tail == lines[-len(tail):]
+        assert len(tail) < 20
+
+        store = AccessLogStore(str(tmpdir.join('plain')), segment_size=100,
+                               compress=False)
+        store.append(lines[:10])
+        assert store.rotated()[0].suffix == '.log'
+        assert store.tail(10) == lines[:10]
+        assert store.tail(0) == []
+
+    def test_access_log_cache(self, cache):
+        log = AccessLog()
+        log.append(AccessRecord(time=time.time(), url='/', status=20,
+                                host='a.org', title='Test'))
+        log.append(AccessRecord(time=time.time(), url='/doc', status=51,
+                                host='b.org'))
+
+        assert accesslog.persist_access_log(cache, log) == 2
+        assert accesslog.persist_access_log(cache, log) == 0
+
+        clog = accesslog.load_cached_access_log(cache)
+        assert len(clog) == 2
+        assert clog.pending == 0
+        assert clog.records()[0].title == 'Test'
+
+        db = accesslog.access_log_db(cache)
+        assert db.count() == 2
+        assert db.query(status=51)[0].url == '/doc'
+
+        # Access log stored in the diskcache by older versions
+        cache.set('legacy_log', io.BytesIO(
+            b'=> /a  [01/Jan/2024 10:00:00] A\n=> /b B\n'), read=True)
+        assert [rec.url for rec in accesslog.load_cached_access_log(
+            cache, key='legacy_log').records()] == ['/a', '/b']
+        assert 'legacy_log' not in cache
+        assert len(accesslog.load_cached_access_log(
+            cache, key='legacy_log')) == 2
+        assert accesslog.access_log_db(cache, key='legacy_log').count() == 2
+
+    @pytest.mark.asyncio
+    async def test_persist_task(self, cache):
+        doc = AccessLog()
+        doc.append(AccessRecord(time=time.time(), url='/', status=20))
+        task = asyncio.create_task(
+            accesslog.cache_persist_task(cache, doc)
+        )
+        await asyncio.sleep(5)
+        task.cancel()
+
+        assert doc.pending == 0
+        assert len(accesslog.load_cached_access_log(cache)) == 1
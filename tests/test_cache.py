@@ -1,14 +1,22 @@
 import asyncio
 import pytest
 import os.path
+import time
+
+import diskcache
+from datetime import datetime
+from datetime import timedelta
 
 from freezegun import freeze_time
 
 from yarl import URL
 from omegaconf import OmegaConf
-from trimgmi import Document as GmiDocument
 
+from levior import accesslog
 from levior import caching
+from levior import handler
+from levior.accesslog import AccessLog
+from levior.accesslog import AccessRecord
 
 
 @pytest.fixture
@@ -79,21 +87,445 @@ class TestCaching:
             ft.tick(86400 * 365)
             assert cache.get(caching.cache_key_for_url(url)) is not None
 
-    def test_access_log_cache(self, cache):
-        log = GmiDocument()
-        log.append('=> / Test')
-        log.append('=> /doc Doc')
+    def test_rendered_cache(self, cache):
+        url = URL('https://example.org/page.html')
+        config = OmegaConf.create({'links_mode': 'paragraph', 'port': 1965})
+        fp = caching.url_config_fingerprint(config, {'feathers': 2},
+                                            proxy_mode=True)
+
+        assert fp == caching.url_config_fingerprint(
+            config, {'feathers': 2, 'ttl': 60}, proxy_mode=True)
+        assert fp != caching.url_config_fingerprint(
+            config, {'feathers': 3}, proxy_mode=True)
+        assert fp != caching.url_config_fingerprint(
+            config, {'feathers': 2}, proxy_mode=False)
+
+        # Not stored if the raw content is not cached
+        assert caching.cache_rendered(cache, url, fp, '# Page') is False
+
+        with freeze_time("2024-02-14 12:00:00") as ft:
+            caching.cache_resource(cache, url, 'text/html', '<p></p>', ttl=60)
+            assert caching.cache_rendered(cache, url, fp, '# Page', 'Page')
+            assert caching.get_rendered(cache, url, fp) == ('# Page', 'Page')
+
+            # Bound to the version of the raw content
+            meta = caching.get_resource(cache, url)[2]
+            assert caching.get_rendered(cache, url, fp, meta=meta) == (
+                '# Page', 'Page')
+
+            # The rendered entry expires with the raw content
+            ft.tick(61)
+            assert caching.get_rendered(cache, url, fp) is None
+
+            # Not stored if the raw content was evicted
+            other = URL('https://example.org/other.html')
+            caching.cache_resource(cache, other, 'text/html', '<p></p>')
+            del cache[caching.cache_key_for_url(other)]
+            assert caching.cache_rendered(cache, other, fp, '# P') is False
+
+    def test_stale_resource(self, cache):
+        url = URL('https://example.org/stale.html')
+        fp = caching.url_config_fingerprint(
+            OmegaConf.create({'port': 1965}), {})
+
+        with freeze_time("2024-02-14 12:00:00") as ft:
+            assert caching.cache_resource(
+                cache, url, 'text/html', '<p>1</p>', ttl=60, stale_ttl=600)
+            _, data, meta = caching.get_resource(cache, url)
+            assert not caching.resource_stale(meta)
+            assert caching.cache_rendered(cache, url, fp, '1')
+
+            # Expired, but kept in the cache for the stale window
+            ft.tick(120)
+            _, data, meta = caching.get_resource(cache, url)
+            assert data == '<p>1</p>'
+            assert caching.resource_stale(meta)
+            assert caching.get_rendered(cache, url, fp, meta=meta) == (
+                '1', None)
+
+            # The rendered gemtext of the old version is not served
+            ft.tick(1)
+            caching.cache_resource(
+                cache, url, 'text/html', '<p>2</p>', ttl=60, stale_ttl=600)
+            _, data, meta = caching.get_resource(cache, url)
+            assert not caching.resource_stale(meta)
+            assert caching.get_rendered(cache, url, fp, meta=meta) is None
+
+            ft.tick(700)
+            assert caching.get_resource(cache, url) is None
+
+        # No stale window for resources cached forever
+        assert caching.stale_lifetime(None, 600) is None
+        assert caching.stale_lifetime(60, None) == 60
+
+    @pytest.mark.asyncio
+    async def test_background_revalidation(self, cache, monkeypatch,
+                                           caplog):
+        url = URL('https://example.org/stale.html')
+        started = asyncio.Event()
+
+        async def revalidate(*args, **kwargs):
+            started.set()
+            await asyncio.sleep(0.05)
+            raise ValueError('upstream down')
+
+        monkeypatch.setattr(handler, 'revalidate_resource', revalidate)
+        monkeypatch.setattr(handler, 'stale_serve_mode',
+                            lambda *args: 'revalidate')
+
+        caching.cache_resource(cache, url, 'text/html', '<p>1</p>',
+                               ttl=-1)
+        monkeypatch.setattr(caching, 'resource_stale', lambda meta: True)
 
-        assert caching.persist_access_log(cache, log) is True
+        cached, stale = await handler.lookup_cached(
+            OmegaConf.create({}), cache, {}, url, [url])
+        assert cached is not None and stale is None
 
-        clog = caching.load_cached_access_log(cache)
-        assert len(clog._lines) == 2
+        # The revalidation task is referenced until it's done, and its
+        # exception is logged
+        await started.wait()
+        assert len(handler.background_jobs) == 1
+
+        await asyncio.gather(*handler.background_jobs,
+                             return_exceptions=True)
+        await asyncio.sleep(0)
+        assert not handler.background_jobs
+        assert 'upstream down' in caplog.text
+
+    def test_validators(self, cache):
+        assert caching.parse_cache_control(
+            'public, max-age=600, s-maxage="60", no-transform') == {
+                'public': True,
+                'max-age': '600',
+                's-maxage': '60',
+                'no-transform': True
+        }
+
+        validators = caching.response_validators({
+            'ETag': '"abc"',
+            'Last-Modified': 'Wed, 14 Feb 2024 12:00:00 GMT',
+            'Cache-Control': 'max-age=3600'
+        })
+        assert validators == {
+            'etag': '"abc"',
+            'last_modified': 'Wed, 14 Feb 2024 12:00:00 GMT',
+            'max_age': 3600
+        }
+        assert caching.response_validators({'Cache-Control': 'no-cache'}) \
+            == {}
+        assert not caching.revalidable({'max_age': 60})
+
+        url = URL('https://example.org/validators.html')
+
+        with freeze_time("2024-02-14 12:00:00") as ft:
+            caching.cache_resource(cache, url, 'text/html', '<p></p>',
+                                   ttl=60, stale_ttl=600,
+                                   validators=validators)
+            _, _, meta = caching.get_resource(cache, url)
+            assert caching.conditional_fetch_args(meta) == {
+                'etag': '"abc"',
+                'last_modified': 'Wed, 14 Feb 2024 12:00:00 GMT'
+            }
+
+            # Not modified: fresh again, the content version is unchanged
+            ft.tick(120)
+            assert caching.resource_stale(meta)
+            assert caching.cache_update_expiration(cache, url, 60,
+                                                   stale_ttl=600)
+            _, data, nmeta = caching.get_resource(cache, url)
+            assert data == '<p></p>'
+            assert not caching.resource_stale(nmeta)
+            assert caching.raw_version(nmeta) == caching.raw_version(meta)
+
+        assert caching.conditional_fetch_args(None) == {}
+        assert caching.cache_update_expiration(
+            cache, URL('https://example.org/notcached'), 60) is False
+
+    @pytest.mark.parametrize('headers,ttl', [
+        ({'Cache-Control': 'public, max-age=600'}, 600),
+        ({'Cache-Control': 'max-age=600, s-maxage=1200'}, 1200),
+        ({'Cache-Control': 'max-age=600', 'Age': '100'}, 500),
+        ({'Cache-Control': 'max-age=999999'}, 86400),
+        ({'Cache-Control': 'max-age=5'}, 10),
+        ({'Cache-Control': 'no-cache'}, 10),
+        ({'Cache-Control': 'no-store'}, None),
+        ({'Cache-Control': 'private, max-age=600'}, None),
+        ({'Cache-Control': 'max-age=600', 'Vary': '*'}, None),
+        ({'Date': 'Wed, 14 Feb 2024 12:00:00 GMT',
+          'Expires': 'Wed, 14 Feb 2024 12:30:00 GMT'}, 1800),
+        ({'Date': 'Wed, 14 Feb 2024 12:00:00 GMT',
+          'Expires': '0'}, 10),
+        ({'Date': 'Wed, 14 Feb 2024 12:00:00 GMT',
+          'Last-Modified': 'Wed, 14 Feb 2024 07:00:00 GMT'}, 1800),
+        ({}, 300)
+    ])
+    def test_http_cache_ttl(self, headers, ttl):
+        assert caching.http_cache_ttl(headers, default=300, ttl_min=10,
+                                      ttl_max=86400) == ttl
+
+    def test_http_cache_ttl_forever(self):
+        assert caching.http_cache_ttl({}, default=-1) == -1
+        assert caching.http_cache_ttl(
+            {'Cache-Control': 'max-age=60'}, default=-1) == 60
 
     @pytest.mark.asyncio
-    async def test_persist_task(self, cache):
-        doc = GmiDocument()
-        doc._scount = 1
-        asyncio.create_task(
-            caching.cache_persist_task(cache, doc)
-        )
-        await asyncio.sleep(5)
+    async def test_cache_resource_file(self, cache, tmpdir):
+        url = URL('https://example.org/video.webm')
+        path = tmpdir.join('video.webm')
+        path.write_binary(b'0123456789' * 10000)
+
+        with open(str(path), 'rb') as fd:
+            assert caching.cache_resource_file(
+                cache, url, 'video/webm', fd, ttl=60) is True
+
+        ctype, body, meta = caching.get_resource(cache, url)
+        assert ctype == 'video/webm'
+        assert isinstance(body, caching.FileBody)
+
+        data = b''
+        async for chunk in body.iter_chunks():
+            data += chunk
+
+        body.release()
+        assert data == b'0123456789' * 10000
+
+        # Blob entries are internal
+        assert any(key.startswith(caching.internal_key_prefixes)
+                   for key in cache.iterkeys())
+
+    def test_cache_index(self, cache):
+        index = caching.cache_index(cache)
+        assert caching.cache_index(cache) is index
+
+        with freeze_time("2024-02-14 12:00:00") as ft:
+            caching.cache_resource(cache, URL('https://a.org/page.html'),
+                                   'text/html', '<p>' * 100, ttl=60)
+            caching.cache_resource(cache, URL('https://b.org/img.png'),
+                                   'image/png', b'0' * 2000, ttl=600)
+            caching.cache_resource(cache, URL('https://b.org/doc.txt'),
+                                   'text/plain', 'doc')
+
+            assert index.count() == 3
+            assert [e['url'] for e in index.query(host='b.org')] == [
+                'https://b.org/doc.txt', 'https://b.org/img.png']
+            assert [e['url'] for e in index.query(ctype='image')] == [
+                'https://b.org/img.png']
+            assert [e['url'] for e in index.query(min_size=1000)] == [
+                'https://b.org/img.png']
+            assert len(index.query(limit=2)) == 2
+            assert len(index.query(offset=2, limit=2)) == 1
+
+            caching.get_resource(cache, URL('https://a.org/page.html'))
+            caching.get_resource(cache, URL('https://a.org/page.html'))
+
+            # Hits are counted in memory until the index is flushed
+            assert index.query(host='a.org')[0]['hits'] == 0
+            caching.flush_index(cache)
+            assert index.query(host='a.org')[0]['hits'] == 2
+
+            caching.cache_update_expiration(
+                cache, URL('https://a.org/page.html'), 300)
+            ft.tick(120)
+            assert index.count() == 3
+
+            ft.tick(200)
+            assert index.count() == 2
+            assert index.purge_expired() == 1
+
+            caching.uncache_resource(cache, URL('https://b.org/doc.txt'))
+            assert index.count() == 1
+
+            # The index is rebuilt from the cache
+            index.close()
+            os.remove(index.path)
+            del caching.cache_indexes[cache.directory]
+
+            assert caching.cache_index(cache).count(host='b.org') == 1
+
+    def test_cache_index_flush(self, cache):
+        index = caching.cache_index(cache)
+        url = URL('https://a.org/page')
+
+        caching.cache_resource(cache, url, 'text/plain', 'a', ttl=60)
+        del cache[caching.cache_key_for_url(url)]
+        assert caching.get_resource(cache, url) is None
+
+        # Stored again before the flush: the entry is kept
+        caching.cache_resource(cache, url, 'text/plain', 'b', ttl=60)
+        assert caching.flush_index(cache) == 0
+        assert index.count(host='a.org') == 1
+
+        del cache[caching.cache_key_for_url(url)]
+        assert caching.get_resource(cache, url) is None
+        assert index.count(host='a.org') == 1
+        assert caching.flush_index(cache) == 1
+        assert index.count(host='a.org') == 0
+
+    def test_sharded_cache(self, cache, tmpdir):
+        url = URL('https://example.org/page')
+        blob_url = URL('https://example.org/file.bin')
+        blob_path = tmpdir.join('file.bin')
+        blob_path.write_binary(b'0' * 4096)
+
+        caching.cache_resource(cache, url, 'text/plain', 'hello', ttl=600)
+        caching.cache_resource(cache, URL('https://example.org/expired'),
+                               'text/plain', 'bye', ttl=1)
+
+        with open(str(blob_path), 'rb') as fd:
+            caching.cache_resource_file(cache, blob_url,
+                                        'application/octet-stream', fd,
+                                        ttl=600)
+
+        log = AccessLog()
+        log.append(AccessRecord(time=time.time(), url='/', status=20))
+        accesslog.persist_access_log(cache, log)
+        cache.close()
+
+        with freeze_time(datetime.now() + timedelta(seconds=60)):
+            sharded = caching.configure_cache(OmegaConf.create({
+                'cache_eviction_policy': 'least-recently-used',
+                'cache_path': cache.directory,
+                'cache_size_limit': 8,
+                'cache_shards': 4
+            }))
+
+            assert isinstance(sharded, diskcache.FanoutCache)
+            assert not os.path.exists(
+                os.path.join(cache.directory, diskcache.core.DBNAME))
+            # The access log is stored out of the diskcache
+            assert len(sharded) == 3
+            assert caching.cache_size_limit(sharded) == 8 * 1024 * 1024
+
+            assert caching.get_resource(sharded, url)[1] == 'hello'
+            assert caching.get_resource(
+                sharded, URL('https://example.org/expired')) is None
+
+            ctype, body, meta = caching.get_resource(sharded, blob_url)
+            assert body.fd.read() == b'0' * 4096
+            body.release()
+
+            assert len(accesslog.load_cached_access_log(sharded)) == 1
+
+            assert caching.cache_update_expiration(sharded, url, 3600)
+            assert caching.get_resource(sharded, url)[2]['fresh_until'] > \
+                time.time() + 3000
+
+    @pytest.mark.parametrize('codec', [
+        'zlib',
+        pytest.param('zstd', marks=pytest.mark.skipif(
+            not caching.have_zstd, reason='zstandard is not installed'))
+    ])
+    def test_compression(self, cache, codec):
+        page = '<html><body>' + '<p>Hello</p>' * 500 + '</body></html>'
+        url = URL('https://example.org/page')
+        old_url = URL('https://example.org/old')
+
+        # Stored before compression is enabled
+        caching.cache_resource(cache, old_url, 'text/html', page, ttl=60)
+
+        try:
+            assert caching.configure_compression(OmegaConf.create({
+                'cache_compression': codec,
+                'cache_compression_min_size': 2048
+            })) == codec
+
+            caching.cache_resource(cache, url, 'text/html', page, ttl=60)
+            caching.cache_resource(cache, URL('https://example.org/img'),
+                                   'image/png', os.urandom(4096), ttl=60)
+            caching.cache_resource(cache, URL('https://example.org/small'),
+                                   'text/plain', 'a' * 100, ttl=60)
+
+            stored = cache.get(caching.cache_key_for_url(url))
+            assert stored[2]['codec'] == codec
+            assert stored[2]['size'] == len(page)
+            assert len(stored[1]) < len(page) / 10
+
+            # Incompressible, or below the size threshold: stored raw
+            for path in ['img', 'small']:
+                assert 'codec' not in cache.get(
+                    f'https://example.org/{path}')[2]
+
+            assert caching.get_resource(cache, url)[1] == page
+            assert caching.get_resource(cache, old_url)[1] == page
+
+            caching.cache_resource(cache, url, 'text/html', page.encode(),
+                                   ttl=60)
+            assert caching.get_resource(cache, url)[1] == page.encode()
+
+            assert caching.cache_index(cache).query(
+                host='example.org', min_size=len(page))
+        finally:
+            caching.configure_compression(OmegaConf.create({}))
+
+        # Compressed entries are readable with compression disabled
+        assert caching.get_resource(cache, url)[1] == page.encode()
+
+    def test_dedup(self, cache, tmpdir):
+        image = os.urandom(32768)
+        urls = [URL(f'https://example.org/{idx}.png') for idx in range(3)]
+        index = caching.cache_index(cache)
+
+        def contents() -> list:
+            return [key for key in cache.iterkeys()
+                    if key.startswith(caching.content_key_prefix)]
+
+        try:
+            assert caching.configure_dedup(OmegaConf.create({
+                'cache_dedup': True,
+                'cache_dedup_min_size': 1024
+            })) is True
+
+            for url in urls:
+                caching.cache_resource(cache, url, 'image/png', image, ttl=60)
+
+            # Stored once, referenced by the 3 URLs
+            assert len(contents()) == 1
+            assert index.content_refs(contents()[0]) == 3
+
+            for url in urls:
+                ctype, data, meta = caching.get_resource(cache, url)
+                assert data == image
+                assert cache.get(caching.cache_key_for_url(url))[1] is None
+
+            # Small bodies and HTML pages are not deduplicated
+            caching.cache_resource(cache, URL('https://example.org/page'),
+                                   'text/html', 'a' * 4096, ttl=60)
+            caching.cache_resource(cache, URL('https://example.org/small'),
+                                   'image/png', b'a' * 100, ttl=60)
+            assert len(contents()) == 1
+
+            # The content is removed with its last reference
+            caching.uncache_resource(cache, urls[0])
+            caching.cache_resource(cache, urls[1], 'image/png', b'b' * 2048,
+                                   ttl=60)
+            assert len(contents()) == 2
+            caching.cache_resource(cache, urls[2], 'image/png', b'b' * 2048,
+                                   ttl=60)
+            assert len(contents()) == 1
+            assert caching.get_resource(cache, urls[2])[1] == b'b' * 2048
+
+            # File bodies
+            path = tmpdir.join('video.webm')
+            path.write_binary(b'0123456789' * 1000)
+
+            for url in urls[:2]:
+                with open(str(path), 'rb') as fd:
+                    assert caching.cache_resource_file(
+                        cache, url, 'video/webm', fd, ttl=60) is True
+
+            assert len(contents()) == 2
+            body = caching.get_resource(cache, urls[0])[1]
+            assert isinstance(body, caching.FileBody)
+            body.release()
+
+            # Orphaned contents (their references were evicted)
+            caching.cache_resource(cache, URL('https://example.org/orphan'),
+                                   'image/png', b'c' * 2048, ttl=60)
+            del cache['https://example.org/orphan']
+            index.remove('https://example.org/orphan')
+
+            assert len(contents()) == 3
+            assert caching.gc_contents(cache) == 1
+            assert len(contents()) == 2
+        finally:
+            caching.configure_dedup(OmegaConf.create({}))
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+from yarl import URL
+from omegaconf import OmegaConf
+
+from levior import cacheio
+from levior import caching
+from levior.stats import LatencyHistogram
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return caching.configure_cache(OmegaConf.create({
+        'cache_eviction_policy': 'least-recently-used',
+        'cache_path': str(tmpdir.join('diskcache')),
+        'cache_size_limit': int(1e6)
+    }))
+
+
+class TestCacheIO:
+    def test_histogram(self):
+        hist = LatencyHistogram(buckets=(0.01, 0.1, 1.0))
+
+        for duration in [0.005, 0.01, 0.05, 0.5, 0.5, 3]:
+            hist.observe(duration)
+
+        assert hist.count == 6
+        assert hist.counts == [2, 1, 2, 1]
+        assert hist.quantile(0.3) == 0.01
+        assert hist.quantile(0.5) == 0.1
+        assert hist.quantile(0.8) == 1.0
+        assert hist.quantile(1) == float('inf')
+        assert hist.as_dict()['buckets'] == {'0.01': 2, '0.1': 3, '1.0': 5}
+
+        lines = hist.to_prometheus('op_seconds', 'op="get"')
+        assert 'op_seconds_bucket{op="get",le="0.1"} 3' in lines
+        assert 'op_seconds_bucket{op="get",le="+Inf"} 6' in lines
+        assert 'op_seconds_count{op="get"} 6' in lines
+
+    @pytest.mark.asyncio
+    async def test_cache_ops(self, cache):
+        url = URL('https://example.org/page')
+        cacheio.configure(OmegaConf.create({
+            'cache_io_workers': 2,
+            'cache_io_inline_max': 16
+        }))
+        cacheio.latencies.clear()
+
+        assert await cacheio.cache_resource(cache, url, 'text/plain',
+                                            'small', ttl=60)
+        assert (await cacheio.get_resource(cache, url))[1] == 'small'
+
+        assert await cacheio.cache_resource(cache, url, 'text/plain',
+                                            'x' * 1024, ttl=60)
+        assert (await cacheio.get_resource(cache, url))[1] == 'x' * 1024
+
+        assert await cacheio.cache_rendered(cache, url, 'fp', '# Page',
+                                            'Page')
+        assert await cacheio.get_rendered(cache, url, 'fp') == (
+            '# Page', 'Page')
+
+        assert await cacheio.set_value(cache, 'key', {'a': 1})
+        assert await cacheio.get_value(cache, 'key') == {'a': 1}
+
+        assert await cacheio.uncache_resource(cache, url)
+        assert await cacheio.get_resource(cache, url) is None
+
+        assert cacheio.latencies['get_resource'].count == 3
+        assert cacheio.latencies['cache_resource'].count == 2
+        assert 'levior_cache_io_seconds_count{op="get_resource"} 3' in \
+            cacheio.latencies_prometheus()
+
+        cacheio.shutdown_executor(wait=True)
+        assert cacheio.executor is None
+
+    @pytest.mark.asyncio
+    async def test_offloaded(self, cache, monkeypatch):
+        """
+        Resources and rendered pages are stored in the executor whatever
+        their size, small plain values are stored inline
+        """
+
+        url = URL('https://example.org/page')
+        threads: list = []
+        cacheio.configure(OmegaConf.create({'cache_io_inline_max': 4096}))
+
+        def spy(func):
+            def wrapper(*args, **kw):
+                threads.append(threading.current_thread())
+                return func(*args, **kw)
+            return wrapper
+
+        for name in ['cache_resource', 'cache_rendered']:
+            monkeypatch.setattr(caching, name, spy(getattr(caching, name)))
+
+        monkeypatch.setattr(cache, 'set', spy(cache.set))
+
+        assert await cacheio.cache_resource(cache, url, 'text/plain', 'a',
+                                            ttl=60)
+        assert await cacheio.cache_rendered(cache, url, 'fp', '# A', 'A')
+        assert await cacheio.set_value(cache, 'key', 'small')
+
+        main = threading.current_thread()
+        assert all(thread is not main for thread in threads[:-1])
+        assert threads[-1] is main
+
+        cacheio.shutdown_executor(wait=True)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+
+from omegaconf import OmegaConf
+
+from levior import conversion
+from levior import timing
+
+
+html_page = '''
+<html>
+<body>
+<h1>Conversion</h1>
+<p>Some text with a <a href="/doc">link</a></p>
+</body>
+</html>
+'''
+
+
+convert_page = conversion.convert_page
+
+
+def hanging_convert_page(snapshot, html):
+    if html == 'hang':
+        time.sleep(60)
+
+    return convert_page(snapshot, html)
+
+
+class TestConversion:
+    @pytest.mark.parametrize('executor', ['inline', 'thread', 'process'])
+    @pytest.mark.asyncio
+    async def test_html2gemtext(self, executor):
+        config = OmegaConf.create({
+            'port': 1965,
+            'convert_executor': executor,
+            'convert_workers': 1
+        })
+
+        token = timing.start()
+
+        try:
+            gemtext, title = await conversion.html2gemtext(
+                config, {'feathers': 3}, html_page,
+                domain='test.org',
+                req_path='/',
+                gemini_server_host='localhost'
+            )
+        finally:
+            conversion.shutdown_executor(wait=True)
+
+        # The conversion steps are timed, whatever the executor
+        assert list(timing.stop(token).as_dict()) == [
+            'markdownify', 'md2gemini']
+        assert title == 'Conversion'
+        assert any(line.startswith('=> gemini://localhost/test.org/doc')
+                   for line in gemtext.splitlines())
+
+    @pytest.mark.asyncio
+    async def test_timeout(self, monkeypatch):
+        config = OmegaConf.create({
+            'port': 1965,
+            'convert_executor': 'process',
+            'convert_workers': 1,
+            'convert_timeout': 0.5
+        })
+
+        monkeypatch.setattr(conversion, 'convert_page',
+                            hanging_convert_page)
+
+        try:
+            pool = conversion.get_executor(config)
+            stuck = asyncio.ensure_future(
+                conversion.html2gemtext(config, {}, 'hang'))
+            await asyncio.sleep(0.2)
+
+            # Queued behind the stuck conversion
+            queued = asyncio.ensure_future(conversion.html2gemtext(
+                config, {}, html_page,
+                domain='test.org',
+                gemini_server_host='localhost'
+            ))
+
+            procs = list(pool._processes.values())
+            assert len(procs) == 1 and procs[0].is_alive()
+
+            stuck, queued = await asyncio.gather(stuck, queued,
+                                                 return_exceptions=True)
+
+            # The stuck worker is killed and the pool replaced, the
+            # conversion queued in the old pool is retried in the new one
+            assert isinstance(stuck, asyncio.TimeoutError)
+            assert queued[1] == 'Conversion'
+            assert not procs[0].is_alive()
+
+            gemtext, title = await conversion.html2gemtext(
+                config, {}, html_page,
+                domain='test.org',
+                gemini_server_host='localhost'
+            )
+            assert title == 'Conversion'
+            assert conversion.executor is not pool
+        finally:
+            conversion.shutdown_executor(wait=True)
+
+    def test_snapshot(self):
+        snap = conversion.conversion_snapshot(
+            OmegaConf.create({'port': 1966, 'hostname': 'localhost'}),
+            {'html_tags_ban': OmegaConf.create(['nav'])},
+            domain='test.org'
+        )
+
+        assert snap['config'] == {'port': 1966}
+        assert snap['url_config']['html_tags_ban'] == ['nav']
+        assert snap['domain'] == 'test.org'
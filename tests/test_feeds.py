@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+
+from omegaconf import OmegaConf
+
+from levior import caching
+from levior import feed2gem
+from levior import handler
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return caching.configure_cache(OmegaConf.create({
+        'cache_eviction_policy': 'least-recently-used',
+        'cache_path': str(tmpdir.join('diskcache')),
+        'cache_size_limit': int(1e6)
+    }))
+
+
+class FakeFeed(dict):
+    pass
+
+
+class TestFeedFetch:
+    @pytest.mark.asyncio
+    async def test_feed_fetch(self, cache, monkeypatch):
+        url_config = {'proxy_url': None, 'user_agent': None}
+        feed_config = OmegaConf.create({'req_timeout': 1})
+
+        async def fetched(url, **kw):
+            return None, '', FakeFeed(entries=[{'title': 'e1'}]), 'e1', None
+
+        async def not_modified(url, **kw):
+            raise feed2gem.FeedNotModified()
+
+        async def slow(url, **kw):
+            await asyncio.sleep(10)
+
+        monkeypatch.setattr(feed2gem, 'feed_fromurl', fetched)
+        feed = await handler.feed_fetch(cache, 'https://a.org/rss',
+                                        feed_config, url_config)
+        assert feed['entries'][0]['title'] == 'e1'
+        assert handler.feeds_fetch_stats['https://a.org/rss'][
+            'status'] == 'fetched'
+
+        # Not modified: the cached feed is served
+        monkeypatch.setattr(feed2gem, 'feed_fromurl', not_modified)
+        feed = await handler.feed_fetch(cache, 'https://a.org/rss',
+                                        feed_config, url_config)
+        assert feed['entries'][0]['title'] == 'e1'
+        assert handler.feeds_fetch_stats['https://a.org/rss'][
+            'status'] == 'not-modified'
+
+        # Concurrent fetches are bounded by the semaphore
+        monkeypatch.setattr(feed2gem, 'feed_fromurl', slow)
+        sem = asyncio.Semaphore(2)
+        tasks = [asyncio.ensure_future(handler.feed_fetch(
+            cache, f'https://{x}.org/rss', feed_config, url_config,
+            semaphore=sem)) for x in range(4)]
+
+        _, pending = await asyncio.wait(tasks, timeout=0.2)
+        assert len(pending) == 4
+        assert sem.locked()
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert handler.feeds_fetch_stats['https://0.org/rss'][
+            'status'] == 'cancelled'
+
+    @pytest.mark.asyncio
+    async def test_aggregate(self, cache, monkeypatch):
+        calls: list = []
+        config = OmegaConf.create({'feeds_aggregate_timeout': 0.5})
+        url_config = {
+            'proxy_url': None,
+            'user_agent': None,
+            'route': '/feeds',
+            'feeds': OmegaConf.create({
+                'https://fast.org/rss': {},
+                'https://slow.org/rss': {},
+                'https://off.org/rss': {'enabled': False}
+            })
+        }
+
+        async def fetch(url, **kw):
+            calls.append(str(url))
+
+            if url.host == 'slow.org':
+                await asyncio.sleep(10)
+
+            return None, '', FakeFeed(entries=[{'title': url.host}]), \
+                None, None
+
+        monkeypatch.setattr(feed2gem, 'feed_fromurl', fetch)
+
+        # The slow feed misses the deadline and is not cached yet
+        feeds = await handler.aggregate_feeds(config, cache, url_config)
+        assert [f['entries'][0]['title'] for f in feeds] == ['fast.org']
+
+        # Feeds fetched recently are not refetched by the refresher
+        calls.clear()
+        feeds = await handler.aggregate_feeds(config, cache, url_config,
+                                              refresh_interval=60)
+        assert calls == ['https://slow.org/rss']
+        assert len(feeds) == 1
+
+        assert handler.cache_feeds_tinylog(cache, url_config, '# Feeds')
+        assert cache.get(handler.feeds_tinylog_key(url_config)) == '# Feeds'
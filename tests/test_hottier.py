@@ -0,0 +1,95 @@
+from freezegun import freeze_time
+
+from yarl import URL
+from omegaconf import OmegaConf
+
+from levior import caching
+from levior.handler import fresh_until
+from levior.hottier import HotTier
+from levior.hottier import hot_tier
+
+
+class TestHotTier:
+    def test_lru(self):
+        tier = HotTier()
+        assert tier.put(('a', 'fp'), 'text/gemini', b'a') is False
+
+        tier.configure(100, max_entry_bytes=60)
+
+        assert tier.put(('a', 'fp'), 'text/gemini', b'a' * 40)
+        assert tier.put(('b', 'fp'), 'text/gemini', b'b' * 40)
+        assert tier.put(('c', 'fp'), 'text/gemini', b'c' * 70) is False
+
+        # 'a' is the most recently used: 'b' is evicted
+        assert tier.get(('a', 'fp')).body == b'a' * 40
+        assert tier.put(('c', 'fp'), 'text/gemini', b'c' * 40)
+        assert tier.get(('b', 'fp')) is None
+        assert tier.size == 80
+        assert len(tier) == 2
+
+        stats = tier.as_dict()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['evictions'] == 1
+        assert stats['hit_ratio'] == 0.5
+
+        # Replace an entry
+        assert tier.put(('c', 'fp'), 'text/gemini', b'c' * 10)
+        assert tier.size == 50
+
+        tier.configure(20)
+        assert len(tier) == 1
+        assert tier.max_entry_bytes == 2
+
+    def test_expiration(self):
+        tier = HotTier(1000, 1000)
+
+        with freeze_time('2024-02-14 12:00:00') as ft:
+            now = ft.time_to_freeze.timestamp()
+
+            assert tier.put(('a', 'fp'), 'text/gemini', b'a',
+                            expires=now - 1) is False
+            assert tier.put(('a', 'fp'), 'text/gemini', b'a',
+                            expires=now + 60)
+            assert tier.put(('b', 'fp'), 'text/gemini', b'b')
+
+            ft.tick(30)
+            assert tier.get(('a', 'fp'))
+
+            ft.tick(40)
+            assert tier.get(('a', 'fp')) is None
+            assert tier.get(('b', 'fp'))
+            assert tier.stats['expirations'] == 1
+
+            known, expires = fresh_until(None, False, 60)
+            assert known and expires == now + 130
+            assert fresh_until(None, False, -1) == (True, None)
+            assert fresh_until({'fresh_until': 10}, True, 60) == (True, 10)
+            assert fresh_until(None, True, 60) == (False, None)
+
+    def test_invalidation(self, tmpdir):
+        cache = caching.configure_cache(OmegaConf.create({
+            'cache_eviction_policy': 'least-recently-used',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_size_limit': 10
+        }))
+        url = URL('https://example.org/page')
+        key = caching.cache_key_for_url(url)
+
+        hot_tier.configure(1024)
+
+        try:
+            hot_tier.put((key, 'fp1'), 'text/gemini', b'# Page')
+            hot_tier.put((key, 'fp2'), 'text/gemini', b'# Page')
+
+            # Storing the resource in the disk cache invalidates it
+            caching.cache_resource(cache, url, 'text/html', '<p>', ttl=60)
+            assert hot_tier.get((key, 'fp1')) is None
+            assert hot_tier.stats['invalidations'] == 2
+
+            hot_tier.put((key, 'fp1'), 'text/gemini', b'# Page')
+            caching.uncache_resource(cache, url)
+            assert len(hot_tier) == 0
+        finally:
+            hot_tier.configure(0)
+            hot_tier.clear()
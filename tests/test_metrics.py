@@ -0,0 +1,145 @@
+import asyncio
+import concurrent.futures
+import socket
+
+import aiohttp
+import pytest
+from omegaconf import OmegaConf
+from yarl import URL
+
+from levior import handler
+from levior import metrics as service_metrics
+from levior.metrics import Metrics
+from levior.metrics import metrics
+
+
+class TestMetrics:
+    def test_fetch_error_type(self):
+        conn_key = type('ConnKey', (), {'ssl': None, 'host': 'a.org',
+                                        'port': 443})()
+
+        assert service_metrics.fetch_error_type(
+            asyncio.TimeoutError()) == 'timeout'
+        assert service_metrics.fetch_error_type(
+            aiohttp.ClientConnectorError(
+                conn_key, socket.gaierror(-2, 'Name not known'))) == 'dns'
+        assert service_metrics.fetch_error_type(
+            aiohttp.ClientConnectorError(
+                conn_key, ConnectionRefusedError(111, 'Refused'))) == \
+            'connect'
+        assert service_metrics.fetch_error_type(
+            aiohttp.ServerDisconnectedError()) == 'disconnected'
+        assert service_metrics.fetch_error_type(
+            aiohttp.ClientError()) == 'client'
+        assert service_metrics.fetch_error_type(ValueError()) == 'other'
+
+    def test_executor_queue_depth(self):
+        assert service_metrics.executor_queue_depth(None) is None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            assert service_metrics.executor_queue_depth(pool) == 0
+
+    def test_prometheus(self):
+        mtr = Metrics()
+
+        for _ in range(3):
+            mtr.request_started()
+
+        assert mtr.in_flight == 3
+
+        mtr.request_done('domain', '20', 0.2)
+        mtr.request_done('domain', '51', 0.01)
+        mtr.fetch_error('timeout')
+        mtr.observe_lag(0.02)
+
+        data = mtr.as_dict()
+        assert data['in_flight'] == 1
+        assert data['requests'] == {'domain': {'20': 1, '51': 1}}
+        assert data['latency']['domain']['count'] == 2
+
+        dump = mtr.to_prometheus()
+        assert 'levior_requests_total{controller="domain",status="20"} 1' \
+            in dump
+        assert 'levior_request_duration_seconds_bucket{' \
+            'controller="domain",le="0.25"} 2' in dump
+        assert 'levior_fetch_errors_total{type="timeout"} 1' in dump
+        assert 'levior_requests_in_flight 1' in dump
+        assert 'levior_event_loop_lag_last_seconds 0.02' in dump
+        assert 'levior_event_loop_lag_seconds_count 1' in dump
+
+    @pytest.mark.asyncio
+    async def test_fetch_errors(self, monkeypatch):
+        async def fetch(url, config, url_config, **kwargs):
+            if url.path == '/timeout':
+                raise asyncio.TimeoutError()
+
+            return type('Resp', (), {'status': 503})(), None, 0, None
+
+        monkeypatch.setattr(handler, 'coalesced_fetch', fetch)
+        errors = dict(metrics.fetch_errors)
+
+        await handler.fetch_first([URL('https://a.org/timeout'),
+                                   URL('https://a.org/down')],
+                                  OmegaConf.create({}), {})
+
+        assert metrics.fetch_errors['timeout'] == \
+            errors.get('timeout', 0) + 1
+        assert metrics.fetch_errors['http_5xx'] == \
+            errors.get('http_5xx', 0) + 1
+
+    @pytest.mark.asyncio
+    async def test_coalescing(self, monkeypatch):
+        async def fetch(url, config, url_config, **kwargs):
+            await asyncio.sleep(0.1)
+            return None, 'text/plain', 0, b'data'
+
+        monkeypatch.setattr(handler.crawler, 'fetch', fetch)
+        before = handler.flights_dict()['fetch']
+
+        await asyncio.gather(*[
+            handler.coalesced_fetch(URL('https://a.org/miss'),
+                                    OmegaConf.create({}), {})
+            for x in range(3)
+        ])
+
+        fetches = handler.flights_dict()['fetch']
+        assert fetches['leaders'] == before['leaders'] + 1
+        assert fetches['coalesced'] == before['coalesced'] + 2
+        assert fetches['in_flight'] == 0
+
+        dump = handler.metrics_prometheus()
+        assert 'levior_coalesced_requests_total{flight="fetch"} ' \
+            f'{fetches["coalesced"]}' in dump
+        assert 'levior_leader_requests_total{flight="fetch"} ' \
+            f'{fetches["leaders"]}' in dump
+        assert 'levior_coalesced_requests_total{flight="render"}' in dump
+
+    @pytest.mark.asyncio
+    async def test_serve_http(self):
+        task = asyncio.ensure_future(service_metrics.loop_lag_task(0.01))
+        server = await service_metrics.serve_http(
+            '127.0.0.1', 0, handler.metrics_prometheus)
+        port = server.sockets[0].getsockname()[1]
+
+        try:
+            await asyncio.sleep(0.05)
+
+            async with aiohttp.ClientSession() as session:
+                async with session.get(
+                        f'http://127.0.0.1:{port}/metrics') as resp:
+                    assert resp.status == 200
+                    assert resp.headers['Content-Type'].startswith(
+                        'text/plain')
+                    dump = await resp.text()
+
+                async with session.get(
+                        f'http://127.0.0.1:{port}/other') as resp:
+                    assert resp.status == 404
+        finally:
+            task.cancel()
+            server.close()
+            await server.wait_closed()
+
+        assert 'levior_requests_in_flight' in dump
+        assert 'levior_cache_hit_ratio' in dump
+        assert metrics.loop_lag_hist.count > 0
@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+
+from omegaconf import OmegaConf
+from yarl import URL
+
+from levior import caching
+from levior import handler
+from levior.prefetch import gemtext_links
+from levior.prefetch import prefetch_policy
+from levior.prefetch import prefetcher
+from levior.rules import parse_rules
+from levior.rules import URLRulesIndex
+
+
+class TestPrefetch:
+    def test_policy(self):
+        assert prefetch_policy({}) is None
+        assert prefetch_policy({'prefetch': False}) is None
+        assert prefetch_policy({'prefetch': True})['max_links'] == 3
+        assert prefetch_policy(OmegaConf.create(
+            {'prefetch': {'max_links': 5, 'regexp': '/docs/'}})) == {
+                'max_links': 5, 'same_domain': True, 'regexp': '/docs/'}
+
+        assert list(gemtext_links(
+            '# Title\n=> /a A\ntext\n=>https://b.org/ B\n')) == [
+                '/a', 'https://b.org/']
+
+    @pytest.mark.asyncio
+    async def test_prefetch(self, tmpdir, monkeypatch):
+        config = OmegaConf.create({
+            'mode': 'proxy',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_eviction_policy': 'none',
+            'cache_size_limit': 10,
+            'cache_ttl_default': 600,
+            'convert_executor': 'inline',
+            'links_mode': 'paragraph',
+            'feathers': 4,
+            'verify_ssl': True,
+            'lang_default_iso639': 'en'
+        })
+        cache = caching.configure_cache(config)
+        fetched: list = []
+
+        class Resp:
+            status = 200
+            headers: dict = {}
+
+        async def fetch(url, config, url_config, **kwargs):
+            fetched.append(str(url))
+            links = ''.join(f'<p><a href="{href}">{href}</a></p>' for href in [
+                '/a', 'https://other.org/', '/b', '/c'])
+            page = f'<html><body><h1>{url.path}</h1>{links}</body></html>'
+            return Resp(), 'text/html', len(page), page.encode()
+
+        monkeypatch.setattr(handler, 'coalesced_fetch', fetch)
+
+        rules = URLRulesIndex(parse_rules(OmegaConf.create({
+            'rules': [{
+                'url': 'example.org',
+                'cache': True,
+                'prefetch': {'max_links': 2}
+            }]
+        })))
+        request_handler = handler.create_levior_handler(config, cache, rules)
+
+        await handler.warmup_fetcher(request_handler)(
+            URL('https://example.org/page'))
+
+        for _ in range(50):
+            if len(fetched) == 3 and not prefetcher.as_dict()['pending']:
+                break
+
+            await asyncio.sleep(0.05)
+
+        # The first 2 links to the same domain are prefetched (but not the
+        # links of the prefetched pages)
+        assert fetched[0] == 'https://example.org/page'
+        assert sorted(fetched[1:]) == ['https://example.org/a',
+                                       'https://example.org/b']
+        assert prefetcher.stats['prefetched'] == 2
+
+        for path in ['/a', '/b']:
+            assert caching.get_resource(
+                cache, URL(f'https://example.org{path}')) is not None
+
+    @pytest.mark.asyncio
+    async def test_no_background_tasks(self, tmpdir, monkeypatch):
+        # Handler built for a cache warm-up: no prefetching, no metrics
+        # listener or other background task
+        config = OmegaConf.create({
+            'mode': 'proxy',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_eviction_policy': 'none',
+            'cache_size_limit': 10,
+            'persist_access_log': True,
+            'feeds_background_refresh': True,
+            'metrics_listen': '127.0.0.1:0',
+            'cache_dedup': True
+        })
+        cache = caching.configure_cache(config)
+        rules = URLRulesIndex(parse_rules(OmegaConf.create({
+            'rules': [{'url': 'example.org', 'prefetch': True}]
+        })))
+
+        monkeypatch.setattr(prefetcher, '_handler', None)
+        tasks = asyncio.all_tasks()
+
+        handler.create_levior_handler(config, cache, rules,
+                                      background_tasks=False)
+
+        assert not prefetcher.enabled
+        assert asyncio.all_tasks() == tasks
+
+    @pytest.mark.asyncio
+    async def test_uncached_links(self, tmpdir):
+        # The links whose rule doesn't cache the resources are skipped
+        config = OmegaConf.create({
+            'mode': 'proxy',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_eviction_policy': 'none',
+            'cache_size_limit': 10,
+            'cache_ttl_default': 600
+        })
+        cache = caching.configure_cache(config)
+        rules = URLRulesIndex(parse_rules(OmegaConf.create({
+            'rules': [
+                {'url': r'example\.org/nocache', 'cache': False},
+                {'url': 'example.org', 'cache': True, 'prefetch': True}
+            ]
+        })))
+
+        handler.create_levior_handler(config, cache, rules)
+
+        gemtext = '=> /nocache/a A\n=> /b B\n=> /nocache C\n=> /c C\n'
+        assert prefetcher.candidates(
+            URL('https://example.org/page'), gemtext,
+            prefetch_policy({'prefetch': True})) == [
+                URL('https://example.org/b'), URL('https://example.org/c')]
+
+        for task in handler.background_jobs:
+            task.cancel()
@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+from omegaconf import OmegaConf
+
+from levior.handler import get_url_config
+from levior.rules import parse_rules
+from levior.rules import regexp_literal_prefix
+from levior.rules import regexp_required_literal
+from levior.rules import URLRulesIndex
+
+
+@pytest.fixture
+def rules():
+    return parse_rules(OmegaConf.create({
+        'rules': [
+            {'url': r'^https://docs\.python\.org/3/', 'feathers': 1},
+            {'url': r'^https?://[\w.-]*theguardian.com', 'feathers': 2},
+            {'url': r'^gemini://[\w\.:]+/ftvinfo', 'type': 'feeds_aggregator'},
+            {'url': r'(?i)^https://CASE\.org/', 'feathers': 3},
+            {'url': [r'\.(png|jpg)$', r'^https://docs\.python\.org/'],
+             'feathers': 4},
+            {'url': r'https://searx.be', 'feathers': 5}
+        ]
+    }))
+
+
+class TestRulesIndex:
+    @pytest.mark.parametrize('pattern,prefix,required', [
+        (r'^https://docs\.python\.org/3/', 'https://docs.python.org/3/',
+         'https://docs.python.org/3/'),
+        (r'^https?://[\w.-]*theguardian.com', 'http', 'theguardian'),
+        (r'^gemini://[\w\.]+/aljazeera', 'gemini://', '/aljazeera'),
+        (r'(a|b)xyz', '', 'xyz'),
+        (r'a|b', '', ''),
+        (r'x{2}', '', 'x'),
+        (r'/[a-f0-9]{32,64}$', '/', '/'),
+        (r'^https://a\.org/ab{0,3}cd', 'https://a.org/a', 'https://a.org/a'),
+        (r'ab{2}cd', 'a', 'ab'),
+        (r'x{,3}yz', '', 'yz')
+    ])
+    def test_literals(self, pattern, prefix, required):
+        assert regexp_literal_prefix(pattern) == prefix
+        assert regexp_required_literal(pattern) == required
+
+    @pytest.mark.parametrize('url', [
+        'https://docs.python.org/3/library/index.html',
+        'https://docs.python.org/2/',
+        'https://www.theguardian.com/international',
+        'gemini://localhost/ftvinfo',
+        'https://case.org/test',
+        'https://example.org/image.png',
+        'https://example.org/?u=https://docs.python.org/3/',
+        'https://searx.be/search?q=cats',
+        'https://nomatch.org'
+    ])
+    def test_match(self, rules, url):
+        index = URLRulesIndex(rules)
+        linear = next((r for r in rules if any(
+            reg.search(url) for reg in r.regexps)), None)
+
+        assert index.match(url) is linear
+
+    def test_url_config(self, rules):
+        config = OmegaConf.create({'cache_ttl_default': 60})
+        index = URLRulesIndex(rules, lru_size=2)
+
+        for x in range(3):
+            ucfg = get_url_config(
+                config, index, 'https://www.theguardian.com/uk')
+            assert ucfg['feathers'] == 2
+            ucfg['http_links_domains'] = ['theguardian.com']
+
+        assert index[1].match_count == 3
+        assert 'http_links_domains' not in get_url_config(
+            config, index, 'https://www.theguardian.com/uk')
+
+        assert get_url_config(
+            config, index, 'https://nomatch.org')['ttl'] == 60
+
+        get_url_config(config, index, 'https://searx.be')
+        assert len(index._lru) == 2
+
+    def test_match_random(self):
+        """
+        The index must always match the same rule as the linear scan
+        """
+
+        rnd = random.Random(42)
+        patterns = [
+            r'^https://cdn\.example\.org/[a-f0-9]{32,64}$',
+            r'/[a-f0-9]{32,64}',
+            r'^https://example\.org/a{2}b',
+            r'^https://example\.org/x{0,2}y',
+            r'example\.org/p{1,}',
+            r'q{,2}z$',
+            r'^https://example\.org/',
+            r'^https?://[\w.-]*example\.org/(a|b)1{3}',
+            r'\.(png|jpg)$'
+        ]
+        rules = parse_rules(OmegaConf.create({
+            'rules': [{'url': pattern, 'feathers': pos + 1}
+                      for pos, pattern in enumerate(patterns)]
+        }))
+        config = OmegaConf.create({'cache_ttl_default': 60})
+        index = URLRulesIndex(rules)
+
+        for x in range(2000):
+            path = ''.join(rnd.choice('abxyzpq0123456789f/.')
+                           for c in range(rnd.randint(0, 70)))
+            url = rnd.choice(['https://cdn.example.org/',
+                              'https://example.org/',
+                              'http://www.example.org/',
+                              'https://other.net/']) + path + \
+                rnd.choice(['', '.png', 'z', '111'])
+
+            assert get_url_config(config, index, url) == \
+                get_url_config(config, rules, url), url
@@ -137,6 +137,7 @@ def config_with_includes(tmpdir):
     cfg = OmegaConf.create({
         'persist_access_log': True,
         'access_log_endpoint': True,
+        'metrics_endpoint': True,
         'mount': {
             '/alpine': {
                 'type': 'zim',
@@ -645,7 +646,22 @@ class TestFeedsAggregation:
             URL('gemini://localhost/access_log')
         )
         assert resp.status == Status.SUCCESS
-        assert doc._lines[0].text == 'Access log'
+        assert doc._lines[0].text.startswith('Access log (')
+
+        # Filter the access log by status class
+        resp, doc = await client.request_gmidoc(
+            URL('gemini://localhost/access_log?status=5&page=1')
+        )
+        assert resp.status == Status.SUCCESS
+        assert doc._lines[1].text == 'Filters: status: 5'
+
+        # Request the metrics
+        resp, doc = await client.request_gmidoc(
+            URL('gemini://localhost/metrics')
+        )
+        assert resp.status == Status.SUCCESS
+        assert any(line.text.startswith('levior_requests_total{')
+                   for line in doc._lines)
 
 
 class TestZIM:
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+
+from levior.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    @pytest.mark.asyncio
+    async def test_coalescing(self):
+        calls: list = []
+        flights = SingleFlight()
+
+        async def fetch(url):
+            calls.append(url)
+            await asyncio.sleep(0.2)
+            return url.upper()
+
+        results = await asyncio.gather(*[
+            flights.run(url, fetch, url) for url in ['a', 'a', 'b', 'a']
+        ])
+
+        assert calls == ['a', 'b']
+        assert [r[0] for r in results] == ['A', 'A', 'B', 'A']
+        assert [r[1] for r in results] == [False, True, False, True]
+        assert flights.stats == {'leaders': 2, 'coalesced': 2}
+        assert len(flights) == 0
+
+        # Once done, the next call runs again
+        assert await flights.run('a', fetch, 'a') == ('A', False)
+
+    @pytest.mark.asyncio
+    async def test_errors(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.1)
+            raise ValueError('failed')
+
+        results = await asyncio.gather(
+            flights.run('k', fail), flights.run('k', fail),
+            return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+
+        # A follower runs the call itself if the leader is cancelled
+        async def slow():
+            await asyncio.sleep(0.2)
+            return 1
+
+        leader = asyncio.ensure_future(flights.run('s', slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run('s', slow))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+
+        assert await follower == (1, False)
+
+    @pytest.mark.asyncio
+    async def test_leader_cancelled(self):
+        # Only one of the followers takes over a cancelled leader, the
+        # others wait for it
+        calls: list = []
+        flights = SingleFlight()
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return 1
+
+        leader = asyncio.ensure_future(flights.run('s', slow))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flights.run('s', slow))
+                     for x in range(3)]
+        await asyncio.sleep(0.05)
+        leader.cancel()
+
+        results = await asyncio.gather(*followers)
+        assert len(calls) == 2
+        assert sorted(shared for _, shared in results) == [False, True, True]
+        assert len(flights) == 0
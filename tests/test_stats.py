@@ -0,0 +1,95 @@
+from yarl import URL
+from omegaconf import OmegaConf
+
+from levior import caching
+from levior.handler import cache_outcome
+from levior.stats import CacheStats
+from levior.stats import cache_stats
+from levior.stats import rule_label
+
+
+class TestCacheStats:
+    def test_counters(self):
+        stats = CacheStats(max_hosts=2)
+        rule = {'url': ['^https://a.org']}
+
+        stats.record_outcome('hit', rule, 'a.org', size=100)
+        stats.record_outcome('stale', rule, 'a.org', size=50)
+        stats.record_outcome('miss', rule, 'a.org')
+        stats.record_outcome('revalidated', None, 'b.org', size=10)
+        stats.record_outcome('bypass', None, 'c.org')
+        stats.record_store('a.org', 0.5, 100)
+        stats.record_store('a.org', 0.1, 100)
+        stats.record_eviction('a.org')
+
+        data = stats.as_dict()
+        assert data['total']['hits'] == 1
+        assert data['total']['stale'] == 1
+        assert data['total']['misses'] == 1
+        assert data['total']['bypass'] == 1
+        assert data['total']['bytes_saved'] == 160
+        assert data['total']['hit_ratio'] == 0.75
+        assert data['total']['evictions'] == 1
+        assert data['total']['stores'] == 2
+        assert abs(data['total']['store_latency'] - 0.3) < 1e-9
+
+        assert list(data['rules'].keys()) == ['^https://a.org']
+        assert data['rules']['^https://a.org']['hit_ratio'] == 2 / 3
+
+        # Hosts beyond max_hosts are counted as 'other'
+        assert list(data['hosts'].keys()) == ['a.org', 'b.org', 'other']
+        assert data['hosts']['a.org']['bytes_stored'] == 200
+        assert data['hosts']['other']['bypass'] == 1
+        assert data['hosts']['other']['hit_ratio'] is None
+
+        prom = stats.to_prometheus()
+        assert '# TYPE levior_cache_hits_total counter' in prom
+        assert 'levior_cache_hits_total 1\n' in prom
+        assert 'levior_cache_host_hits_total{host="a.org"} 1\n' in prom
+        assert 'levior_cache_rule_hits_total{rule="^https://a.org"} 1\n' \
+            in prom
+        assert 'levior_cache_hits_total{' not in prom
+        assert 'levior_cache_hit_ratio 0.75\n' in prom
+
+        stats.reset()
+        assert stats.as_dict()['total']['hits'] == 0
+
+    def test_rule_label(self):
+        assert rule_label(None) == 'default'
+        assert rule_label({'cache': True}) == 'default'
+        assert rule_label({'name': 'docs', 'url': 'x'}) == 'docs'
+        assert rule_label({'regexp': '^https://a.org'}) == '^https://a.org'
+        assert rule_label(OmegaConf.create(
+            {'url': ['^a', '^b']})) == '^a,^b'
+
+    def test_cache_outcome(self):
+        fresh = ('text/plain', 'a', caching.resource_meta(60))
+        stale = ('text/plain', 'a', caching.resource_meta(-1))
+
+        assert cache_outcome({'cache': True}, None) == 'miss'
+        assert cache_outcome({'cache': False}, None) == 'bypass'
+        assert cache_outcome({}, fresh) == 'hit'
+        assert cache_outcome({}, stale) == 'stale'
+
+    def test_store_and_evictions(self, tmpdir):
+        cache = caching.configure_cache(OmegaConf.create({
+            'cache_eviction_policy': 'least-recently-stored',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_size_limit': 10
+        }))
+        url = URL('https://stats.example.org/page')
+
+        cache_stats.reset()
+        caching.cache_resource(cache, url, 'text/plain', 'hello', ttl=60)
+
+        host = cache_stats.as_dict()['hosts']['stats.example.org']
+        assert host['stores'] == 1
+        assert host['bytes_stored'] == 5
+
+        # Removed from the diskcache behind the index's back: evicted
+        del cache[caching.cache_key_for_url(url)]
+        assert caching.get_resource(cache, url) is None
+        assert caching.get_resource(cache, url) is None
+        assert caching.flush_index(cache) == 1
+        assert caching.flush_index(cache) == 0
+        assert cache_stats.as_dict()['total']['evictions'] == 1
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from levior import timing
+
+
+class TestTiming:
+    def test_request_timings(self):
+        rtimings = timing.RequestTimings()
+
+        with rtimings.measure('write'):
+            pass
+
+        rtimings.add('rule', 0.002)
+        rtimings.add('rule', 0.001)
+        rtimings.add('fetch', 0.5)
+
+        # Phases are listed in order, fetch and convert are not phases
+        assert list(rtimings.as_dict()) == ['rule', 'write']
+        assert rtimings.as_dict()['rule'] == 3.0
+        assert rtimings.get('fetch') == 0.5
+        assert rtimings.summary().startswith('rule: 3 ms, write: ')
+
+        elapsed = rtimings.finish()
+        assert rtimings.elapsed == elapsed
+
+        # Nothing is recorded once the request is done
+        rtimings.add('filters', 1)
+        assert rtimings.get('filters') is None
+
+    def test_context(self, caplog):
+        # No timing context: nothing is recorded
+        with timing.measure('rule'):
+            timing.record('dns', 1)
+
+        assert timing.timings() is None
+
+        token = timing.start()
+        with timing.measure('rule'):
+            timing.record('dns', 1)
+
+        rtimings = timing.stop(token)
+        assert timing.timings() is None
+        assert rtimings.get('dns') == 1
+        assert rtimings.get('rule') is not None
+
+        # The request took 2 seconds
+        rtimings.finished = rtimings.started + 2
+
+        with caplog.at_level(logging.WARNING, logger='levior.slow'):
+            assert not timing.log_slow_request('/fast', rtimings, 0)
+            assert not timing.log_slow_request('/fast', rtimings, 5)
+            assert timing.log_slow_request('/slow', rtimings, 1)
+
+        assert 'Slow request: /slow (2.000 s)' in caplog.text
+        assert 'dns: 1000 ms' in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_trace_config(self):
+        async def page(request):
+            await asyncio.sleep(0.05)
+            return web.Response(text='hello')
+
+        app = web.Application()
+        app.router.add_get('/', page)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        token = timing.start()
+
+        try:
+            async with aiohttp.ClientSession(
+                    trace_configs=[timing.trace_config()]) as session:
+                async with session.get(f'http://127.0.0.1:{port}/') as resp:
+                    assert await resp.text() == 'hello'
+        finally:
+            rtimings = timing.stop(token)
+            await runner.cleanup()
+
+        assert 'connect' in rtimings.phases
+        assert rtimings.get('ttfb') >= 0.04
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+import pytest
+
+from yarl import URL
+from omegaconf import OmegaConf
+
+from levior import accesslog
+from levior import caching
+from levior import handler
+from levior import warmup
+from levior.accesslog import AccessLog
+from levior.accesslog import AccessRecord
+from levior.rules import parse_rules
+from levior.rules import URLRulesIndex
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return caching.configure_cache(OmegaConf.create({
+        'cache_eviction_policy': 'least-recently-used',
+        'cache_path': str(tmpdir.join('diskcache')),
+        'cache_size_limit': int(1e6)
+    }))
+
+
+class TestWarmup:
+    def test_warmup_sources(self, cache, tmpdir):
+        urls = tmpdir.join('urls.txt')
+        urls.write('# Pages\nhttps://a.org/1\n\nhttps://b.org/\n')
+        assert warmup.warmup_urls_file(str(urls)) == [
+            URL('https://a.org/1'), URL('https://b.org/')]
+
+        sitemap = tmpdir.join('sitemap.xml')
+        sitemap.write(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            '<url><loc>https://a.org/</loc></url>'
+            '<url><loc> https://a.org/about </loc></url></urlset>')
+        assert warmup.warmup_urls_file(str(sitemap)) == [
+            URL('https://a.org/'), URL('https://a.org/about')]
+
+        log = AccessLog()
+        for url in ['https://a.org/1', 'https://b.org/', 'https://b.org/']:
+            log.append(AccessRecord(time=time.time(), url=url, status=20))
+        accesslog.persist_access_log(cache, log)
+
+        # Most requested first
+        assert warmup.warmup_urls_access_log(cache) == [
+            URL('https://b.org/'), URL('https://a.org/1')]
+
+        assert warmup.warmup_order([
+            URL('https://a.org/1'), URL('https://a.org/2'),
+            URL('https://a.org/1'), URL('https://b.org/1')
+        ]) == [URL('https://a.org/1'), URL('https://b.org/1'),
+               URL('https://a.org/2')]
+
+    @pytest.mark.asyncio
+    async def test_warm_cache(self):
+        fetched: list = []
+        failures: list = []
+
+        async def fetch(url: URL) -> int:
+            fetched.append((url, asyncio.get_running_loop().time()))
+
+            if url.path == '/error':
+                raise warmup.WarmupError('NOT_FOUND')
+
+            return 100
+
+        urls = [URL(f'https://a.org/{idx}') for idx in range(3)] + [
+            URL('https://b.org/'), URL('https://b.org/error')]
+
+        report = await warmup.warm_cache(
+            urls, fetch, concurrency=4, host_rate=20,
+            progress=lambda url, err: failures.append(url) if err else None)
+
+        assert report.total == 5
+        assert report.fetched == 4
+        assert report.size == 400
+        assert report.failed == {'https://b.org/error': 'NOT_FOUND'}
+        assert failures == [URL('https://b.org/error')]
+        assert report.throughput > 0
+
+        # Requests to a host are spaced by 1 / host_rate seconds
+        times = [t for url, t in fetched if url.host == 'a.org']
+        assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+
+    @pytest.mark.asyncio
+    async def test_warmup_fetcher(self, tmpdir, monkeypatch):
+        config = OmegaConf.create({
+            'mode': 'proxy',
+            'cache_path': str(tmpdir.join('diskcache')),
+            'cache_eviction_policy': 'none',
+            'cache_size_limit': 10,
+            'cache_ttl_default': 600,
+            'convert_executor': 'inline',
+            'links_mode': 'paragraph',
+            'feathers': 4,
+            'verify_ssl': True,
+            'lang_default_iso639': 'en'
+        })
+        cache = caching.configure_cache(config)
+        page = b'<html><body><h1>Hello</h1><p>World</p></body></html>'
+
+        class Resp:
+            status = 200
+            headers: dict = {}
+
+        async def fetch(url, config, url_config, **kwargs):
+            if url.path == '/missing':
+                return Resp(), None, 0, None
+
+            return Resp(), 'text/html', len(page), page
+
+        monkeypatch.setattr(handler, 'coalesced_fetch', fetch)
+
+        rules = URLRulesIndex(parse_rules(OmegaConf.create({
+            'rules': [{'url': 'example.org', 'cache': True}]})))
+        access_log = AccessLog()
+        fetcher = handler.warmup_fetcher(
+            handler.create_levior_handler(config, cache, rules,
+                                          access_log=access_log))
+
+        report = await warmup.warm_cache(
+            [URL('https://example.org/page'),
+             URL('https://example.org/missing')],
+            fetcher, host_rate=0)
+
+        assert report.fetched == 1
+        assert report.size > 0
+        assert list(report.failed) == ['https://example.org/missing']
+
+        # Cached, with its rendered gemtext
+        assert caching.get_resource(
+            cache, URL('https://example.org/page'))[1] == page
+        assert any(key.startswith(caching.rendered_key_prefix)
+                   for key in cache.iterkeys())
+
+        # Timing breakdown of the request
+        record = access_log.query(host='example.org', status=20)[0]
+        assert record.outcome == 'miss'
+        assert record.fetch_time is not None
+        assert record.convert_time is not None
+        assert record.duration >= record.fetch_time + record.convert_time
+        assert list(record.timings) == ['rule', 'cache_lookup', 'markdownify',
+                                        'md2gemini', 'write']
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import time
+import traceback
+
+import pytest
+from omegaconf import OmegaConf
+
+from levior import watchdog as lwatchdog
+from levior.watchdog import StallWatchdog
+
+
+def blocking_call(duration: float) -> None:
+    time.sleep(duration)
+
+
+class TestWatchdog:
+    @pytest.mark.asyncio
+    async def test_stall(self, caplog):
+        watchdog = StallWatchdog()
+        watchdog.configure(OmegaConf.create({
+            'stall_threshold': 50,
+            'stall_history': 2
+        }))
+        assert watchdog.threshold == 0.05
+        assert not watchdog.enabled
+
+        watchdog.start(asyncio.get_running_loop())
+
+        try:
+            await asyncio.sleep(0.1)
+            assert watchdog.count == 0
+
+            # Block the loop
+            blocking_call(0.3)
+            await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+
+        assert not watchdog.enabled
+        assert watchdog.count == 1
+
+        stall = watchdog.stalls[0]
+        assert stall.duration >= 0.25
+        assert stall.location == 'blocking_call (test_watchdog.py:14)'
+        assert any('time.sleep(duration)' in line for line in stall.stack)
+
+        assert stall.gemtext().startswith('## [')
+        assert watchdog.as_dict()['stalls'][0]['location'] == stall.location
+        assert 'Event loop blocked for' in caplog.text
+
+    def test_location(self):
+        def frame(filename: str, name: str) -> traceback.FrameSummary:
+            return traceback.FrameSummary(filename, 10, name)
+
+        levior_file = os.path.join(lwatchdog.package_dir, 'crawler.py')
+        dc_file = '/usr/lib/python3/site-packages/diskcache/core.py'
+
+        assert lwatchdog.stall_location(traceback.StackSummary()) == 'unknown'
+        assert lwatchdog.stall_location(traceback.StackSummary.from_list([
+            frame('/usr/lib/python3/asyncio/events.py', '_run'),
+            frame(levior_file, 'convert')
+        ])) == 'convert (crawler.py:10)'
+        assert lwatchdog.stall_location(traceback.StackSummary.from_list([
+            frame(levior_file, 'get_resource'),
+            frame(dc_file, 'get')
+        ])) == 'get_resource (crawler.py:10) -> get (core.py:10)'
@@ -1,3 +1,7 @@
+import asyncio
+import threading
+
+import aiohttp
 import pytest
 from yarl import URL
 from omegaconf import OmegaConf
@@ -5,6 +9,9 @@ from aiohttp_socks import ProxyConnector, ChainProxyConnector
 from aiohttp_socks import ProxyType
 
 from levior.web import get_proxy_connector
+from levior.web import get_client_session
+from levior.web import close_client_sessions
+from levior.web import client_sessions
 from levior.web import valid_proxy_url
 from levior.web import custom_random_useragent
 from levior.web import random_useragent
@@ -53,6 +60,57 @@ class TestProxies:
         assert conn._proxy_infos[1].port == 8092
 
 
+class TestClientSessions:
+    @pytest.mark.asyncio
+    async def test_pooled_sessions(self):
+        config = OmegaConf.create({'http_pool_limit_per_host': 2})
+
+        s1 = get_client_session(config)
+        assert get_client_session(config) is s1
+        assert s1.connector.limit_per_host == 2
+
+        s2 = get_client_session(config, verify_ssl=False)
+        s3 = get_client_session(config, proxy_url='socks5://localhost:9050')
+        assert s2 is not s1
+        assert s3 is not s1
+        assert isinstance(s3.connector, ProxyConnector)
+
+        # The sessions are shared by all the clients: no cookies
+        assert isinstance(s1.cookie_jar, aiohttp.DummyCookieJar)
+
+        await close_client_sessions()
+        assert s1.closed and s2.closed and s3.closed
+        assert len(client_sessions) == 0
+
+    @pytest.mark.asyncio
+    async def test_other_loop_sessions(self):
+        # Sessions created by an event loop of another thread
+        sessions: list = []
+
+        def create():
+            loop = asyncio.new_event_loop()
+
+            async def get():
+                return get_client_session(), loop
+
+            sessions.append(loop.run_until_complete(get()))
+
+        thread = threading.Thread(target=create)
+        thread.start()
+        thread.join()
+
+        session, sloop = sessions[0]
+        assert client_sessions[((), True, False)][0] is session
+
+        # Replaced by a session for this loop, the old one is closed
+        assert get_client_session() is not session
+        assert session.closed
+
+        await close_client_sessions()
+        assert len(client_sessions) == 0
+        sloop.close()
+
+
 class TestUserAgent:
     def test_random(self):
         assert random_useragent()